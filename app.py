@@ -1,11 +1,35 @@
-from flask import Flask, request, jsonify, render_template, session
+from flask import Flask, request, jsonify, render_template, session, Response
 import requests
 import json
+import csv
 import uuid
 from datetime import datetime
 import sqlite3
 import os
 import re
+import time
+import hashlib
+import base64
+import codecs
+import mmap
+import posixpath
+import zipfile
+from xml.etree import ElementTree
+import random
+import tempfile
+import asyncio
+import concurrent.futures
+import select
+import socket
+import threading
+import queue
+import itertools
+import heapq
+import math
+import operator
+from array import array
+import multiprocessing
+from collections import OrderedDict, deque
 from werkzeug.utils import secure_filename
 import mimetypes
 from pathlib import Path
@@ -94,7 +118,7 @@ except ImportError:
     print("WARNING: PDF library not installed. PDF support disabled.")
 
 try:
-    from PIL import Image
+    from PIL import Image, ImageOps
     import io
     IMAGE_AVAILABLE = True
     print("+ Image processing enabled")
@@ -127,13 +151,40 @@ except ImportError:
     PPTX_AVAILABLE = False
     print("WARNING: python-pptx not installed. PowerPoint support disabled.")
 
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+    print("+ numpy enabled for vector search")
+except ImportError:
+    NUMPY_AVAILABLE = False
+    print("WARNING: numpy not installed. Vector search uses pure Python.")
+
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-this-in-production'
 
 # Ollama configuration
-OLLAMA_BASE_URL = 'http://localhost:11434'
+OLLAMA_BASE_URL = os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434')
 DEFAULT_MODELS = ['llama2', 'codellama', 'mistral']
 
+# Ollama HTTP transport configuration
+OLLAMA_POOL_SIZE = int(os.getenv('OLLAMA_POOL_SIZE', '16'))  # Keep-alive connections, roughly one per server thread
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv('OLLAMA_CONNECT_TIMEOUT', '5'))
+OLLAMA_READ_TIMEOUT = float(os.getenv('OLLAMA_READ_TIMEOUT', '120'))
+OLLAMA_MAX_RETRIES = int(os.getenv('OLLAMA_MAX_RETRIES', '2'))  # Retries on connection errors/resets only
+OLLAMA_RETRY_BACKOFF = float(os.getenv('OLLAMA_RETRY_BACKOFF', '0.5'))  # Seconds, doubled on each retry
+# Several Ollama hosts can share the chat load, comma separated (defaults to OLLAMA_BASE_URL)
+OLLAMA_BASE_URLS = [url.strip().rstrip('/') for url in os.getenv('OLLAMA_BASE_URLS', OLLAMA_BASE_URL).split(',') if url.strip()]
+OLLAMA_HEALTH_INTERVAL = float(os.getenv('OLLAMA_HEALTH_INTERVAL', '15'))  # Seconds between host probes
+OLLAMA_EJECT_AFTER = int(os.getenv('OLLAMA_EJECT_AFTER', '2'))  # Failed probes before a host stops getting traffic
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '')  # e.g. "30m", "3600" (seconds) or "-1"; empty uses Ollama's default
+MODEL_CATALOG_REFRESH_INTERVAL = float(os.getenv('MODEL_CATALOG_REFRESH_INTERVAL', '60'))  # Seconds between /api/tags refreshes
+# Per-model read timeouts as JSON, e.g. {"llama2:70b": 300, "phi": 30}
+try:
+    OLLAMA_MODEL_TIMEOUTS = json.loads(os.getenv('OLLAMA_MODEL_TIMEOUTS', '{}'))
+except ValueError:
+    print("WARNING: OLLAMA_MODEL_TIMEOUTS is not valid JSON. Using default timeouts.")
+    OLLAMA_MODEL_TIMEOUTS = {}
+
 # Claude Code configuration
 CLAUDE_CODE_API_KEY = os.getenv('CLAUDE_CODE_API_KEY', '')  # Will be set later
 CLAUDE_CODE_MODEL = 'claude-code'
@@ -159,6 +210,9 @@ if EXCEL_AVAILABLE:
 if PPTX_AVAILABLE:
     ALLOWED_EXTENSIONS.add('pptx')
 
+# Uploads are stored once per content hash under this folder
+BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, 'blobs')
+
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
 
@@ -168,45 +222,594 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 # Database configuration
 DATABASE = 'chat_app.db'
 
+# Context window configuration (token counts are estimated at ~4 characters per token)
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '3072'))  # Keep below the model's num_ctx
+CONTEXT_MAX_HISTORY = int(os.getenv('CONTEXT_MAX_HISTORY', '50'))  # Most history messages considered
+HISTORY_ATTACHMENT_TOKENS = int(os.getenv('HISTORY_ATTACHMENT_TOKENS', '500'))  # Cap for files from earlier turns
+CONTEXT_EVICTION_BLOCK = int(os.getenv('CONTEXT_EVICTION_BLOCK', '8'))  # Old messages are dropped this many at a time
+# Per-model prompt budgets as JSON, e.g. {"mistral": 7000, "llama2": 3072}
+try:
+    MODEL_CONTEXT_BUDGETS = json.loads(os.getenv('MODEL_CONTEXT_BUDGETS', '{}'))
+except ValueError:
+    print("WARNING: MODEL_CONTEXT_BUDGETS is not valid JSON. Using default budget.")
+    MODEL_CONTEXT_BUDGETS = {}
+
+# Rolling conversation summaries (disabled unless SUMMARY_MODEL is set)
+SUMMARY_MODEL = os.getenv('SUMMARY_MODEL', '')  # A small, cheap Ollama model, e.g. phi
+SUMMARY_KEEP_RECENT = int(os.getenv('SUMMARY_KEEP_RECENT', '6'))  # Latest messages always sent verbatim
+SUMMARY_TRIGGER = int(os.getenv('SUMMARY_TRIGGER', '10'))  # Unsummarized older messages before a new summary
+
+# Generation scheduler: concurrent generations per model and a fair queue for the rest
+MODEL_CONCURRENCY = int(os.getenv('MODEL_CONCURRENCY', '2'))
+# Per-model concurrency as JSON, e.g. {"llama2:70b": 1, "phi": 4}
+try:
+    MODEL_CONCURRENCY_LIMITS = json.loads(os.getenv('MODEL_CONCURRENCY_LIMITS', '{}'))
+except ValueError:
+    print("WARNING: MODEL_CONCURRENCY_LIMITS is not valid JSON. Using default concurrency.")
+    MODEL_CONCURRENCY_LIMITS = {}
+SCHEDULER_MAX_QUEUE = int(os.getenv('SCHEDULER_MAX_QUEUE', '32'))  # Waiting requests per model before 429
+SCHEDULER_QUEUE_TIMEOUT = float(os.getenv('SCHEDULER_QUEUE_TIMEOUT', '120'))  # Seconds a request may wait
+
+# Most models a single fan-out comparison may ask at once
+FANOUT_MAX_MODELS = int(os.getenv('FANOUT_MAX_MODELS', '6'))
+
+# Batch API configuration
+BATCH_MAX_JOBS = int(os.getenv('BATCH_MAX_JOBS', '1000'))
+BATCH_MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', '8'))  # Upper bound for a batch's parallelism
+
+# Response cache configuration (opt-in, stored next to the chat database)
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+RESPONSE_CACHE_DATABASE = os.getenv('RESPONSE_CACHE_DATABASE', os.path.join(os.path.dirname(DATABASE), 'response_cache.db'))
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', str(7 * 24 * 3600)))  # Seconds
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '1000'))
+
+# Background document extraction
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', '2'))
+EXTRACTION_JOB_TTL = int(os.getenv('EXTRACTION_JOB_TTL', '3600'))  # Seconds a finished job stays pollable
+EXTRACTION_WAIT_TIMEOUT = float(os.getenv('EXTRACTION_WAIT_TIMEOUT', '300'))  # Max seconds a chat waits for its upload
+EXTRACTION_PROCESSES = int(os.getenv('EXTRACTION_PROCESSES', '2'))  # Parser processes; 0 extracts in the request thread
+EXTRACTION_TIMEOUT = float(os.getenv('EXTRACTION_TIMEOUT', '120'))  # Wall-clock seconds per file
+EXTRACTION_MEMORY_LIMIT_MB = int(os.getenv('EXTRACTION_MEMORY_LIMIT_MB', '1024'))  # Per worker; 0 disables
+EXTRACTION_MAX_TASKS_PER_WORKER = int(os.getenv('EXTRACTION_MAX_TASKS_PER_WORKER', '100'))
+
+# PDF extraction budget (0 = no limit); pages are read in ranges spread over the extraction processes
+PDF_MAX_PAGES = int(os.getenv('PDF_MAX_PAGES', '0'))
+PDF_MAX_CHARS = int(os.getenv('PDF_MAX_CHARS', '200000'))
+PDF_PAGES_PER_RANGE = int(os.getenv('PDF_PAGES_PER_RANGE', '8'))
+
+# Spreadsheet window: rows and columns read from each sheet
+EXCEL_MAX_ROWS = int(os.getenv('EXCEL_MAX_ROWS', '50'))
+EXCEL_MAX_COLS = int(os.getenv('EXCEL_MAX_COLS', '20'))
+
+# Structured data (CSV, JSON, spreadsheets) is summarized as per-column statistics
+DATA_PROFILE_ENABLED = os.getenv('DATA_PROFILE_ENABLED', 'true').lower() == 'true'
+PROFILE_CHUNK_ROWS = int(os.getenv('PROFILE_CHUNK_ROWS', '5000'))
+PROFILE_MAX_COLUMNS = int(os.getenv('PROFILE_MAX_COLUMNS', '50'))
+PROFILE_SAMPLE_ROWS = int(os.getenv('PROFILE_SAMPLE_ROWS', '10'))
+PROFILE_TOP_K = int(os.getenv('PROFILE_TOP_K', '5'))
+
+# Plain text ingestion
+TEXT_MAX_CHARS = int(os.getenv('TEXT_MAX_CHARS', '200000'))  # Larger files are excerpted (0 = no limit)
+TEXT_EXCERPT_MODE = os.getenv('TEXT_EXCERPT_MODE', 'head_tail')  # head, head_tail or sample
+TEXT_SNIFF_BYTES = int(os.getenv('TEXT_SNIFF_BYTES', '65536'))  # Prefix used to detect the encoding
+
+# Read .docx/.pptx text straight from the zip XML, falling back to python-docx/python-pptx
+OFFICE_FAST_PATH = os.getenv('OFFICE_FAST_PATH', 'true').lower() == 'true'
+
+# Long attachments are chunked into a SQLite FTS5 index; only chunks relevant to the question are sent
+RETRIEVAL_ENABLED = os.getenv('RETRIEVAL_ENABLED', 'true').lower() == 'true'
+RETRIEVAL_CHUNK_CHARS = int(os.getenv('RETRIEVAL_CHUNK_CHARS', '1200'))
+RETRIEVAL_CHUNK_OVERLAP = int(os.getenv('RETRIEVAL_CHUNK_OVERLAP', '200'))
+RETRIEVAL_TOP_K = int(os.getenv('RETRIEVAL_TOP_K', '8'))
+
+# Semantic search over session messages and attachments (empty model disables it)
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', '')
+EMBEDDING_FOLDER = os.getenv('EMBEDDING_FOLDER', 'embeddings')  # One vector file per session
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', '32'))  # Texts per /api/embed call
+EMBEDDING_RECALL_K = int(os.getenv('EMBEDDING_RECALL_K', '3'))  # Older messages recalled per turn
+EMBEDDING_MIN_SCORE = float(os.getenv('EMBEDDING_MIN_SCORE', '0.5'))  # Cosine similarity needed for recall
+
+# Images sent to vision models through Ollama's images field
+VISION_MODELS = [name.strip() for name in os.getenv(
+    'VISION_MODELS', 'llava,bakllava,llama3.2-vision,moondream,minicpm-v,qwen2.5vl,gemma3,granite3.2-vision'
+).split(',') if name.strip()]  # Name prefixes used when Ollama does not report capabilities
+VISION_MAX_EDGE = int(os.getenv('VISION_MAX_EDGE', '1024'))  # Longest image side in pixels
+VISION_JPEG_QUALITY = int(os.getenv('VISION_JPEG_QUALITY', '85'))
+VISION_HISTORY_IMAGES = int(os.getenv('VISION_HISTORY_IMAGES', '1'))  # Earlier images kept in the prompt
+VISION_CAPABILITY_TTL = int(os.getenv('VISION_CAPABILITY_TTL', '600'))  # Seconds a model's vision check is reused
+# Per-model longest side as JSON, e.g. {"llava": 672, "llama3.2-vision": 1120}
+try:
+    VISION_MODEL_MAX_EDGE = json.loads(os.getenv('VISION_MODEL_MAX_EDGE', '{}'))
+except ValueError:
+    print("WARNING: VISION_MODEL_MAX_EDGE is not valid JSON. Using VISION_MAX_EDGE.")
+    VISION_MODEL_MAX_EDGE = {}
+
+# Office Open XML namespaces used by the streaming extractors
+W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+A_NS = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+P_NS = '{http://schemas.openxmlformats.org/presentationml/2006/main}'
+R_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+
+class ExtractionError(Exception):
+    """Raised when an extraction worker times out, crashes or fails"""
+    pass
+
+class ExtractionTimeout(ExtractionError):
+    """Raised when an extraction runs past its time limit"""
+    pass
+
+class FastPathUnsupported(Exception):
+    """Raised when a document uses structures the streaming extractors do not handle"""
+    pass
+
+class OllamaConnectionError(Exception):
+    """Raised when an Ollama host cannot be reached"""
+    pass
+
+class GenerationCancelled(Exception):
+    """Raised when a generation is abandoned because the client went away"""
+    pass
+
 class OllamaClient:
-    def __init__(self, base_url=OLLAMA_BASE_URL):
+    def __init__(self, base_url=OLLAMA_BASE_URL, pool_size=OLLAMA_POOL_SIZE,
+                 connect_timeout=OLLAMA_CONNECT_TIMEOUT, read_timeout=OLLAMA_READ_TIMEOUT,
+                 model_timeouts=None, max_retries=OLLAMA_MAX_RETRIES, retry_backoff=OLLAMA_RETRY_BACKOFF,
+                 keep_alive=OLLAMA_KEEP_ALIVE):
         self.base_url = base_url
+        self.keep_alive = keep_alive
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.model_timeouts = dict(OLLAMA_MODEL_TIMEOUTS if model_timeouts is None else model_timeouts)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        
+        # Shared keep-alive session so requests reuse pooled TCP connections
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+    
+    def get_timeout(self, model=None, read_timeout=None):
+        """Return the (connect, read) timeout tuple for a model"""
+        if read_timeout is None:
+            read_timeout = self.model_timeouts.get(model, self.read_timeout)
+        return (self.connect_timeout, read_timeout)
     
-    def chat(self, model, messages):
+    def _request(self, method, path, model=None, read_timeout=None, **kwargs):
+        """Send a request over the pooled session, retrying connection errors with backoff"""
+        url = f"{self.base_url}{path}"
+        timeout = self.get_timeout(model, read_timeout)
+        
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.session.request(method, url, timeout=timeout, **kwargs)
+            except requests.exceptions.ConnectionError:
+                # Covers refused connections and resets of stale keep-alive sockets;
+                # read timeouts are not retried since the model may still be generating
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.retry_backoff * (2 ** attempt)
+                print(f"Ollama connection error, retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+                time.sleep(delay)
+    
+    def _apply_keep_alive(self, payload, keep_alive):
+        """Add keep_alive to a chat payload; it keeps the model and its cached prompt prefix loaded"""
+        if keep_alive is None:
+            keep_alive = self.keep_alive
+        if isinstance(keep_alive, str):
+            keep_alive = keep_alive.strip()
+            # Ollama reads strings as Go durations, which need a unit, so bare numbers go as seconds
+            if re.fullmatch(r'-?\d+', keep_alive):
+                keep_alive = int(keep_alive)
+        if keep_alive not in (None, ''):
+            payload["keep_alive"] = keep_alive
+    
+    def chat(self, model, messages, options=None, keep_alive=None, cancel_event=None):
         """Send chat request to Ollama"""
-        url = f"{self.base_url}/api/chat"
+        if cancel_event is not None:
+            return self._chat_cancellable(model, messages, options, keep_alive, cancel_event)
+        
         payload = {
             "model": model,
             "messages": messages,
             "stream": False
         }
+        if options:
+            payload["options"] = options
+        self._apply_keep_alive(payload, keep_alive)
         
         try:
-            response = requests.post(url, json=payload, timeout=120)
+            response = self._request('POST', '/api/chat', model=model, json=payload)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.ConnectionError:
-            raise Exception("Cannot connect to Ollama. Make sure Ollama is running on http://localhost:11434")
+            raise OllamaConnectionError(f"Cannot connect to Ollama. Make sure Ollama is running on {self.base_url}")
+        except requests.exceptions.Timeout:
+            raise Exception("Request timed out. The model might be taking too long to respond.")
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Ollama request failed: {str(e)}")
+    
+    def _chat_cancellable(self, model, messages, options, keep_alive, cancel_event):
+        """Non-streaming chat built on the stream, so it can stop as soon as cancel_event is set"""
+        parts = []
+        final_chunk = {}
+        stream = self.chat_stream(model, messages, options, keep_alive)
+        try:
+            for chunk in stream:
+                if cancel_event.is_set():
+                    # Closing the stream drops the connection, which makes Ollama stop generating
+                    raise GenerationCancelled("Client disconnected")
+                parts.append(chunk.get('message', {}).get('content', ''))
+                if chunk.get('done'):
+                    final_chunk = chunk
+        finally:
+            stream.close()
+        
+        response = dict(final_chunk)
+        response['message'] = {'role': 'assistant', 'content': "".join(parts)}
+        return response
+    
+    def chat_stream(self, model, messages, options=None, keep_alive=None):
+        """Stream chat response from Ollama, yielding each chunk as it arrives"""
+        payload = {
+            "model": model,
+            "messages": messages,
+            "stream": True
+        }
+        if options:
+            payload["options"] = options
+        self._apply_keep_alive(payload, keep_alive)
+        
+        try:
+            with self._request('POST', '/api/chat', model=model, json=payload, stream=True) as response:
+                response.raise_for_status()
+                # Ollama streams newline-delimited JSON objects
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if chunk.get('error'):
+                        raise Exception(f"Ollama request failed: {chunk['error']}")
+                    yield chunk
+                    if chunk.get('done'):
+                        break
+        except requests.exceptions.ConnectionError:
+            raise OllamaConnectionError(f"Cannot connect to Ollama. Make sure Ollama is running on {self.base_url}")
         except requests.exceptions.Timeout:
             raise Exception("Request timed out. The model might be taking too long to respond.")
         except requests.exceptions.RequestException as e:
             raise Exception(f"Ollama request failed: {str(e)}")
     
+    def embed(self, model, inputs):
+        """Embed a list of texts with /api/embed; returns one vector per input"""
+        payload = {"model": model, "input": inputs}
+        try:
+            response = self._request('POST', '/api/embed', model=model, json=payload)
+            response.raise_for_status()
+            return response.json().get('embeddings', [])
+        except requests.exceptions.ConnectionError:
+            raise OllamaConnectionError(f"Cannot connect to Ollama. Make sure Ollama is running on {self.base_url}")
+    
+    def show(self, model):
+        """Model details from /api/show, including capabilities on recent Ollama versions"""
+        response = self._request('POST', '/api/show', read_timeout=10, json={"model": model})
+        response.raise_for_status()
+        return response.json()
+    
+    def list_running_models(self):
+        """List models currently loaded in memory (raises on failure, used for health checks)"""
+        response = self._request('GET', '/api/ps', read_timeout=5)
+        response.raise_for_status()
+        return [model.get('name') for model in response.json().get('models', [])]
+    
     def list_models(self):
         """List available models"""
-        url = f"{self.base_url}/api/tags"
-        
         try:
-            response = requests.get(url, timeout=10)
+            response = self._request('GET', '/api/tags', read_timeout=10)
             response.raise_for_status()
             data = response.json()
             return {"models": data.get("models", [])}
         except requests.exceptions.RequestException as e:
             print(f"Error listing models: {e}")
-            return {"models": []}
+            return {"models": [], "error": str(e)}
 
-# Initialize Ollama client
-ollama_client = OllamaClient()
+def tagged_model_name(model):
+    """Model name in the name:tag form /api/ps reports, e.g. llama2 -> llama2:latest"""
+    if model and ':' not in model.rsplit('/', 1)[-1]:
+        return f"{model}:latest"
+    return model
+
+class OllamaBackend:
+    """One Ollama host in the pool and its routing state"""
+    def __init__(self, base_url):
+        self.client = OllamaClient(base_url=base_url)
+        self.base_url = base_url
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        self.loaded_models = set()
+        self.last_checked = None
+        self.last_error = None
+    
+    def status(self):
+        return {
+            'url': self.base_url,
+            'healthy': self.healthy,
+            'outstanding': self.outstanding,
+            'failures': self.failures,
+            'loaded_models': sorted(self.loaded_models),
+            'last_checked': self.last_checked,
+            'last_error': self.last_error
+        }
+
+class OllamaBackendPool:
+    """Routes Ollama requests across several hosts with health checks"""
+    def __init__(self, base_urls=None, health_interval=OLLAMA_HEALTH_INTERVAL, eject_after=OLLAMA_EJECT_AFTER):
+        self.backends = [OllamaBackend(url) for url in (base_urls or OLLAMA_BASE_URLS)]
+        self.health_interval = health_interval
+        self.eject_after = eject_after
+        self._lock = threading.Lock()
+        self._health_thread = None
+    
+    @property
+    def base_url(self):
+        return self.backends[0].base_url
+    
+    def _select(self, model, exclude=()):
+        """Pick the least-loaded healthy host, preferring hosts that already have the model loaded"""
+        self.start_health_checks()
+        with self._lock:
+            candidates = [b for b in self.backends if b not in exclude]
+            if not candidates:
+                return None
+            # If every host looks down, still try them rather than failing outright
+            healthy = [b for b in candidates if b.healthy] or candidates
+            tagged = tagged_model_name(model)
+            backend = min(healthy, key=lambda b: (tagged not in b.loaded_models, b.outstanding))
+            backend.outstanding += 1
+            return backend
+    
+    def _release(self, backend, model=None, failed=False, error=None):
+        with self._lock:
+            backend.outstanding -= 1
+            if failed:
+                # Connection failures eject the host until a health probe succeeds
+                backend.healthy = False
+                backend.failures += 1
+                backend.last_error = error
+            elif model:
+                backend.loaded_models.add(tagged_model_name(model))
+    
+    def chat(self, model, messages, options=None, keep_alive=None, cancel_event=None):
+        """Send chat request to the best host, failing over on connection errors"""
+        tried = []
+        while True:
+            backend = self._select(model, exclude=tried)
+            if backend is None:
+                raise OllamaConnectionError(f"Cannot connect to Ollama. No reachable host among {', '.join(b.base_url for b in self.backends)}")
+            tried.append(backend)
+            try:
+                response = backend.client.chat(model, messages, options, keep_alive, cancel_event)
+            except OllamaConnectionError as e:
+                self._release(backend, failed=True, error=str(e))
+                print(f"Ollama host {backend.base_url} unreachable, trying next host")
+                continue
+            except Exception:
+                self._release(backend)
+                raise
+            self._release(backend, model)
+            return response
+    
+    def embed(self, model, inputs):
+        """Embed texts on the best host, failing over on connection errors"""
+        tried = []
+        while True:
+            backend = self._select(model, exclude=tried)
+            if backend is None:
+                raise OllamaConnectionError(f"Cannot connect to Ollama. No reachable host among {', '.join(b.base_url for b in self.backends)}")
+            tried.append(backend)
+            try:
+                embeddings = backend.client.embed(model, inputs)
+            except OllamaConnectionError as e:
+                self._release(backend, failed=True, error=str(e))
+                print(f"Ollama host {backend.base_url} unreachable, trying next host")
+                continue
+            except Exception:
+                self._release(backend)
+                raise
+            self._release(backend, model)
+            return embeddings
+    
+    def chat_stream(self, model, messages, options=None, keep_alive=None):
+        """Stream chat from the best host; fails over only before the first chunk"""
+        tried = []
+        while True:
+            backend = self._select(model, exclude=tried)
+            if backend is None:
+                raise OllamaConnectionError(f"Cannot connect to Ollama. No reachable host among {', '.join(b.base_url for b in self.backends)}")
+            tried.append(backend)
+            started = False
+            try:
+                for chunk in backend.client.chat_stream(model, messages, options, keep_alive):
+                    started = True
+                    yield chunk
+            except OllamaConnectionError as e:
+                self._release(backend, failed=True, error=str(e))
+                if started:
+                    raise
+                print(f"Ollama host {backend.base_url} unreachable, trying next host")
+                continue
+            except BaseException:
+                self._release(backend)
+                raise
+            self._release(backend, model)
+            return
+    
+    def list_models(self):
+        """List models available on any healthy host"""
+        models = {}
+        errors = []
+        with self._lock:
+            backends = [b for b in self.backends if b.healthy] or list(self.backends)
+        for backend in backends:
+            data = backend.client.list_models()
+            if data.get('error'):
+                errors.append(f"{backend.base_url}: {data['error']}")
+                continue
+            for model in data.get('models', []):
+                models.setdefault(model['name'], model)
+        if errors and not models:
+            return {"models": [], "error": "; ".join(errors)}
+        return {"models": list(models.values())}
+    
+    def show(self, model):
+        """Model details from the first healthy host that has the model"""
+        with self._lock:
+            backends = [b for b in self.backends if b.healthy] or list(self.backends)
+        error = None
+        for backend in backends:
+            try:
+                return backend.client.show(model)
+            except requests.exceptions.RequestException as e:
+                error = e
+        raise error
+    
+    def check_health(self):
+        """Probe every host's /api/ps and update health and loaded models"""
+        for backend in self.backends:
+            try:
+                loaded = backend.client.list_running_models()
+                with self._lock:
+                    backend.healthy = True
+                    backend.failures = 0
+                    backend.loaded_models = {tagged_model_name(name) for name in loaded if name}
+                    backend.last_error = None
+                    backend.last_checked = time.time()
+            except Exception as e:
+                with self._lock:
+                    backend.failures += 1
+                    backend.last_error = str(e)
+                    if backend.failures >= self.eject_after:
+                        backend.healthy = False
+                    backend.last_checked = time.time()
+    
+    def _run_health_checks(self):
+        while True:
+            try:
+                self.check_health()
+            except Exception as e:
+                print(f"Error checking Ollama hosts: {e}")
+            time.sleep(self.health_interval)
+    
+    def start_health_checks(self):
+        """Start the background health probe thread if it is not running"""
+        with self._lock:
+            if self._health_thread is None:
+                self._health_thread = threading.Thread(target=self._run_health_checks, name='ollama-health', daemon=True)
+                self._health_thread.start()
+    
+    def status(self):
+        with self._lock:
+            return [backend.status() for backend in self.backends]
+
+# Initialize Ollama client (a pool over one or more hosts)
+ollama_client = OllamaBackendPool()
+
+class ModelCatalog:
+    """In-memory Ollama model list kept fresh by a background thread"""
+    def __init__(self, client, interval=MODEL_CATALOG_REFRESH_INTERVAL):
+        self.client = client
+        self.interval = interval
+        self.last_error = None
+        self._models = []
+        self._fetched_at = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+    
+    def refresh(self):
+        """Fetch the model list now; keeps the previous list if Ollama is unreachable"""
+        data = self.client.list_models()
+        with self._lock:
+            if data.get('error'):
+                self.last_error = data['error']
+            else:
+                self._models = data.get('models', [])
+                self._fetched_at = time.time()
+                self.last_error = None
+            return list(self._models)
+    
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Error refreshing model catalog: {e}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+    
+    def start(self):
+        """Start the background refresh thread if it is not running"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='model-catalog', daemon=True)
+                self._thread.start()
+    
+    def invalidate(self):
+        """Ask the background thread to refresh immediately"""
+        self.start()
+        self._wake.set()
+    
+    def snapshot(self):
+        """Return (models, age in seconds or None) without touching the network"""
+        self.start()
+        with self._lock:
+            age = time.time() - self._fetched_at if self._fetched_at else None
+            return list(self._models), age
+
+# Model list served to the UI from memory
+model_catalog = ModelCatalog(ollama_client)
+
+class AsyncLoopRunner:
+    """Runs coroutines on one long-lived event loop in a background thread"""
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+    
+    def _ensure_loop(self):
+        """Start the background loop on first use"""
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever,
+                    name='async-loop-runner',
+                    daemon=True
+                )
+                self._thread.start()
+            return self._loop
+    
+    def submit(self, coro):
+        """Schedule a coroutine on the loop and return a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+    
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the loop and block the calling thread until it finishes"""
+        return self.submit(coro).result(timeout)
+    
+    def shutdown(self):
+        """Stop the background loop"""
+        with self._lock:
+            if self._loop is not None and not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join(timeout=5)
+                self._loop.close()
+            self._loop = None
+            self._thread = None
+
+# Shared event loop for async clients, so sync routes don't create a loop per request
+async_runner = AsyncLoopRunner()
 
 class ClaudeCodeClient:
     def __init__(self, api_key=None):
@@ -280,6 +883,25 @@ class ClaudeCodeClient:
             print(f"DEBUG: Claude Code exception: {str(e)}")
             raise Exception(f"Claude Code request failed: {str(e)}")
     
+    def chat_sync(self, messages, tools=None, timeout=None, cancel_event=None):
+        """Run chat on the shared background event loop from synchronous code"""
+        if cancel_event is None:
+            return async_runner.run(self.chat(messages, tools), timeout)
+        
+        future = async_runner.submit(self.chat(messages, tools))
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            try:
+                return future.result(0.5)
+            except concurrent.futures.TimeoutError:
+                if cancel_event.is_set():
+                    # Cancels the task on the loop, which stops the Claude Code session
+                    future.cancel()
+                    raise GenerationCancelled("Client disconnected")
+                if deadline and time.time() > deadline:
+                    future.cancel()
+                    raise
+    
     def _format_messages(self, messages):
         """Convert message history to a single prompt for Claude Code"""
         if not messages:
@@ -297,47 +919,972 @@ class ClaudeCodeClient:
 # Initialize Claude Code client
 claude_code_client = ClaudeCodeClient()
 
+class ResponseCache:
+    """SQLite-backed cache of chat completions with TTL and LRU eviction"""
+    def __init__(self, database=RESPONSE_CACHE_DATABASE, enabled=RESPONSE_CACHE_ENABLED,
+                 ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.database = database
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._initialized = False
+    
+    def _connect(self):
+        conn = sqlite3.connect(self.database)
+        conn.row_factory = sqlite3.Row
+        if not self._initialized:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_accessed REAL NOT NULL,
+                    hit_count INTEGER DEFAULT 0
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_response_cache_lru ON response_cache (last_accessed)')
+            conn.commit()
+            self._initialized = True
+        return conn
+    
+    @staticmethod
+    def make_key(model, messages, options=None):
+        """Hash the model, final message list and generation options"""
+        raw = json.dumps({'model': model, 'messages': messages, 'options': options or {}}, sort_keys=True)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        """Return the cached response for key, or None on a miss"""
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                row = conn.execute('SELECT response, created_at FROM response_cache WHERE key = ?', (key,)).fetchone()
+                if row and now - row['created_at'] > self.ttl:
+                    conn.execute('DELETE FROM response_cache WHERE key = ?', (key,))
+                    row = None
+                if row:
+                    conn.execute(
+                        'UPDATE response_cache SET last_accessed = ?, hit_count = hit_count + 1 WHERE key = ?',
+                        (now, key)
+                    )
+                conn.commit()
+        except Exception as e:
+            print(f"Error reading response cache: {e}")
+            row = None
+        
+        with self._lock:
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return json.loads(row['response']) if row else None
+    
+    def set(self, key, model, response):
+        """Store a response and evict the least recently used entries over the cap"""
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    '''INSERT OR REPLACE INTO response_cache (key, model, response, created_at, last_accessed)
+                       VALUES (?, ?, ?, ?, ?)''',
+                    (key, model, json.dumps(response), now, now)
+                )
+                conn.execute('DELETE FROM response_cache WHERE created_at < ?', (now - self.ttl,))
+                conn.execute(
+                    '''DELETE FROM response_cache WHERE key IN (
+                           SELECT key FROM response_cache ORDER BY last_accessed DESC LIMIT -1 OFFSET ?
+                       )''',
+                    (self.max_entries,)
+                )
+                conn.commit()
+        except Exception as e:
+            print(f"Error writing response cache: {e}")
+    
+    def clear(self):
+        """Remove every cached response and reset the counters"""
+        with self._connect() as conn:
+            conn.execute('DELETE FROM response_cache')
+            conn.commit()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+    
+    def stats(self):
+        """Return hit/miss counters and current cache size"""
+        try:
+            with self._connect() as conn:
+                entries = conn.execute('SELECT COUNT(*) FROM response_cache').fetchone()[0]
+        except Exception as e:
+            print(f"Error reading response cache stats: {e}")
+            entries = 0
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            'enabled': self.enabled,
+            'entries': entries,
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / total, 3) if total else 0.0
+        }
+
+# Initialize response cache
+response_cache = ResponseCache()
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one upstream call"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+    
+    def do(self, key, fn, cancel_event=None):
+        """Run fn once per in-flight key; concurrent callers share its result or exception
+        
+        A waiting caller whose cancel_event is set stops waiting with
+        GenerationCancelled; the shared call keeps running for the others.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = {'event': threading.Event(), 'result': None, 'error': None}
+                self._calls[key] = call
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        
+        if not leader:
+            while not call['event'].wait(0.25):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise GenerationCancelled("Client disconnected while waiting for a shared generation")
+            if isinstance(call['error'], GenerationCancelled):
+                # The leader's client left; run the call for this caller instead
+                return self.do(key, fn, cancel_event)
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+        
+        try:
+            call['result'] = fn()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call['event'].set()
+    
+    def in_flight(self):
+        """Number of distinct calls currently running"""
+        with self._lock:
+            return len(self._calls)
+
+# Shared by all chat routes so duplicate generations run once
+chat_single_flight = SingleFlight()
+
+class SharedStream:
+    """Chunks of one upstream chat stream, replayed to every subscriber from the start"""
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self._cond = threading.Condition()
+    
+    def publish(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+    
+    def finish(self, error=None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._cond.notify_all()
+    
+    def subscribe(self):
+        with self._cond:
+            self.subscribers += 1
+        return StreamSubscription(self)
+    
+    def _unsubscribe(self):
+        with self._cond:
+            self.subscribers -= 1
+
+class StreamSubscription:
+    """One request's view of a SharedStream; close is idempotent"""
+    def __init__(self, shared):
+        self.shared = shared
+        self._closed = False
+    
+    def chunks(self, cancel_event=None, poll_interval=0.5):
+        """Yield every chunk in order; raises the upstream error, or GenerationCancelled"""
+        shared = self.shared
+        index = 0
+        try:
+            while True:
+                with shared._cond:
+                    while index >= len(shared.chunks) and not shared.done:
+                        if cancel_event is not None and cancel_event.is_set():
+                            raise GenerationCancelled("Client disconnected")
+                        shared._cond.wait(poll_interval)
+                    pending = shared.chunks[index:]
+                    index += len(pending)
+                    finished, error = shared.done, shared.error
+                for chunk in pending:
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise GenerationCancelled("Client disconnected")
+                    yield chunk
+                if finished:
+                    if error is not None:
+                        raise error
+                    return
+        finally:
+            self.close()
+    
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.shared._unsubscribe()
+
+class StreamFlight:
+    """Shares one upstream Ollama stream between identical concurrent stream requests
+    
+    The stream is read by a background thread, so it keeps going for the
+    other subscribers when the request that started it disconnects; it is
+    closed once nobody is subscribed.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._streams = {}
+        self.coalesced = 0
+    
+    def join(self, key):
+        """Return (shared stream, subscription, leader); the leader must start or abandon the stream"""
+        with self._lock:
+            shared = self._streams.get(key)
+            leader = shared is None
+            if leader:
+                shared = SharedStream()
+                self._streams[key] = shared
+            else:
+                self.coalesced += 1
+            return shared, shared.subscribe(), leader
+    
+    def start(self, key, shared, open_stream, slot=None, on_complete=None):
+        """Read open_stream() into shared on a background thread, then release slot"""
+        threading.Thread(
+            target=self._produce, args=(key, shared, open_stream, slot, on_complete),
+            name='shared-stream', daemon=True
+        ).start()
+    
+    def abandon(self, key, shared, error):
+        """The leader could not start the stream; subscribers get its error"""
+        if isinstance(error, GenerationCancelled):
+            # Only the leader's client left; the others should not look cancelled
+            error = Exception("The identical request this one was sharing was cancelled. Please retry.")
+        self._forget(key, shared)
+        shared.finish(error)
+    
+    def _forget(self, key, shared):
+        with self._lock:
+            if self._streams.get(key) is shared:
+                del self._streams[key]
+    
+    def _produce(self, key, shared, open_stream, slot, on_complete):
+        stream = None
+        error = None
+        try:
+            stream = open_stream()
+            for chunk in stream:
+                if shared.subscribers <= 0:
+                    # Closing the upstream stream (below) makes Ollama stop generating
+                    raise GenerationCancelled("All clients disconnected")
+                shared.publish(chunk)
+            if on_complete:
+                on_complete(shared.chunks)
+        except Exception as e:
+            error = e
+        finally:
+            # Requests arriving from now on start a fresh generation
+            self._forget(key, shared)
+            if stream is not None:
+                stream.close()
+            if slot:
+                slot.release()
+            shared.finish(error)
+    
+    def in_flight(self):
+        with self._lock:
+            return len(self._streams)
+
+chat_stream_flight = StreamFlight()
+
+class QueueFullError(Exception):
+    """Raised when a model's generation queue cannot take another request"""
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class GenerationSlot:
+    """A held generation slot; release is idempotent"""
+    def __init__(self, scheduler, model):
+        self.scheduler = scheduler
+        self.model = model
+        self.acquired_at = time.time()
+        self._released = False
+    
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.scheduler._release(self.model, time.time() - self.acquired_at)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+class GenerationScheduler:
+    """Per-model concurrency limits with a round-robin queue across sessions"""
+    def __init__(self, default_limit=MODEL_CONCURRENCY, model_limits=None,
+                 max_queue=SCHEDULER_MAX_QUEUE, queue_timeout=SCHEDULER_QUEUE_TIMEOUT):
+        self.default_limit = default_limit
+        self.model_limits = dict(MODEL_CONCURRENCY_LIMITS if model_limits is None else model_limits)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._models = {}
+    
+    def get_limit(self, model):
+        return max(1, self.model_limits.get(model, self.default_limit))
+    
+    def _state(self, model):
+        state = self._models.get(model)
+        if state is None:
+            state = {
+                'active': 0,
+                'waiting': OrderedDict(),  # session_id -> deque of waiters, served round-robin
+                'queued': 0,
+                'avg_duration': None,  # seeded by the first finished generation
+                'completed': 0,
+                'rejected': 0
+            }
+            self._models[model] = state
+        return state
+    
+    def _retry_after(self, model, state):
+        """Estimate seconds until a queued request would be served"""
+        if state['avg_duration'] is None:
+            # No generation has finished yet, so there is nothing to estimate from
+            return 1
+        per_slot = state['avg_duration'] * (state['queued'] + 1) / self.get_limit(model)
+        return max(1, int(round(per_slot)))
+    
+    def acquire(self, model, session_id=None, timeout=None, cancel_event=None):
+        """Wait for a generation slot for model; raises QueueFullError when the queue is full"""
+        timeout = self.queue_timeout if timeout is None else timeout
+        with self._lock:
+            state = self._state(model)
+            if state['active'] < self.get_limit(model) and state['queued'] == 0:
+                state['active'] += 1
+                return GenerationSlot(self, model)
+            
+            if state['queued'] >= self.max_queue:
+                state['rejected'] += 1
+                raise QueueFullError(
+                    f"Too many requests queued for {model}. Please try again shortly.",
+                    self._retry_after(model, state)
+                )
+            
+            waiter = {'event': threading.Event(), 'granted': False}
+            state['waiting'].setdefault(session_id, deque()).append(waiter)
+            state['queued'] += 1
+        
+        deadline = time.time() + timeout
+        while not waiter['event'].wait(min(0.25, max(deadline - time.time(), 0))):
+            if time.time() >= deadline or (cancel_event is not None and cancel_event.is_set()):
+                break
+        
+        with self._lock:
+            if waiter['granted']:
+                return GenerationSlot(self, model)
+            self._remove_waiter(state, session_id, waiter)
+            if cancel_event is not None and cancel_event.is_set():
+                # The client left while queued; free its place
+                raise GenerationCancelled("Client disconnected while queued")
+            # Timed out: leave the queue
+            state['rejected'] += 1
+            raise QueueFullError(
+                f"Timed out waiting for {model} after {int(timeout)}s. Please try again shortly.",
+                self._retry_after(model, state)
+            )
+    
+    def _remove_waiter(self, state, session_id, waiter):
+        waiters = state['waiting'].get(session_id)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            state['queued'] -= 1
+            if not waiters:
+                del state['waiting'][session_id]
+    
+    def _release(self, model, duration):
+        with self._lock:
+            state = self._state(model)
+            state['completed'] += 1
+            if state['avg_duration'] is None:
+                state['avg_duration'] = duration
+            else:
+                state['avg_duration'] = 0.8 * state['avg_duration'] + 0.2 * duration
+            
+            if state['waiting']:
+                # Hand the slot to the next session in turn
+                session_id, waiters = next(iter(state['waiting'].items()))
+                waiter = waiters.popleft()
+                state['queued'] -= 1
+                if waiters:
+                    state['waiting'].move_to_end(session_id)
+                else:
+                    del state['waiting'][session_id]
+                waiter['granted'] = True
+                waiter['event'].set()
+            else:
+                state['active'] -= 1
+    
+    def stats(self):
+        """Active, queued and limit counts per model"""
+        with self._lock:
+            return {
+                model: {
+                    'active': state['active'],
+                    'queued': state['queued'],
+                    'queued_sessions': len(state['waiting']),
+                    'limit': self.get_limit(model),
+                    'max_queue': self.max_queue,
+                    'avg_duration': round(state['avg_duration'], 2) if state['avg_duration'] is not None else None,
+                    'completed': state['completed'],
+                    'rejected': state['rejected']
+                }
+                for model, state in self._models.items()
+            }
+
+# Admission control in front of every model generation
+generation_scheduler = GenerationScheduler()
+
+class DisconnectWatcher:
+    """Sets .cancelled when the HTTP client of a request closes its connection"""
+    def __init__(self, environ, interval=0.5):
+        # Only servers that expose the client socket can be watched
+        self.sock = environ.get('werkzeug.socket') or environ.get('gunicorn.socket')
+        self.interval = interval
+        self.cancelled = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+    
+    def start(self):
+        if self.sock is not None and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='disconnect-watcher', daemon=True)
+            self._thread.start()
+        return self
+    
+    def stop(self):
+        self._stopped.set()
+    
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                readable, _, _ = select.select([self.sock], [], [], self.interval)
+                if readable and not self._stopped.is_set():
+                    # A readable socket with no data means the peer closed it
+                    if self.sock.recv(1, socket.MSG_PEEK) == b'':
+                        print("Client disconnected, cancelling generation")
+                        self.cancelled.set()
+                    # Otherwise the client sent more data; we can't tell, so stop watching
+                    return
+            except (OSError, ValueError):
+                if not self._stopped.is_set():
+                    self.cancelled.set()
+                return
+    
+    def __enter__(self):
+        return self.start()
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+def detect_text_encoding(prefix, complete=False):
+    """Pick an encoding from a file prefix; complete says the prefix is the whole file"""
+    if prefix.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if prefix.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    for encoding in ('utf-8', 'cp1252'):
+        try:
+            # Incremental decoding tolerates a character cut off at the end of the prefix
+            codecs.getincrementaldecoder(encoding)().decode(prefix, final=complete)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    # latin-1 decodes any byte sequence
+    return 'latin-1'
+
+def detect_file_encoding(file_path, sniff_bytes=TEXT_SNIFF_BYTES):
+    """Detect a file's encoding from its first sniff_bytes bytes"""
+    with open(file_path, 'rb') as f:
+        prefix = f.read(sniff_bytes)
+        return detect_text_encoding(prefix, complete=not f.read(1))
+
+def excerpt_ranges(length, budget, mode=TEXT_EXCERPT_MODE, sample_windows=8):
+    """(start, end) ranges to keep so length fits budget, leaving room for omission notes"""
+    if length <= budget:
+        return [(0, length)]
+    if mode == 'sample':
+        notes = sample_windows
+    else:
+        notes = 1
+    usable = max(budget - 48 * notes, 0)
+    
+    if mode == 'head_tail':
+        head = usable * 2 // 3
+        return [(0, head), (length - (usable - head), length)]
+    if mode == 'sample':
+        # Evenly spaced windows from the start to the end of the text
+        window = usable // sample_windows
+        step = (length - window) / (sample_windows - 1)
+        return [(int(i * step), int(i * step) + window) for i in range(sample_windows)]
+    return [(0, usable)]
+
+def join_excerpts(chunks, ranges, length, unit='characters'):
+    """Join excerpt chunks with notes about what was left out"""
+    parts = []
+    position = 0
+    for (start, end), chunk in zip(ranges, chunks):
+        if start > position:
+            parts.append(f"\n... [{start - position} {unit} omitted] ...\n")
+        parts.append(chunk)
+        position = end
+    if position < length:
+        parts.append(f"\n... [truncated {length - position} {unit}]")
+    return "".join(parts)
+
+def excerpt_text(text, max_chars, mode=TEXT_EXCERPT_MODE):
+    """Cut text to max_chars, keeping its head, head and tail, or evenly spaced samples"""
+    if len(text) <= max_chars:
+        return text
+    ranges = excerpt_ranges(len(text), max_chars, mode)
+    return join_excerpts([text[start:end] for start, end in ranges], ranges, len(text))
+
+class ColumnProfile:
+    """Running statistics for one column, in memory bounded by the caps below"""
+    NULL_TOKENS = {'', 'null', 'none', 'nan', 'n/a', 'na', '-'}
+    BOOLEAN_TOKENS = {'true', 'false', 'yes', 'no'}
+    DATE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2})?)?')
+    MAX_DISTINCT = 10000  # Distinct values tracked for top-k
+    RESERVOIR_SIZE = 10000  # Numbers sampled for quantiles
+    
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.nulls = 0
+        self.type_counts = {}
+        self.values = {}
+        self.distinct_overflow = False
+        self.numbers = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.reservoir = []
+        self.first_date = None
+        self.last_date = None
+        # Fixed seed keeps profiles of the same file identical between runs
+        self.random = random.Random(0)
+    
+    @classmethod
+    def classify(cls, value):
+        """Return (type, parsed value); type is None for nulls"""
+        if value is None:
+            return None, None
+        if isinstance(value, bool):
+            return 'boolean', value
+        if isinstance(value, int):
+            return 'integer', value
+        if isinstance(value, float):
+            return (None, None) if value != value else ('float', value)
+        if hasattr(value, 'isoformat'):
+            return 'date', value.isoformat()
+        
+        text = str(value).strip()
+        lowered = text.lower()
+        if lowered in cls.NULL_TOKENS:
+            return None, None
+        # Only attempt number parsing when the text could be a number
+        if text[0] in '0123456789+-.':
+            try:
+                return 'integer', int(text)
+            except ValueError:
+                pass
+            try:
+                number = float(text)
+                if number == number and number not in (float('inf'), float('-inf')):
+                    return 'float', number
+            except ValueError:
+                pass
+        if lowered in cls.BOOLEAN_TOKENS:
+            return 'boolean', lowered
+        if cls.DATE_PATTERN.match(text):
+            return 'date', text
+        return 'text', text
+    
+    def update(self, values):
+        """Fold one chunk of column values into the statistics"""
+        type_counts = self.type_counts
+        counts = self.values
+        classify = self.classify
+        for value in values:
+            self.count += 1
+            kind, parsed = classify(value)
+            if kind is None:
+                self.nulls += 1
+                continue
+            type_counts[kind] = type_counts.get(kind, 0) + 1
+            
+            if kind in ('integer', 'float'):
+                self._add_number(parsed)
+            elif kind == 'date':
+                if self.first_date is None or parsed < self.first_date:
+                    self.first_date = parsed
+                if self.last_date is None or parsed > self.last_date:
+                    self.last_date = parsed
+            
+            key = str(parsed)[:60]
+            if key in counts:
+                counts[key] += 1
+            elif len(counts) < self.MAX_DISTINCT:
+                counts[key] = 1
+            else:
+                self.distinct_overflow = True
+    
+    def _add_number(self, number):
+        self.numbers += 1
+        self.total += number
+        if self.minimum is None or number < self.minimum:
+            self.minimum = number
+        if self.maximum is None or number > self.maximum:
+            self.maximum = number
+        # Reservoir sampling keeps quantiles bounded in memory
+        if len(self.reservoir) < self.RESERVOIR_SIZE:
+            self.reservoir.append(number)
+        else:
+            slot = self.random.randrange(self.numbers)
+            if slot < self.RESERVOIR_SIZE:
+                self.reservoir[slot] = number
+    
+    def column_type(self):
+        if not self.type_counts:
+            return 'empty'
+        ranked = sorted(self.type_counts.items(), key=lambda item: item[1], reverse=True)
+        kinds = {kind for kind, _ in ranked}
+        if kinds == {'integer', 'float'}:
+            return 'float'
+        non_null = self.count - self.nulls
+        # A minority type above 5% of the values makes the column mixed
+        minor = [kind for kind, count in ranked[1:] if count > non_null * 0.05]
+        return f"mixed ({', '.join([ranked[0][0]] + minor)})" if minor else ranked[0][0]
+    
+    def describe(self, top_k=PROFILE_TOP_K):
+        """One markdown bullet summarizing the column"""
+        column_type = self.column_type()
+        parts = [f"{self.nulls:,} nulls"]
+        distinct = f"{len(self.values):,}{'+' if self.distinct_overflow else ''}"
+        parts.append(f"{distinct} distinct")
+        
+        if self.numbers:
+            quantiles = sorted(self.reservoir)
+            pick = lambda q: quantiles[min(int(q * len(quantiles)), len(quantiles) - 1)]
+            parts.append(
+                f"min {format_stat(self.minimum)}, max {format_stat(self.maximum)}, "
+                f"mean {format_stat(self.total / self.numbers)}"
+            )
+            parts.append(
+                f"p25 {format_stat(pick(0.25))}, median {format_stat(pick(0.5))}, p75 {format_stat(pick(0.75))}"
+            )
+        if self.first_date is not None:
+            parts.append(f"from {self.first_date} to {self.last_date}")
+        
+        # Top values only help when values repeat; floats are covered by the quantiles
+        top = sorted(self.values.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        if top and top[0][1] > 1 and column_type != 'float':
+            parts.append("top: " + ", ".join(f"{value} ({count:,})" for value, count in top))
+        
+        return f"- `{self.name}` ({column_type}): " + "; ".join(parts)
+
+def format_stat(number):
+    """Format a statistic compactly"""
+    if isinstance(number, int) or float(number).is_integer():
+        return f"{int(number):,}"
+    return f"{number:,.6g}"
+
+class DataProfiler:
+    """Summarizes tabular data as per-column statistics plus a few sample rows
+    
+    Rows are consumed in chunks of chunk_rows, so memory and output size
+    stay flat no matter how large the file is.
+    """
+    def __init__(self, chunk_rows=PROFILE_CHUNK_ROWS, max_columns=PROFILE_MAX_COLUMNS,
+                 sample_rows=PROFILE_SAMPLE_ROWS):
+        self.chunk_rows = max(1, chunk_rows)
+        self.max_columns = max_columns
+        self.sample_rows = sample_rows
+    
+    def profile(self, title, rows, header=None, has_header=None):
+        """Profile an iterable of row sequences
+        
+        header gives the column names when the caller already knows them.
+        Otherwise has_header says whether the first row is a header; when it
+        is None the first row is taken as a header if it holds only text.
+        """
+        rows = iter(rows)
+        if header is None:
+            first_row = next(rows, None)
+            if first_row is None:
+                return f"**{title}**\nNo rows found\n"
+            
+            first_row = list(first_row)
+            if has_header is None:
+                # A first row made only of non-numeric labels is taken as the header
+                has_header = bool(first_row) and all(
+                    isinstance(value, str) and ColumnProfile.classify(value)[0] == 'text'
+                    for value in first_row)
+            if has_header:
+                header = [str(value if value is not None else '').strip() for value in first_row]
+            else:
+                header = [f"Column {i + 1}" for i in range(len(first_row))]
+                rows = itertools.chain([first_row], rows)
+        else:
+            header = [str(name) for name in header]
+        
+        columns = [ColumnProfile(name) for name in header[:self.max_columns]]
+        width = len(header)
+        row_count = 0
+        samples = []
+        
+        while True:
+            chunk = list(itertools.islice(rows, self.chunk_rows))
+            if not chunk:
+                break
+            row_count += len(chunk)
+            if len(samples) < self.sample_rows:
+                samples.extend(chunk[:self.sample_rows - len(samples)])
+            width = max(width, max(len(row) for row in chunk))
+            
+            # Transpose the chunk so each column is updated in bulk
+            for column, values in zip(columns, itertools.zip_longest(*chunk)):
+                column.update(values)
+        
+        # Columns that never appear in a chunk still get their nulls counted
+        for column in columns:
+            column.nulls += row_count - column.count
+            column.count = row_count
+        
+        lines = [f"**{title}**\n", f"Rows: {row_count:,} | Columns: {width:,}\n\n", "Columns:\n"]
+        lines.extend(column.describe() + "\n" for column in columns)
+        if width > len(columns):
+            lines.append(f"- ... and {width - len(columns)} more columns not profiled\n")
+        
+        if samples:
+            shown = len(columns) or width
+            lines.append(f"\nSample rows (first {len(samples)}):\n")
+            lines.append(f"| {' | '.join(header[:shown])} |\n")
+            for row in samples:
+                cells = [("" if value is None else str(value))[:40] for value in list(row)[:shown]]
+                lines.append(f"| {' | '.join(cells)} |\n")
+        return "".join(lines)
+
+class PdfTextCollector:
+    """Collects PDF page text in order until the page or character budget runs out"""
+    def __init__(self, total_pages, max_pages=PDF_MAX_PAGES, max_chars=PDF_MAX_CHARS):
+        self.total_pages = total_pages
+        self.page_limit = min(total_pages, max_pages) if max_pages else total_pages
+        self.max_chars = max_chars
+        self.parts = []
+        self.chars = 0
+        self.pages_read = 0
+        self.budget_hit = False
+        self.time_limit_hit = False
+    
+    def add(self, text):
+        """Add the next page; returns False once no more pages are wanted"""
+        if self.max_chars and self.chars + len(text) > self.max_chars:
+            text = text[:max(self.max_chars - self.chars, 0)]
+            self.budget_hit = True
+        self.parts.append(text)
+        self.chars += len(text) + 1
+        self.pages_read += 1
+        return not self.budget_hit and self.pages_read < self.page_limit
+    
+    def result(self):
+        text = "\n".join(self.parts).strip()
+        if not text:
+            return "PDF processed but no text could be extracted"
+        if self.budget_hit or self.pages_read < self.total_pages:
+            if self.time_limit_hit:
+                reason = "time limit reached"
+            else:
+                reason = "character budget reached" if self.budget_hit else "page budget reached"
+            text += f"\n\n... (stopped after {self.pages_read} of {self.total_pages} pages: {reason})"
+        return text
+
 class FileProcessor:
+    # Bump when extraction output changes so cached results are recomputed
+    VERSION = 5
+    
     def __init__(self):
         pass
     
-    def process_file(self, file_path, filename, mime_type):
-        """Process uploaded file and extract content"""
+    def process_file(self, file_path, filename, mime_type, progress=None):
+        """Process uploaded file and extract content
+        
+        progress, if given, is called as progress(done, total) while pages,
+        sheets or slides are extracted.
+        """
         try:
-            if mime_type.startswith('text/') or filename.endswith(('.txt', '.md', '.py', '.js', '.html', '.css', '.json', '.xml', '.csv')):
+            if DATA_PROFILE_ENABLED and filename.endswith(('.csv', '.json')):
+                return self._process_structured_data(file_path, filename)
+            elif mime_type.startswith('text/') or filename.endswith(('.txt', '.md', '.py', '.js', '.html', '.css', '.json', '.xml', '.csv')):
                 return self._process_text_file(file_path)
             elif mime_type == 'application/pdf' and PDF_AVAILABLE:
-                return self._process_pdf(file_path)
+                return self._process_pdf(file_path, progress)
             elif mime_type.startswith('image/') and IMAGE_AVAILABLE:
                 return self._process_image(file_path, filename)
-            elif filename.endswith('.docx') and DOCX_AVAILABLE:
+            elif filename.endswith('.docx') and (DOCX_AVAILABLE or OFFICE_FAST_PATH):
                 return self._process_word_document(file_path, filename)
             elif filename.endswith(('.xlsx', '.xls')) and EXCEL_AVAILABLE:
-                return self._process_excel_file(file_path, filename)
-            elif filename.endswith('.pptx') and PPTX_AVAILABLE:
-                return self._process_powerpoint(file_path, filename)
+                return self._process_excel_file(file_path, filename, progress)
+            elif filename.endswith('.pptx') and (PPTX_AVAILABLE or OFFICE_FAST_PATH):
+                return self._process_powerpoint(file_path, filename, progress)
             else:
                 return f"File uploaded: {filename} (content extraction not supported for this file type)"
+        except MemoryError:
+            return "Error processing file: out of memory"
         except Exception as e:
             return f"Error processing file: {str(e)}"
     
     def _process_text_file(self, file_path):
-        """Extract text from text files"""
-        encodings = ['utf-8', 'latin-1', 'cp1252', 'iso-8859-1']
+        """Extract text from text files, excerpting files over TEXT_MAX_CHARS"""
+        try:
+            size = os.path.getsize(file_path)
+            encoding = detect_file_encoding(file_path)
+            
+            # A character takes at least one byte, so files within the budget in bytes are read whole
+            if not TEXT_MAX_CHARS or size <= TEXT_MAX_CHARS:
+                with open(file_path, 'r', encoding=encoding, errors='replace') as f:
+                    return f.read()
+            
+            # Larger files: decode only the excerpts, straight from a memory map
+            ranges = excerpt_ranges(size, TEXT_MAX_CHARS, TEXT_EXCERPT_MODE)
+            if encoding == 'utf-16':
+                ranges = [(start - start % 2, end - end % 2) for start, end in ranges]
+            with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                chunks = [mapped[start:end].decode(encoding, errors='replace').strip('\ufeff\ufffd')
+                          for start, end in ranges]
+            return join_excerpts(chunks, ranges, size, unit='bytes')
+        except Exception as e:
+            return f"Error reading file: {str(e)}"
+    
+    def _process_structured_data(self, file_path, filename):
+        """Profile CSV and JSON data instead of passing every row to the model"""
+        profiler = DataProfiler()
+        
+        if filename.endswith('.csv'):
+            with open(file_path, 'r', encoding=detect_file_encoding(file_path), errors='replace', newline='') as f:
+                sample = f.read(64 * 1024)
+                sniffer = csv.Sniffer()
+                try:
+                    dialect = sniffer.sniff(sample, delimiters=',;\t|')
+                except csv.Error:
+                    dialect = csv.excel
+                has_header = self._csv_has_header(sniffer, sample, dialect) or None
+                f.seek(0)
+                return f"Data profile: {filename}\n" + "=" * 50 + "\n" + profiler.profile(
+                    "Table", csv.reader(f, dialect), has_header=has_header)
         
-        for encoding in encodings:
-            try:
-                with open(file_path, 'r', encoding=encoding) as f:
-                    content = f.read()
-                return content
-            except UnicodeDecodeError:
-                continue
-            except Exception as e:
-                return f"Error reading file: {str(e)}"
+        try:
+            with open(file_path, 'r', encoding=detect_file_encoding(file_path), errors='replace') as f:
+                data = json.load(f)
+        except ValueError:
+            # NDJSON or malformed JSON: send it to the model as plain text
+            return self._process_text_file(file_path)
+        
+        records, path = self._find_json_records(data)
+        if records is None:
+            # Not tabular: keep the document as text
+            return self._process_text_file(file_path)
+        
+        if all(isinstance(record, dict) for record in records):
+            header = list(dict.fromkeys(key for record in records for key in record))
+            rows = ([self._json_cell(record.get(key)) for key in header] for record in records)
+        elif all(isinstance(record, list) for record in records):
+            header = None
+            rows = ([self._json_cell(value) for value in record] for record in records)
+        else:
+            header = ["value"]
+            rows = ([self._json_cell(record)] for record in records)
+        
+        title = f"Records at `{path}`" if path else "Records"
+        return f"Data profile: {filename}\n" + "=" * 50 + "\n" + profiler.profile(title, rows, header=header)
+    
+    def _csv_has_header(self, sniffer, sample, dialect):
+        """Whether the sample starts with a header row, including numeric labels like years
         
-        return "Error: Could not decode file with any supported encoding"
+        A text cell above a column whose sampled values are all numbers marks a
+        header even when the sniffer is outvoted by numeric labels beside it.
+        """
+        try:
+            if sniffer.has_header(sample):
+                return True
+        except csv.Error:
+            pass
+        
+        rows = list(itertools.islice(csv.reader(sample.splitlines(), dialect), 21))
+        if not sample.endswith(('\n', '\r')):
+            # The sample may stop mid-row
+            rows = rows[:-1]
+        if len(rows) < 2:
+            return False
+        for index, label in enumerate(rows[0]):
+            values = [row[index] for row in rows[1:] if index < len(row) and row[index].strip()]
+            if (values and ColumnProfile.classify(label)[0] == 'text'
+                    and all(ColumnProfile.classify(value)[0] in ('integer', 'float') for value in values)):
+                return True
+        return False
+    
+    def _find_json_records(self, data):
+        """Find the list of records in a JSON document; returns (records, key path)"""
+        if isinstance(data, list) and data:
+            return data, ''
+        if isinstance(data, dict):
+            for key, value in data.items():
+                if isinstance(value, list) and value and isinstance(value[0], (dict, list)):
+                    return value, key
+        return None, None
+    
+    def _json_cell(self, value):
+        """Nested JSON values are profiled as compact text"""
+        if isinstance(value, (dict, list)):
+            return json.dumps(value, separators=(',', ':'))
+        return value
     
-    def _process_pdf(self, file_path):
+    def _process_pdf(self, file_path, progress=None):
         """Extract text from PDF files"""
         if not PDF_AVAILABLE:
             return "PDF processing not available (pypdf/PyPDF2 not installed)"
@@ -345,13 +1892,33 @@ class FileProcessor:
         try:
             with open(file_path, 'rb') as f:
                 pdf_reader = PyPDF2.PdfReader(f)
-                text = ""
-                for page in pdf_reader.pages:
-                    text += page.extract_text() + "\n"
-                return text.strip() if text.strip() else "PDF processed but no text could be extracted"
+                collector = PdfTextCollector(len(pdf_reader.pages))
+                for page_index in range(collector.page_limit):
+                    wants_more = collector.add(pdf_reader.pages[page_index].extract_text() or "")
+                    if progress:
+                        progress(page_index + 1, collector.page_limit)
+                    if not wants_more:
+                        break
+                return collector.result()
         except Exception as e:
             return f"Error reading PDF: {str(e)}"
     
+    def pdf_page_count(self, file_path, progress=None):
+        """Number of pages in a PDF"""
+        with open(file_path, 'rb') as f:
+            return len(PyPDF2.PdfReader(f).pages)
+    
+    def extract_pdf_pages(self, file_path, start, end, progress=None):
+        """Extract the text of pages [start, end) as a list of strings"""
+        with open(file_path, 'rb') as f:
+            pdf_reader = PyPDF2.PdfReader(f)
+            texts = []
+            for page_index in range(start, min(end, len(pdf_reader.pages))):
+                texts.append(pdf_reader.pages[page_index].extract_text() or "")
+                if progress:
+                    progress(len(texts), end - start)
+            return texts
+    
     def _process_image(self, file_path, filename):
         """Process image files"""
         if not IMAGE_AVAILABLE:
@@ -363,12 +1930,21 @@ class FileProcessor:
                 format_name = img.format
                 mode = img.mode
                 
-                return f"Image file: {filename}\nDimensions: {width}x{height}\nFormat: {format_name}\nMode: {mode}\n\nNote: For image analysis, please use a vision-capable model like llava."
+                return f"Image file: {filename}\nDimensions: {width}x{height}\nFormat: {format_name}\nMode: {mode}\n\nNote: Vision-capable models (such as llava) are sent the image itself."
         except Exception as e:
             return f"Error processing image: {str(e)}"
     
     def _process_word_document(self, file_path, filename):
         """Extract text and formatting from Word documents"""
+        if OFFICE_FAST_PATH:
+            try:
+                return office_xml_extractor.word_document(file_path, filename)
+            except (FastPathUnsupported, KeyError, ElementTree.ParseError, zipfile.BadZipFile) as e:
+                print(f"Streaming extractor fell back to python-docx for {filename}: {e!r}")
+        return self._load_word_document(file_path, filename)
+    
+    def _load_word_document(self, file_path, filename):
+        """Extract a Word document through the python-docx object model"""
         if not DOCX_AVAILABLE:
             return "Word document processing not available (python-docx not installed)"
         
@@ -402,7 +1978,7 @@ class FileProcessor:
         except Exception as e:
             return f"Error reading Word document: {str(e)}"
     
-    def _process_excel_file(self, file_path, filename):
+    def _process_excel_file(self, file_path, filename, progress=None):
         """Extract data from Excel files"""
         if not EXCEL_AVAILABLE:
             return "Excel processing not available (openpyxl/xlrd not installed)"
@@ -413,63 +1989,87 @@ class FileProcessor:
             content.append("=" * 50 + "\n")
             
             if filename.endswith('.xlsx'):
-                # Use openpyxl for .xlsx files
-                workbook = openpyxl.load_workbook(file_path, data_only=True)
-                
-                for sheet_name in workbook.sheetnames:
-                    sheet = workbook[sheet_name]
-                    content.append(f"\n**Sheet: {sheet_name}**\n")
-                    
-                    # Get data from sheet (limit to prevent huge outputs)
-                    max_rows = min(sheet.max_row, 50)  # Limit to 50 rows
-                    max_cols = min(sheet.max_column, 20)  # Limit to 20 columns
-                    
-                    for row in range(1, max_rows + 1):
-                        row_data = []
-                        for col in range(1, max_cols + 1):
-                            cell_value = sheet.cell(row=row, column=col).value
-                            if cell_value is not None:
-                                row_data.append(str(cell_value))
-                            else:
-                                row_data.append("")
+                # Read-only mode streams rows from the zip instead of loading every cell
+                workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+                try:
+                    for sheet_number, sheet_name in enumerate(workbook.sheetnames, 1):
+                        sheet = workbook[sheet_name]
+                        if DATA_PROFILE_ENABLED:
+                            content.append("\n" + DataProfiler().profile(f"Sheet: {sheet_name}", sheet.iter_rows(values_only=True)))
+                            if progress:
+                                progress(sheet_number, len(workbook.sheetnames))
+                            continue
                         
-                        if any(cell.strip() for cell in row_data):  # Only add non-empty rows
-                            content.append(f"| {' | '.join(row_data)} |\n")
-                    
-                    if sheet.max_row > 50:
-                        content.append(f"\n... (showing first 50 of {sheet.max_row} rows)\n")
+                        content.append(f"\n**Sheet: {sheet_name}**\n")
+                        
+                        # One extra row tells whether the sheet goes on past the window
+                        rows = sheet.iter_rows(max_row=EXCEL_MAX_ROWS + 1, max_col=EXCEL_MAX_COLS, values_only=True)
+                        rows_read = self._append_sheet_rows(content, rows, EXCEL_MAX_ROWS)
+                        
+                        if rows_read > EXCEL_MAX_ROWS:
+                            total = f" of {sheet.max_row}" if sheet.max_row else ""
+                            content.append(f"\n... (showing first {EXCEL_MAX_ROWS}{total} rows)\n")
+                        
+                        if progress:
+                            progress(sheet_number, len(workbook.sheetnames))
+                finally:
+                    # Read-only workbooks keep the file open until closed
+                    workbook.close()
             
             else:
-                # Use xlrd for .xls files
-                workbook = xlrd.open_workbook(file_path)
-                
-                for sheet_index in range(workbook.nsheets):
-                    sheet = workbook.sheet_by_index(sheet_index)
-                    content.append(f"\n**Sheet: {sheet.name}**\n")
-                    
-                    # Limit rows and columns
-                    max_rows = min(sheet.nrows, 50)
-                    max_cols = min(sheet.ncols, 20)
-                    
-                    for row in range(max_rows):
-                        row_data = []
-                        for col in range(max_cols):
-                            cell_value = sheet.cell_value(row, col)
-                            row_data.append(str(cell_value) if cell_value else "")
+                # on_demand loads each .xls sheet only when it is read
+                workbook = xlrd.open_workbook(file_path, on_demand=True)
+                try:
+                    for sheet_index in range(workbook.nsheets):
+                        sheet = workbook.sheet_by_index(sheet_index)
+                        if DATA_PROFILE_ENABLED:
+                            rows = (sheet.row_values(row) for row in range(sheet.nrows))
+                            content.append("\n" + DataProfiler().profile(f"Sheet: {sheet.name}", rows))
+                        else:
+                            content.append(f"\n**Sheet: {sheet.name}**\n")
+                            
+                            max_cols = min(sheet.ncols, EXCEL_MAX_COLS)
+                            rows = (sheet.row_values(row, 0, max_cols) for row in range(min(sheet.nrows, EXCEL_MAX_ROWS)))
+                            self._append_sheet_rows(content, rows, EXCEL_MAX_ROWS)
+                            
+                            if sheet.nrows > EXCEL_MAX_ROWS:
+                                content.append(f"\n... (showing first {EXCEL_MAX_ROWS} of {sheet.nrows} rows)\n")
                         
-                        if any(cell.strip() for cell in row_data):
-                            content.append(f"| {' | '.join(row_data)} |\n")
-                    
-                    if sheet.nrows > 50:
-                        content.append(f"\n... (showing first 50 of {sheet.nrows} rows)\n")
+                        workbook.unload_sheet(sheet_index)
+                        if progress:
+                            progress(sheet_index + 1, workbook.nsheets)
+                finally:
+                    workbook.release_resources()
             
             return "".join(content) if content else "Excel file processed but no data could be extracted"
             
         except Exception as e:
             return f"Error reading Excel file: {str(e)}"
     
-    def _process_powerpoint(self, file_path, filename):
+    def _append_sheet_rows(self, content, rows, max_rows):
+        """Append non-empty rows as table lines; returns how many rows were read"""
+        rows_read = 0
+        for values in rows:
+            rows_read += 1
+            if rows_read > max_rows:
+                break
+            
+            row_data = [str(value) if value not in (None, '') else "" for value in values]
+            if any(cell.strip() for cell in row_data):  # Only add non-empty rows
+                content.append(f"| {' | '.join(row_data)} |\n")
+        return rows_read
+    
+    def _process_powerpoint(self, file_path, filename, progress=None):
         """Extract text from PowerPoint presentations"""
+        if OFFICE_FAST_PATH:
+            try:
+                return office_xml_extractor.powerpoint(file_path, filename, progress)
+            except (FastPathUnsupported, KeyError, ElementTree.ParseError, zipfile.BadZipFile) as e:
+                print(f"Streaming extractor fell back to python-pptx for {filename}: {e!r}")
+        return self._load_powerpoint(file_path, filename, progress)
+    
+    def _load_powerpoint(self, file_path, filename, progress=None):
+        """Extract a presentation through the python-pptx object model"""
         if not PPTX_AVAILABLE:
             return "PowerPoint processing not available (python-pptx not installed)"
         
@@ -497,12 +2097,204 @@ class FileProcessor:
                     content.append("- (No text content)\n")
                 
                 content.append("\n")
+                if progress:
+                    progress(i, len(prs.slides))
             
             return "".join(content) if content else "PowerPoint file processed but no content could be extracted"
             
         except Exception as e:
             return f"Error reading PowerPoint file: {str(e)}"
 
+class OfficeXmlExtractor:
+    """Streaming .docx/.pptx text extraction straight from the zip container
+    
+    Output matches the python-docx/python-pptx paths in FileProcessor. Parts
+    are read with iterparse and each paragraph, table or shape is dropped once
+    handled, so memory stays flat on long documents. Anything the fast path
+    does not model (merged or nested table cells, embedded documents) raises
+    FastPathUnsupported so the caller can use the object-model path.
+    """
+    WORD_UNSUPPORTED = {W_NS + 'gridSpan', W_NS + 'vMerge', W_NS + 'gridBefore', W_NS + 'gridAfter', W_NS + 'altChunk'}
+    
+    def main_part(self, archive):
+        """Name of the main document part, from the package relationships"""
+        for relationship in ElementTree.fromstring(archive.read('_rels/.rels')):
+            if relationship.get('Type', '').endswith('/officeDocument'):
+                return relationship.get('Target').lstrip('/')
+        raise FastPathUnsupported("no main document part")
+    
+    def part_targets(self, archive, part_name):
+        """Map the relationship ids of a part to the part names they point at"""
+        folder, name = posixpath.split(part_name)
+        relationships = ElementTree.fromstring(archive.read(posixpath.join(folder, '_rels', name + '.rels')))
+        targets = {}
+        for relationship in relationships:
+            if relationship.get('TargetMode') == 'External':
+                continue
+            target = relationship.get('Target')
+            if target.startswith('/'):
+                targets[relationship.get('Id')] = target.lstrip('/')
+            else:
+                targets[relationship.get('Id')] = posixpath.normpath(posixpath.join(folder, target))
+        return targets
+    
+    def word_document(self, file_path, filename):
+        with zipfile.ZipFile(file_path) as archive:
+            document_part = self.main_part(archive)
+            heading_styles = self._heading_styles(archive, document_part)
+            content = [f"Word Document: {filename}\n", "=" * 50 + "\n"]
+            tables = []
+            stack = []
+            
+            with archive.open(document_part) as part:
+                for event, element in ElementTree.iterparse(part, events=('start', 'end')):
+                    if event == 'start':
+                        if element.tag in self.WORD_UNSUPPORTED:
+                            raise FastPathUnsupported(f"unsupported element {element.tag}")
+                        if element.tag == W_NS + 'tbl' and any(parent.tag == W_NS + 'tbl' for parent in stack):
+                            raise FastPathUnsupported("nested table")
+                        stack.append(element)
+                        continue
+                    
+                    stack.pop()
+                    # Only direct children of w:body count, as in python-docx
+                    if len(stack) != 2 or stack[-1].tag != W_NS + 'body':
+                        continue
+                    if element.tag == W_NS + 'p':
+                        text = self._word_paragraph_text(element)
+                        if text.strip():
+                            style = element.find(f'{W_NS}pPr/{W_NS}pStyle')
+                            if style is not None and style.get(W_NS + 'val') in heading_styles:
+                                content.append(f"## {text}\n")
+                            else:
+                                content.append(f"{text}\n")
+                    elif element.tag == W_NS + 'tbl':
+                        tables.append(self._word_table_rows(element))
+                    stack[-1].remove(element)
+            
+            if tables:
+                content.append("\n**Tables found in document:**\n")
+                for i, rows in enumerate(tables):
+                    content.append(f"\nTable {i+1}:\n")
+                    for row in rows:
+                        content.append(f"| {' | '.join(row)} |\n")
+            return "".join(content)
+    
+    def _heading_styles(self, archive, document_part):
+        """Style ids whose display name starts with 'Heading'"""
+        styles_part = next((target for target in self.part_targets(archive, document_part).values()
+                            if target.endswith('styles.xml')), None)
+        if styles_part is None:
+            return set()
+        heading_styles = set()
+        for style in ElementTree.fromstring(archive.read(styles_part)).iter(W_NS + 'style'):
+            name = style.find(W_NS + 'name')
+            name = name.get(W_NS + 'val', '') if name is not None else ''
+            # Built-in names are stored lowercase ("heading 1") and shown capitalized
+            if name.startswith('Heading') or re.fullmatch(r'heading [1-9]', name):
+                heading_styles.add(style.get(W_NS + 'styleId'))
+        return heading_styles
+    
+    def _word_paragraph_text(self, paragraph):
+        runs = []
+        for child in paragraph:
+            if child.tag == W_NS + 'r':
+                runs.append(child)
+            elif child.tag == W_NS + 'hyperlink':
+                runs.extend(child.findall(W_NS + 'r'))
+        
+        parts = []
+        for run in runs:
+            for item in run:
+                tag = item.tag
+                if tag == W_NS + 't':
+                    parts.append(item.text or '')
+                elif tag in (W_NS + 'tab', W_NS + 'ptab'):
+                    parts.append('\t')
+                elif tag == W_NS + 'cr':
+                    parts.append('\n')
+                elif tag == W_NS + 'br':
+                    # Page and column breaks have no text
+                    if item.get(W_NS + 'type', 'textWrapping') == 'textWrapping':
+                        parts.append('\n')
+                elif tag == W_NS + 'noBreakHyphen':
+                    parts.append('-')
+        return "".join(parts)
+    
+    def _word_table_rows(self, table):
+        rows = []
+        for row in table.iter(W_NS + 'tr'):
+            cells = []
+            for child in row:
+                if child.tag == W_NS + 'tc':
+                    paragraphs = child.findall(W_NS + 'p')
+                    cells.append("\n".join(self._word_paragraph_text(p) for p in paragraphs).strip())
+                elif child.tag not in (W_NS + 'trPr', W_NS + 'tblPrEx'):
+                    raise FastPathUnsupported(f"unsupported row content {child.tag}")
+            rows.append(cells)
+        return rows
+    
+    def slide_texts(self, archive, slide_part):
+        """Text of each top-level shape on a slide, in document order"""
+        texts = []
+        stack = []
+        with archive.open(slide_part) as part:
+            for event, element in ElementTree.iterparse(part, events=('start', 'end')):
+                if event == 'start':
+                    stack.append(element)
+                    continue
+                stack.pop()
+                # Shapes directly in p:cSld/p:spTree; groups, tables and pictures carry no text here
+                if len(stack) != 3 or stack[-1].tag != P_NS + 'spTree':
+                    continue
+                if element.tag == P_NS + 'sp':
+                    text = self._shape_text(element).strip()
+                    if text:
+                        texts.append(text)
+                stack[-1].remove(element)
+        return texts
+    
+    def _shape_text(self, shape):
+        text_body = shape.find(P_NS + 'txBody')
+        if text_body is None:
+            return ""
+        paragraphs = []
+        for paragraph in text_body.findall(A_NS + 'p'):
+            parts = []
+            for child in paragraph:
+                if child.tag in (A_NS + 'r', A_NS + 'fld'):
+                    text = child.find(A_NS + 't')
+                    parts.append((text.text or '') if text is not None else '')
+                elif child.tag == A_NS + 'br':
+                    # python-pptx renders soft line breaks as vertical tabs
+                    parts.append('\v')
+            paragraphs.append("".join(parts))
+        return "\n".join(paragraphs)
+    
+    def powerpoint(self, file_path, filename, progress=None):
+        with zipfile.ZipFile(file_path) as archive:
+            presentation_part = self.main_part(archive)
+            targets = self.part_targets(archive, presentation_part)
+            presentation = ElementTree.fromstring(archive.read(presentation_part))
+            slide_list = presentation.find(P_NS + 'sldIdLst')
+            slide_parts = [targets[slide.get(R_NS + 'id')] for slide in slide_list] if slide_list is not None else []
+            
+            content = [f"PowerPoint Presentation: {filename}\n", "=" * 50 + "\n", f"Total slides: {len(slide_parts)}\n\n"]
+            for i, slide_part in enumerate(slide_parts, 1):
+                content.append(f"**Slide {i}:**\n")
+                slide_text = self.slide_texts(archive, slide_part)
+                if slide_text:
+                    for text in slide_text:
+                        content.append(f"- {text}\n")
+                else:
+                    content.append("- (No text content)\n")
+                content.append("\n")
+                if progress:
+                    progress(i, len(slide_parts))
+            return "".join(content)
+
+office_xml_extractor = OfficeXmlExtractor()
+
 class ResponseFormatter:
     def __init__(self):
         pass
@@ -738,14 +2530,623 @@ class ResponseFormatter:
 formatter = ResponseFormatter()
 file_processor = FileProcessor()
 
+def _extraction_worker_main(conn, memory_limit_mb):
+    """Extraction worker loop: runs FileProcessor jobs sent over conn"""
+    if memory_limit_mb:
+        try:
+            import resource
+            # RLIMIT_DATA covers the heap and anonymous mappings, so runaway parsers hit MemoryError
+            limit = memory_limit_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+        except (ImportError, ValueError, OSError) as e:
+            print(f"Extraction worker memory limit not applied: {e}")
+    
+    processor = FileProcessor()
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if job is None:
+            break
+        
+        method, args = job
+        progress = lambda done, total: conn.send(('progress', done, total))
+        try:
+            result = getattr(processor, method)(*args, progress=progress)
+        except MemoryError:
+            conn.send(('error', 'out of memory', _peak_rss_mb()))
+            continue
+        except Exception as e:
+            conn.send(('error', str(e), _peak_rss_mb()))
+            continue
+        conn.send(('result', result, _peak_rss_mb()))
+
+def _peak_rss_mb():
+    """Peak resident set size of this process in MB (0 when unavailable)"""
+    try:
+        import resource
+        # ru_maxrss is KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        return 0
+
+class ExtractionWorker:
+    """One parser process and the pipe used to talk to it"""
+    def __init__(self, context, memory_limit_mb):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_extraction_worker_main, args=(child_conn, memory_limit_mb), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+    
+    def stop(self, force=False):
+        try:
+            if not force:
+                self.conn.send(None)
+                self.process.join(1)
+        except (OSError, BrokenPipeError):
+            pass
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join(1)
+        self.conn.close()
+
+class ExtractionProcessPool:
+    """Runs FileProcessor in separate processes with per-file time and memory limits
+    
+    Parsing is CPU-bound, so running it in worker processes keeps the GIL free
+    for request threads. A worker that times out or dies is killed and
+    replaced; workers are also recycled after max_tasks jobs or once their
+    peak RSS passes half the memory limit.
+    """
+    def __init__(self, size=EXTRACTION_PROCESSES, timeout=EXTRACTION_TIMEOUT,
+                 memory_limit_mb=EXTRACTION_MEMORY_LIMIT_MB, max_tasks=EXTRACTION_MAX_TASKS_PER_WORKER):
+        self.size = max(0, size)
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        self.max_tasks = max_tasks
+        # Forking this multithreaded process could copy a lock in its held state into the
+        # child; a forkserver forks workers from a clean single-threaded process instead
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.context = multiprocessing.get_context(method)
+        self.idle = queue.Queue()
+        self.started = 0
+        self.lock = threading.Lock()
+        self.counters = {'completed': 0, 'timeouts': 0, 'crashes': 0, 'recycled': 0}
+    
+    def run(self, file_path, filename, mime_type, progress=None):
+        """Extract one file in a worker; returns the content or an error string"""
+        try:
+            return self.call('process_file', (file_path, filename, mime_type), progress, filename)
+        except ExtractionError as e:
+            return f"Error processing file: {e}"
+    
+    def call(self, method, args, progress=None, label='', deadline=None):
+        """Run a FileProcessor method in a worker and return its result
+        
+        The call is limited to the pool timeout, or to deadline (a time.time()
+        value) if that comes first. Raises ExtractionTimeout on timeout and
+        ExtractionError if the worker crashes or the method raises.
+        """
+        if self.size == 0:
+            try:
+                return getattr(file_processor, method)(*args, progress=progress)
+            except Exception as e:
+                raise ExtractionError(str(e) or type(e).__name__)
+        
+        worker = self._checkout()
+        deadline = min(time.time() + self.timeout, deadline or float('inf'))
+        try:
+            worker.conn.send((method, args))
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not worker.conn.poll(remaining):
+                    self._discard(worker, 'timeouts')
+                    worker = None
+                    print(f"Extraction of {label} timed out")
+                    raise ExtractionTimeout(f"extraction timed out after {self.timeout:g} seconds")
+                
+                message = worker.conn.recv()
+                if message[0] == 'progress':
+                    if progress:
+                        progress(message[1], message[2])
+                    continue
+                
+                status, result, peak_rss_mb = message
+                worker.tasks += 1
+                with self.lock:
+                    self.counters['completed'] += 1
+                if self._should_recycle(worker, peak_rss_mb):
+                    self._discard(worker, 'recycled')
+                    worker = None
+                if status == 'error':
+                    raise ExtractionError(result)
+                return result
+        except (EOFError, OSError) as e:
+            # The worker died mid-job (crash or kernel OOM kill)
+            self._discard(worker, 'crashes')
+            worker = None
+            print(f"Extraction worker crashed on {label}: {e}")
+            raise ExtractionError("extraction worker crashed")
+        finally:
+            if worker is not None:
+                self.idle.put(worker)
+    
+    def _checkout(self):
+        """Take an idle worker, starting one if the pool is not full yet"""
+        while True:
+            try:
+                return self.idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self.lock:
+                reserved = self.started < self.size
+                if reserved:
+                    self.started += 1
+            if reserved:
+                # Start the process outside the lock; other callers can keep using idle workers
+                try:
+                    return ExtractionWorker(self.context, self.memory_limit_mb)
+                except Exception:
+                    with self.lock:
+                        self.started -= 1
+                    raise
+            # Poll so a slot freed by a discarded worker is noticed
+            try:
+                return self.idle.get(timeout=0.5)
+            except queue.Empty:
+                continue
+    
+    def _discard(self, worker, reason):
+        """Stop a worker and free its slot for a fresh one"""
+        worker.stop(force=reason != 'recycled')
+        with self.lock:
+            self.started -= 1
+            self.counters[reason] += 1
+    
+    def _should_recycle(self, worker, peak_rss_mb):
+        if self.max_tasks and worker.tasks >= self.max_tasks:
+            return True
+        return bool(self.memory_limit_mb) and peak_rss_mb > self.memory_limit_mb / 2
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'processes': self.size,
+                'running': self.started,
+                'timeout': self.timeout,
+                'memory_limit_mb': self.memory_limit_mb,
+                **self.counters
+            }
+
+extraction_pool = ExtractionProcessPool()
+
+class UploadStore:
+    """Stores uploads once per SHA-256 digest"""
+    def __init__(self, blob_folder=BLOB_FOLDER, chunk_size=1024 * 1024):
+        self.blob_folder = blob_folder
+        self.chunk_size = chunk_size
+    
+    def blob_path(self, digest, ext):
+        return os.path.join(self.blob_folder, f"{digest}{ext}")
+    
+    def find(self, name):
+        """Locate a stored upload by blob name or original filename
+        
+        Returns (file_path, original_filename, mime_type, content_hash) or None;
+        files saved to the upload folder before blobs existed are found too.
+        """
+        filename = secure_filename(name or '')
+        if not filename:
+            return None
+        with get_db() as conn:
+            row = conn.execute(
+                '''SELECT original_filename, file_path, mime_type, content_hash FROM file_attachments
+                   WHERE filename = ? OR original_filename = ? ORDER BY id DESC LIMIT 1''',
+                (filename, filename)
+            ).fetchone()
+        if row and os.path.isfile(row['file_path']):
+            return row['file_path'], row['original_filename'], row['mime_type'], row['content_hash']
+        
+        for folder in (self.blob_folder, UPLOAD_FOLDER):
+            file_path = os.path.join(folder, filename)
+            if os.path.isfile(file_path):
+                mime_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+                digest = os.path.splitext(filename)[0] if folder == self.blob_folder else None
+                return file_path, filename, mime_type, digest
+        return None
+    
+    def save(self, file_storage, filename):
+        """Hash and store an upload; returns (digest, blob path, size, already stored)"""
+        ext = os.path.splitext(filename)[1].lower()
+        os.makedirs(self.blob_folder, exist_ok=True)
+        stream = file_storage.stream
+        
+        try:
+            seekable = stream.seekable()
+        except AttributeError:
+            seekable = False
+        
+        if seekable:
+            # Hash first, so a known file is never written again
+            start = stream.tell()
+            hasher = hashlib.sha256()
+            size = 0
+            for chunk in iter(lambda: stream.read(self.chunk_size), b''):
+                hasher.update(chunk)
+                size += len(chunk)
+            digest = hasher.hexdigest()
+            blob_path = self.blob_path(digest, ext)
+            if os.path.exists(blob_path):
+                return digest, blob_path, size, True
+            stream.seek(start)
+            self._write(stream, blob_path)
+            return digest, blob_path, size, False
+        
+        # Non-seekable stream: hash while writing to a temporary file
+        digest, size, temp_path = self._write(stream, None)
+        blob_path = self.blob_path(digest, ext)
+        if os.path.exists(blob_path):
+            os.remove(temp_path)
+            return digest, blob_path, size, True
+        os.replace(temp_path, blob_path)
+        return digest, blob_path, size, False
+    
+    def _write(self, stream, blob_path):
+        """Copy stream to blob_path atomically (or to a temp file when blob_path is None)"""
+        fd, temp_path = tempfile.mkstemp(dir=self.blob_folder, suffix='.part')
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for chunk in iter(lambda: stream.read(self.chunk_size), b''):
+                    hasher.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        
+        if blob_path is None:
+            return hasher.hexdigest(), size, temp_path
+        os.replace(temp_path, blob_path)
+        return hasher.hexdigest(), size, blob_path
+
+upload_store = UploadStore()
+
+class VisionImageEncoder:
+    """Downscaled JPEG encodings of uploaded images for Ollama's images field
+    
+    Each image is decoded and re-encoded once per target size; the base64
+    payload is kept in the image_encodings table (keyed by content hash) and
+    a small in-memory LRU, so later turns reuse it instead of the original.
+    """
+    def __init__(self, client, model_prefixes=VISION_MODELS, max_edge=VISION_MAX_EDGE,
+                 model_max_edges=None, quality=VISION_JPEG_QUALITY, memory_entries=16,
+                 capability_ttl=VISION_CAPABILITY_TTL):
+        self.client = client
+        self.capability_ttl = capability_ttl
+        self.model_prefixes = model_prefixes
+        self.max_edge = max_edge
+        self.model_max_edges = dict(VISION_MODEL_MAX_EDGE if model_max_edges is None else model_max_edges)
+        self.quality = quality
+        self.memory_entries = memory_entries
+        self._capabilities = {}  # model -> (is vision model, checked at)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+    
+    def is_vision_model(self, model):
+        """True if Ollama reports vision support, or the name matches VISION_MODELS
+        
+        Every answer is cached for capability_ttl seconds, including the name
+        match used when /api/show fails or reports no capabilities, so a
+        missing model or an unreachable host costs one lookup per TTL.
+        """
+        if not IMAGE_AVAILABLE or not model or model == CLAUDE_CODE_MODEL:
+            return False
+        cached = self._capabilities.get(model)
+        if cached and time.time() - cached[1] < self.capability_ttl:
+            return cached[0]
+        
+        try:
+            capabilities = self.client.show(model).get('capabilities')
+        except Exception:
+            capabilities = None
+        if capabilities is None:
+            # Older Ollama versions do not report capabilities
+            base = model.split(':')[0]
+            vision = any(base.startswith(prefix) for prefix in self.model_prefixes)
+        else:
+            vision = 'vision' in capabilities
+        self._capabilities[model] = (vision, time.time())
+        return vision
+    
+    def get_max_edge(self, model):
+        return self.model_max_edges.get(model, self.model_max_edges.get(model.split(':')[0], self.max_edge))
+    
+    def encode_for_model(self, model, content_hash, file_path):
+        """Base64 JPEG of the image sized for model, or None if it cannot be encoded"""
+        try:
+            return self.encode(content_hash, file_path, self.get_max_edge(model))
+        except Exception as e:
+            print(f"Error encoding image {file_path} for {model}: {e}")
+            return None
+    
+    def encode(self, content_hash, file_path, max_edge):
+        if not content_hash:
+            # Attachments stored before uploads were content-addressed
+            hasher = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    hasher.update(chunk)
+            content_hash = hasher.hexdigest()
+        key = (content_hash, max_edge, self.quality)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        
+        data = self._flight.do(key, lambda: self._load_or_encode(key, file_path))
+        with self._lock:
+            self._memory[key] = data
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+        return data
+    
+    def _load_or_encode(self, key, file_path):
+        content_hash, max_edge, quality = key
+        with get_db() as conn:
+            row = conn.execute(
+                'SELECT data FROM image_encodings WHERE content_hash = ? AND max_edge = ? AND quality = ?', key
+            ).fetchone()
+        if row:
+            return row['data']
+        
+        started = time.time()
+        with Image.open(file_path) as original:
+            # JPEGs can be decoded straight at a reduced scale
+            original.draft('RGB', (max_edge, max_edge))
+            img = ImageOps.exif_transpose(original)
+            if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+                rgba = img.convert('RGBA')
+                img = Image.new('RGB', rgba.size, (255, 255, 255))
+                img.paste(rgba, mask=rgba.getchannel('A'))
+            elif img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=quality, optimize=True)
+        data = base64.b64encode(buffer.getvalue()).decode('ascii')
+        
+        with get_db() as conn:
+            conn.execute(
+                '''INSERT OR REPLACE INTO image_encodings (content_hash, max_edge, quality, width, height, data)
+                   VALUES (?, ?, ?, ?, ?, ?)''',
+                (content_hash, max_edge, quality, img.width, img.height, data)
+            )
+            conn.commit()
+        print(f"Encoded {os.path.basename(file_path)} at {img.width}x{img.height} "
+              f"({len(data) // 1024} KB base64) in {time.time() - started:.2f}s")
+        return data
+    
+    def prune(self):
+        """Drop encodings of images no attachment refers to any more"""
+        with get_db() as conn:
+            conn.execute(
+                '''DELETE FROM image_encodings
+                   WHERE content_hash NOT IN (SELECT content_hash FROM file_attachments WHERE content_hash IS NOT NULL)'''
+            )
+            conn.commit()
+        with self._lock:
+            self._memory.clear()
+
+vision_images = VisionImageEncoder(ollama_client)
+
+def extract_file_content(file_path, filename, mime_type, content_hash=None, progress=None):
+    """Run the file processor, reusing cached output for content already seen"""
+    ext = os.path.splitext(filename)[1].lower()
+    if content_hash:
+        cached = get_cached_extraction(content_hash, ext)
+        if cached is not None:
+            print(f"Extraction cache hit for {filename}")
+            return cached
+    
+    complete = True
+    if mime_type == 'application/pdf' and PDF_AVAILABLE:
+        try:
+            processed_content, complete = extract_pdf_content(file_path, filename, content_hash, progress)
+        except ExtractionError as e:
+            # Pages read so far stay in the page cache, so a retry resumes from there
+            processed_content = f"Error reading PDF: {e}"
+    else:
+        processed_content = extraction_pool.run(file_path, filename, mime_type, progress)
+    
+    # Failed or time-limited extractions are not cached so they are retried next time
+    if content_hash and complete and not processed_content.startswith('Error'):
+        save_cached_extraction(content_hash, ext, processed_content)
+        # Index now so the first question about a long document does not wait for it
+        document_index.add(content_hash, processed_content)
+    return processed_content
+
+def extract_pdf_content(file_path, filename, content_hash=None, progress=None):
+    """Extract PDF text page by page within the PDF budget
+    
+    EXTRACTION_TIMEOUT covers the whole file, not each page range; pages read
+    before it runs out are returned with a note. Returns (text, complete),
+    where complete is False if the time limit cut the text short.
+    """
+    deadline = time.time() + extraction_pool.timeout
+    total_pages = extraction_pool.call('pdf_page_count', (file_path,), label=filename, deadline=deadline)
+    collector = PdfTextCollector(total_pages)
+    
+    pages = iter_pdf_pages(file_path, filename, collector.page_limit, content_hash, deadline)
+    try:
+        for page_index, text in pages:
+            wants_more = collector.add(text)
+            if progress:
+                progress(page_index + 1, collector.page_limit)
+            if not wants_more:
+                break
+            if time.time() >= deadline:
+                collector.time_limit_hit = True
+                break
+    except ExtractionTimeout:
+        if not collector.pages_read:
+            raise
+        collector.time_limit_hit = True
+    finally:
+        pages.close()
+    if collector.time_limit_hit:
+        print(f"PDF {filename}: time limit reached after {collector.pages_read} of {total_pages} pages")
+    return collector.result(), not collector.time_limit_hit
+
+def iter_pdf_pages(file_path, filename, page_limit, content_hash=None, deadline=None):
+    """Yield (page index, text) in order, reading page ranges in parallel
+    
+    Ranges are spread over the extraction processes, with at most one
+    range per process in flight. Pages are cached by content hash, and
+    ranges already in flight when the caller stops still fill the cache.
+    """
+    cached_pages = get_cached_pdf_pages(content_hash, page_limit) if content_hash else {}
+    range_size = max(1, PDF_PAGES_PER_RANGE)
+    ranges = ((start, min(start + range_size, page_limit)) for start in range(0, page_limit, range_size))
+    
+    def read_range(start, end):
+        if all(page_index in cached_pages for page_index in range(start, end)):
+            return [cached_pages[page_index] for page_index in range(start, end)]
+        texts = extraction_pool.call(
+            'extract_pdf_pages', (file_path, start, end), label=f"{filename} pages {start + 1}-{end}", deadline=deadline
+        )
+        if content_hash:
+            save_cached_pdf_pages(content_hash, start, texts)
+        return texts
+    
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, extraction_pool.size))
+    pending = deque()
+    try:
+        for start, end in itertools.islice(ranges, max(1, extraction_pool.size)):
+            pending.append((start, executor.submit(read_range, start, end)))
+        
+        while pending:
+            start, future = pending.popleft()
+            texts = future.result()
+            for next_start, next_end in itertools.islice(ranges, 1):
+                pending.append((next_start, executor.submit(read_range, next_start, next_end)))
+            for offset, text in enumerate(texts):
+                yield start + offset, text
+    finally:
+        executor.shutdown(wait=False)
+
+class ExtractionJob:
+    """A document extraction running in the background"""
+    def __init__(self, file_info):
+        self.id = str(uuid.uuid4())
+        self.file_info = file_info
+        self.status = 'queued'  # queued -> running -> done | failed
+        self.progress = 0.0
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.done = threading.Event()
+    
+    def set_progress(self, done, total):
+        if total:
+            self.progress = round(min(done / total, 1.0), 3)
+    
+    def to_dict(self):
+        job = {
+            'id': self.id,
+            'status': self.status,
+            'progress': self.progress,
+            'filename': self.file_info['original_filename'],
+            'file_size': self.file_info['file_size'],
+            'mime_type': self.file_info['mime_type'],
+            'content_hash': self.file_info['content_hash'],
+            'elapsed': round((self.finished or time.time()) - self.created, 3)
+        }
+        if self.status == 'done':
+            job['content_length'] = len(self.file_info.get('processed_content') or '')
+        if self.error:
+            job['error'] = self.error
+        return job
+
+class ExtractionJobManager:
+    """Runs file extraction off the request thread and tracks job progress"""
+    def __init__(self, max_workers=EXTRACTION_WORKERS, ttl=EXTRACTION_JOB_TTL):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, max_workers), thread_name_prefix='extract'
+        )
+        self.ttl = ttl
+        self.jobs = {}
+        self.lock = threading.Lock()
+    
+    def submit(self, file_info):
+        """Start extracting a stored upload; returns the job"""
+        job = ExtractionJob(file_info)
+        with self.lock:
+            self._prune()
+            self.jobs[job.id] = job
+        self.executor.submit(self._run, job)
+        return job
+    
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+    
+    def wait(self, job_id, timeout=EXTRACTION_WAIT_TIMEOUT):
+        """Block until a job finishes; returns the job, or None if it is unknown"""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        if not job.done.wait(timeout):
+            raise TimeoutError(f"Extraction of {job.file_info['original_filename']} is still running")
+        return job
+    
+    def stats(self):
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return {'jobs': len(self.jobs), 'by_status': counts}
+    
+    def _run(self, job):
+        info = job.file_info
+        job.status = 'running'
+        try:
+            info['processed_content'] = extract_file_content(
+                info['file_path'], info['original_filename'], info['mime_type'],
+                info['content_hash'], progress=job.set_progress
+            )
+            job.progress = 1.0
+            job.status = 'done'
+        except Exception as e:
+            print(f"Extraction job {job.id} failed: {e}")
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            job.finished = time.time()
+            job.done.set()
+    
+    def _prune(self):
+        """Forget finished jobs older than the TTL (caller holds the lock)"""
+        cutoff = time.time() - self.ttl
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job.finished and job.finished < cutoff]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+extraction_jobs = ExtractionJobManager()
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def enhance_prompt(user_message):
-    """Enhance user prompt with formatting instructions"""
-    return f"""{user_message}
-
-Please format your response professionally using:
+# Sent as the first system message of every chat. It never changes between turns,
+# so the prompt prefix stays stable and Ollama can reuse its cached prefill.
+FORMATTING_SYSTEM_PROMPT = """Please format your responses professionally using:
 - **Bold text** for emphasis and important points
 - *Italic text* for explanations or definitions
 - `code snippets` for technical terms and functions
@@ -753,27 +3154,747 @@ Please format your response professionally using:
 - ## Headings for organizing content
 - Tables with | pipes | for | structured data |
 - Bullet points and numbered lists for clarity
-- Links [like this](url) when referencing external resources"""
+- Links [like this](url) when referencing external resources
+
+When the user shares a file, analyze it to answer their question. When analyzing spreadsheet data, present key findings in table format."""
 
 def enhance_prompt_with_file(user_message, file_content, filename):
-    """Add file context to user prompt"""
+    """Add file context to user prompt (file first, question last, same layout every turn)"""
     return f"""I'm sharing a file with you: {filename}
 
 File content:
 {file_content}
 
-User question: {user_message}
+User question: {user_message}"""
+
+def estimate_tokens(text):
+    """Rough token estimate for budgeting (about 4 characters per token)"""
+    return (len(text) + 3) // 4 if text else 0
+
+def truncate_to_tokens(text, max_tokens, mode='head'):
+    """Cut text to roughly max_tokens, noting how much was dropped
+    
+    mode is 'head', 'head_tail' or 'sample' (see excerpt_text).
+    """
+    return excerpt_text(text, max(max_tokens, 0) * 4, mode)
+
+class ContextBuilder:
+    """Fits conversation history and attachments into a per-model token budget
+    
+    Prompts are kept prefix-stable so Ollama can reuse its cached prefix: a
+    history message is rendered the same way on every turn, and old messages
+    are dropped in fixed blocks of positions rather than one per turn.
+    """
+    def __init__(self, default_budget=CONTEXT_TOKEN_BUDGET, model_budgets=None,
+                 max_history=CONTEXT_MAX_HISTORY, attachment_tokens=HISTORY_ATTACHMENT_TOKENS,
+                 eviction_block=CONTEXT_EVICTION_BLOCK):
+        self.default_budget = default_budget
+        self.model_budgets = dict(MODEL_CONTEXT_BUDGETS if model_budgets is None else model_budgets)
+        self.max_history = max_history
+        self.attachment_tokens = attachment_tokens
+        self.eviction_block = max(eviction_block, 1)
+        self._last_prompts = OrderedDict()  # (session_id, model) -> message digests
+        self._lock = threading.Lock()
+    
+    def get_budget(self, model):
+        return self.model_budgets.get(model, self.default_budget)
+    
+    def _get_history(self, session_id, exclude_message_id=None, after_message_id=0):
+        """Newest-first history rows with any attachment content and their position in the session"""
+        try:
+            with get_db() as conn:
+                cursor = conn.execute(
+                    '''SELECT * FROM (
+                           SELECT m.id, m.role, m.content, m.prompt_content, fa.original_filename,
+                                  fa.processed_content, fa.content_hash, fa.mime_type, fa.file_path,
+                                  ROW_NUMBER() OVER (ORDER BY m.timestamp, m.id) AS position
+                           FROM messages m
+                           LEFT JOIN file_attachments fa ON m.id = fa.message_id
+                           WHERE m.session_id = ?
+                       )
+                       WHERE id != ? AND id > ?
+                       ORDER BY position DESC LIMIT ?''',
+                    (session_id, exclude_message_id or -1, after_message_id or 0, self.max_history)
+                )
+                return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            print(f"Error getting context history: {e}")
+            return []
+    
+    def _render(self, row, budget):
+        """History text for a row; depends only on the row and the budget, never on the turn"""
+        # A user turn is replayed exactly as it was sent, unless that alone would crowd the prompt
+        if row['prompt_content'] and estimate_tokens(row['prompt_content']) <= budget // 2:
+            return row['prompt_content'], False
+        if row['processed_content']:
+            attachment = truncate_to_tokens(row['processed_content'], self.attachment_tokens, TEXT_EXCERPT_MODE)
+            content = enhance_prompt_with_file(row['content'], attachment, row['original_filename'])
+            return content, attachment != row['processed_content']
+        return row['content'], False
+    
+    def _block_start(self, position):
+        """First position of the eviction block at or after position"""
+        return -(-(position - 1) // self.eviction_block) * self.eviction_block + 1
+    
+    def _track_prefix(self, session_id, model, messages):
+        """How many leading messages match this session's previous prompt for the model"""
+        digests = [hashlib.sha256(json.dumps(message, sort_keys=True).encode('utf-8')).hexdigest()
+                   for message in messages]
+        with self._lock:
+            previous = self._last_prompts.pop((session_id, model), [])
+            self._last_prompts[(session_id, model)] = digests
+            while len(self._last_prompts) > 256:
+                self._last_prompts.popitem(last=False)
+        shared = 0
+        for old, new in zip(previous, digests):
+            if old != new:
+                break
+            shared += 1
+        return shared, len(previous)
+    
+    def _recall(self, session_id, user_message, history_rows, exclude_message_id=None):
+        """Earlier messages outside the history window that are similar to the question"""
+        if not embedding_index.enabled or not user_message.strip():
+            return []
+        exclude = {row['id'] for row in history_rows}
+        exclude.add(exclude_message_id)
+        try:
+            hits = embedding_index.search(
+                session_id, user_message, EMBEDDING_RECALL_K, kind='message',
+                exclude_sources=exclude, min_score=EMBEDDING_MIN_SCORE
+            )
+        except Exception as e:
+            print(f"Error recalling earlier messages: {e}")
+            return []
+        
+        recalled = []
+        remaining = self.attachment_tokens // 2
+        for hit in sorted(hits, key=lambda hit: hit['source_id']):
+            line = truncate_to_tokens(hit['text'], min(150, remaining))
+            remaining -= estimate_tokens(line)
+            if remaining < 0:
+                break
+            recalled.append(line)
+        return recalled
+    
+    def build(self, session_id, model, user_message, file_info=None, exclude_message_id=None):
+        """Return (messages, context_info) for the latest user turn"""
+        budget = self.get_budget(model)
+        truncated_attachments = 0
+        retrieved_attachments = 0
+        images = 0
+        
+        # A rolling summary stands in for everything up to summary_message_id
+        summary, summary_message_id = get_session_summary(session_id)
+        history_rows = self._get_history(session_id, exclude_message_id, summary_message_id if summary else 0)
+        # Only turns that involve a picture need to know whether the model can see
+        has_images = any((row['mime_type'] or '').startswith('image/') for row in history_rows) or \
+            bool(file_info and (file_info.get('mime_type') or '').startswith('image/'))
+        vision = has_images and vision_images.is_vision_model(model)
+        # An unanswered copy of this question is a double submit; leaving it out gives
+        # both requests the same prompt, so their generations are coalesced
+        while history_rows and history_rows[0]['role'] == 'user' and not history_rows[0]['processed_content'] \
+                and not file_info and history_rows[0]['content'] == user_message:
+            history_rows.pop(0)
+        
+        # The current turn always goes in; a long attachment is reduced to the chunks
+        # relevant to the question, or cut to what the budget allows
+        if file_info:
+            question_tokens = estimate_tokens(enhance_prompt_with_file(user_message, '', file_info['original_filename']))
+            file_content = file_info['processed_content'] or ''
+            available = budget - question_tokens
+            fitted_content = None
+            if estimate_tokens(file_content) > available:
+                fitted_content = document_index.excerpts(
+                    file_info.get('content_hash'), file_content, user_message, available, session_id
+                )
+                retrieved_attachments += fitted_content is not None
+            if fitted_content is None:
+                fitted_content = truncate_to_tokens(file_content, available, TEXT_EXCERPT_MODE)
+                if fitted_content != file_content:
+                    truncated_attachments += 1
+            current = enhance_prompt_with_file(user_message, fitted_content, file_info['original_filename'])
+        else:
+            current = user_message
+            # Follow-up questions get the relevant parts of the latest long attachment
+            earlier = next((row for row in history_rows if row['processed_content']), None)
+            if earlier and user_message.strip() and \
+                    estimate_tokens(earlier['processed_content']) > self.attachment_tokens:
+                excerpts = document_index.excerpts(
+                    earlier['content_hash'], earlier['processed_content'], user_message,
+                    self.attachment_tokens, session_id
+                )
+                if excerpts:
+                    current = f"{user_message}\n\nRelevant excerpts from {earlier['original_filename']}:\n{excerpts}"
+                    retrieved_attachments += 1
+        
+        # Older turns that dropped out of the window but match the question
+        recalled = self._recall(session_id, user_message, history_rows, exclude_message_id)
+        if recalled:
+            current += "\n\nRelated earlier messages from this conversation:\n" + "\n".join(f"- {line}" for line in recalled)
+        current_message = {'role': 'user', 'content': current}
+        
+        # Vision models get the picture itself, downscaled once and cached
+        if vision and file_info and (file_info.get('mime_type') or '').startswith('image/'):
+            image = vision_images.encode_for_model(model, file_info.get('content_hash'), file_info['file_path'])
+            if image:
+                current_message['images'] = [image]
+                images += 1
+        
+        used = estimate_tokens(FORMATTING_SYSTEM_PROMPT) + estimate_tokens(current)
+        
+        summary_message = None
+        if summary:
+            summary_message = {
+                'role': 'system',
+                'content': f"Summary of the earlier conversation:\n{summary}"
+            }
+            used += estimate_tokens(summary_message['content'])
+        
+        # Walk history newest to oldest to find the oldest message that still fits,
+        # then start at an eviction block boundary so the first messages rarely change
+        rendered = []
+        fitting = 0
+        for row in history_rows:
+            content, truncated = self._render(row, budget)
+            content_tokens = estimate_tokens(content)
+            if used + content_tokens > budget:
+                break
+            used += content_tokens
+            rendered.append((row, content, content_tokens, truncated))
+            fitting += 1
+        if rendered:
+            oldest = rendered[-1][0]['position']
+            if fitting < len(history_rows) or len(history_rows) >= self.max_history:
+                # Something older was left out, so start on a block boundary
+                start = self._block_start(oldest)
+                while rendered and rendered[-1][0]['position'] < start:
+                    used -= rendered.pop()[2]
+        
+        history = []
+        history_images = 0
+        for row, content, content_tokens, truncated in rendered:
+            truncated_attachments += truncated
+            entry = {'role': row['role'], 'content': content}
+            # Follow-ups about a recent picture keep it, in the turn it was sent with
+            if vision and history_images < VISION_HISTORY_IMAGES and (row['mime_type'] or '').startswith('image/'):
+                image = vision_images.encode_for_model(model, row['content_hash'], row['file_path'])
+                if image:
+                    entry['images'] = [image]
+                    history_images += 1
+            history.append(entry)
+        
+        # Stable parts first: formatting guidance, then the summary, then the turns
+        messages = [{'role': 'system', 'content': FORMATTING_SYSTEM_PROMPT}]
+        if summary_message:
+            messages.append(summary_message)
+        messages.extend(reversed(history))
+        messages.append(current_message)
+        
+        context_info = {
+            'prompt_tokens': used,
+            'budget': budget,
+            'history_messages': len(history),
+            'history_available': len(history_rows),
+            'truncated_attachments': truncated_attachments,
+            'retrieved_attachments': retrieved_attachments,
+            'recalled_messages': len(recalled),
+            'images': images + history_images,
+            'summarized': bool(summary)
+        }
+        context_info['prefix_messages'], previous_length = self._track_prefix(session_id, model, messages)
+        context_info['prefix_stable'] = context_info['prefix_messages'] == previous_length
+        return messages, context_info
+
+context_builder = ContextBuilder()
+
+class DocumentIndex:
+    """Chunks attachment text into a SQLite FTS5 index for question-focused excerpts
+    
+    Chunks are keyed by content hash, like the upload blobs, so a document
+    is indexed once however many sessions attach it.
+    """
+    STOPWORDS = {
+        'the', 'and', 'for', 'are', 'was', 'what', 'which', 'who', 'how', 'why', 'when', 'where',
+        'this', 'that', 'with', 'from', 'about', 'does', 'did', 'can', 'you', 'your', 'file',
+        'document', 'please', 'tell', 'there', 'their', 'they', 'into', 'have', 'has', 'its'
+    }
+    
+    def __init__(self, chunk_chars=RETRIEVAL_CHUNK_CHARS, overlap=RETRIEVAL_CHUNK_OVERLAP,
+                 top_k=RETRIEVAL_TOP_K, enabled=RETRIEVAL_ENABLED):
+        self.chunk_chars = max(chunk_chars, 200)
+        self.overlap = min(max(overlap, 0), self.chunk_chars // 2)
+        self.top_k = top_k
+        self.available = enabled
+        self._lock = threading.Lock()
+    
+    def chunk(self, text):
+        """Split text into overlapping (start offset, text) chunks, preferring natural breaks"""
+        chunks = []
+        start = 0
+        length = len(text)
+        while start < length:
+            end = min(start + self.chunk_chars, length)
+            if end < length:
+                # End on a paragraph, line or sentence break in the second half of the window
+                for separator in ('\n\n', '\n', '. '):
+                    cut = text.rfind(separator, start + self.chunk_chars // 2, end)
+                    if cut != -1:
+                        end = cut + len(separator)
+                        break
+            chunks.append((start, text[start:end]))
+            if end >= length:
+                break
+            start = max(end - self.overlap, start + 1)
+        return chunks
+    
+    def add(self, content_hash, text):
+        """Index a document unless the current extractor's version is already indexed"""
+        if not self.available or not content_hash or not text:
+            return
+        with self._lock, get_db() as conn:
+            row = conn.execute(
+                'SELECT extractor_version FROM document_index WHERE content_hash = ?', (content_hash,)
+            ).fetchone()
+            if row and row['extractor_version'] == FileProcessor.VERSION:
+                return
+            
+            chunks = self.chunk(text)
+            conn.execute('DELETE FROM document_chunks WHERE content_hash = ?', (content_hash,))
+            conn.executemany(
+                'INSERT INTO document_chunks (content, content_hash, chunk_index, start_offset) VALUES (?, ?, ?, ?)',
+                [(chunk, content_hash, index, start) for index, (start, chunk) in enumerate(chunks)]
+            )
+            conn.execute(
+                'INSERT OR REPLACE INTO document_index (content_hash, extractor_version, chunk_count) VALUES (?, ?, ?)',
+                (content_hash, FileProcessor.VERSION, len(chunks))
+            )
+            conn.commit()
+            print(f"Indexed {len(chunks)} chunks for {content_hash[:12]}")
+    
+    def query_terms(self, question):
+        terms = [term for term in re.findall(r'\w{2,}', question.lower()) if term not in self.STOPWORDS]
+        return list(dict.fromkeys(terms))[:32]
+    
+    def search(self, content_hash, question, limit):
+        """Best matching chunks for the question, most relevant first"""
+        terms = self.query_terms(question)
+        with get_db() as conn:
+            if terms:
+                rows = conn.execute(
+                    '''SELECT chunk_index, start_offset, content FROM document_chunks
+                       WHERE document_chunks MATCH ? AND content_hash = ?
+                       ORDER BY bm25(document_chunks) LIMIT ?''',
+                    (' OR '.join(f'"{term}"' for term in terms), content_hash, limit)
+                ).fetchall()
+                if rows:
+                    return rows
+            # Nothing matched: fall back to the start of the document
+            return conn.execute(
+                '''SELECT chunk_index, start_offset, content FROM document_chunks
+                   WHERE content_hash = ? ORDER BY chunk_index LIMIT ?''',
+                (content_hash, limit)
+            ).fetchall()
+    
+    def fuse(self, content_hash, rows, semantic_indexes, k=60):
+        """Merge keyword and semantic rankings with reciprocal rank fusion"""
+        scores = {}
+        for ranking in ([row['chunk_index'] for row in rows], semantic_indexes):
+            for rank, chunk_index in enumerate(ranking):
+                scores[chunk_index] = scores.get(chunk_index, 0) + 1 / (k + rank + 1)
+        by_index = {row['chunk_index']: row for row in rows}
+        missing = [index for index in semantic_indexes if index not in by_index]
+        if missing:
+            with get_db() as conn:
+                by_index.update((row['chunk_index'], row) for row in conn.execute(
+                    f'''SELECT chunk_index, start_offset, content FROM document_chunks
+                        WHERE content_hash = ? AND chunk_index IN ({', '.join('?' * len(missing))})''',
+                    [content_hash] + missing
+                ))
+        ranked = sorted(by_index, key=lambda index: scores.get(index, 0), reverse=True)
+        return [by_index[index] for index in ranked[:self.top_k]]
+    
+    def excerpts(self, content_hash, text, question, max_tokens, session_id=None):
+        """Relevant chunks of text that fit max_tokens, in document order; None if unavailable
+        
+        With a session_id and semantic search enabled, chunks the session's
+        embedding index ranks highly are fused with the keyword matches.
+        """
+        if not self.available or not content_hash:
+            return None
+        try:
+            self.add(content_hash, text)
+            rows = self.search(content_hash, question, self.top_k)
+            with get_db() as conn:
+                total = conn.execute(
+                    'SELECT chunk_count FROM document_index WHERE content_hash = ?', (content_hash,)
+                ).fetchone()['chunk_count']
+        except Exception as e:
+            print(f"Error retrieving document chunks: {e}")
+            return None
+        
+        if session_id and embedding_index.enabled:
+            try:
+                hits = embedding_index.search(session_id, question, self.top_k, kind='chunk', content_hash=content_hash)
+                if hits:
+                    rows = self.fuse(content_hash, rows, [hit['chunk_index'] for hit in hits])
+            except Exception as e:
+                print(f"Error ranking chunks by embedding: {e}")
+        
+        header_tokens = 20
+        used = header_tokens
+        selected = []
+        for row in rows:
+            # Each section carries a short label line
+            tokens = estimate_tokens(row['content']) + 12
+            if used + tokens > max_tokens:
+                continue
+            selected.append(row)
+            used += tokens
+        if not selected:
+            return None
+        
+        parts = [f"[{len(selected)} of {total} sections, selected for the question]"]
+        for row in sorted(selected, key=lambda row: row['chunk_index']):
+            start = row['start_offset']
+            parts.append(f"[Section {row['chunk_index'] + 1}, characters {start:,}-{start + len(row['content']):,}]\n{row['content']}")
+        return "\n\n".join(parts)
+    
+    def prune(self):
+        """Drop chunks of documents no attachment refers to any more"""
+        if not self.available:
+            return
+        with self._lock, get_db() as conn:
+            orphans = [row['content_hash'] for row in conn.execute(
+                '''SELECT content_hash FROM document_index
+                   WHERE content_hash NOT IN (SELECT content_hash FROM file_attachments WHERE content_hash IS NOT NULL)'''
+            )]
+            for content_hash in orphans:
+                conn.execute('DELETE FROM document_chunks WHERE content_hash = ?', (content_hash,))
+                conn.execute('DELETE FROM document_index WHERE content_hash = ?', (content_hash,))
+            conn.commit()
+
+document_index = DocumentIndex()
+
+class EmbeddingIndex:
+    """Per-session vector index over messages and attachment chunks
+    
+    Unit-length float32 vectors are appended to one file per session under
+    EMBEDDING_FOLDER; embedding_entries records what each row holds. A search
+    memory-maps the file and scores every row with a single matrix-vector
+    product, so nothing is re-embedded or loaded into Python objects per query.
+    """
+    def __init__(self, client, model=EMBEDDING_MODEL, folder=EMBEDDING_FOLDER,
+                 batch_size=EMBEDDING_BATCH_SIZE, chunker=document_index):
+        self.client = client
+        self.model = model
+        self.folder = folder
+        self.batch_size = max(batch_size, 1)
+        self.chunker = chunker
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._query_cache = OrderedDict()
+        if self.enabled:
+            os.makedirs(self.folder, exist_ok=True)
+    
+    @property
+    def enabled(self):
+        return bool(self.model)
+    
+    def store_path(self, session_id):
+        return os.path.join(self.folder, f"{secure_filename(session_id)}.f32")
+    
+    def schedule(self, session_id):
+        """Queue a session for indexing; duplicate requests are merged"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if session_id in self._pending:
+                return
+            self._pending.add(session_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='embedding-indexer', daemon=True)
+                self._thread.start()
+        self._queue.put(session_id)
+    
+    def _run(self):
+        while True:
+            session_id = self._queue.get()
+            with self._lock:
+                self._pending.discard(session_id)
+            try:
+                self.update(session_id)
+            except Exception as e:
+                print(f"Error indexing embeddings for session {session_id}: {e}")
+    
+    def embed(self, texts):
+        """Unit-length vectors for texts, embedded EMBEDDING_BATCH_SIZE at a time"""
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            embeddings = self.client.embed(self.model, batch)
+            if len(embeddings) != len(batch):
+                raise ValueError(f"Expected {len(batch)} embeddings, got {len(embeddings)}")
+            for vector in embeddings:
+                norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+                vectors.append([value / norm for value in vector])
+        return vectors
+    
+    def embed_query(self, query):
+        """Embedding of a search query, remembered for repeated questions"""
+        with self._lock:
+            if query in self._query_cache:
+                self._query_cache.move_to_end(query)
+                return self._query_cache[query]
+        vector = self.embed([query])[0]
+        with self._lock:
+            self._query_cache[query] = vector
+            while len(self._query_cache) > 64:
+                self._query_cache.popitem(last=False)
+        return vector
+    
+    def update(self, session_id):
+        """Embed the session's messages and attachment chunks that are not indexed yet"""
+        if not self.enabled:
+            return 0
+        with self._write_lock:
+            with get_db() as conn:
+                store = conn.execute(
+                    'SELECT model FROM embedding_stores WHERE session_id = ?', (session_id,)
+                ).fetchone()
+                if store and store['model'] != self.model:
+                    # Vectors from different models are not comparable
+                    self._reset(conn, session_id)
+                messages = conn.execute(
+                    '''SELECT m.id, m.role, m.content FROM messages m
+                       WHERE m.session_id = ? AND trim(m.content) != ''
+                         AND NOT EXISTS (SELECT 1 FROM embedding_entries e
+                                         WHERE e.session_id = m.session_id AND e.kind = 'message' AND e.source_id = m.id)
+                       ORDER BY m.id''',
+                    (session_id,)
+                ).fetchall()
+                attachments = conn.execute(
+                    '''SELECT fa.message_id, fa.content_hash, fa.processed_content FROM file_attachments fa
+                       JOIN messages m ON m.id = fa.message_id
+                       WHERE m.session_id = ? AND fa.content_hash IS NOT NULL AND fa.processed_content IS NOT NULL
+                         AND NOT EXISTS (SELECT 1 FROM embedding_entries e
+                                         WHERE e.session_id = m.session_id AND e.kind = 'chunk' AND e.content_hash = fa.content_hash)
+                       GROUP BY fa.content_hash ORDER BY fa.message_id''',
+                    (session_id,)
+                ).fetchall()
+            
+            items = [('message', row['id'], None, None, f"{row['role'].title()}: {row['content']}") for row in messages]
+            for row in attachments:
+                # Same chunk boundaries as the full-text index, so chunk numbers line up
+                for index, (_, chunk) in enumerate(self.chunker.chunk(row['processed_content'])):
+                    items.append(('chunk', row['message_id'], row['content_hash'], index, chunk))
+            
+            for start in range(0, len(items), self.batch_size):
+                batch = items[start:start + self.batch_size]
+                self._append(session_id, batch, self.embed([item[4] for item in batch]))
+            if items:
+                print(f"Embedded {len(items)} items for session {session_id[:8]}")
+            return len(items)
+    
+    def _append(self, session_id, items, vectors):
+        """Write vectors after the last stored row and record what they hold"""
+        dim = len(vectors[0])
+        data = array('f')
+        for vector in vectors:
+            if len(vector) != dim:
+                raise ValueError("Embedding dimensions differ within a batch")
+            data.extend(vector)
+        
+        with get_db() as conn:
+            store = conn.execute(
+                'SELECT dim, count FROM embedding_stores WHERE session_id = ?', (session_id,)
+            ).fetchone()
+            count = store['count'] if store else 0
+            if store and store['dim'] != dim:
+                raise ValueError(f"Embedding dimension changed from {store['dim']} to {dim}")
+            
+            path = self.store_path(session_id)
+            with open(path, 'r+b' if count and os.path.exists(path) else 'wb') as f:
+                # Rows past count are leftovers of an interrupted write
+                f.seek(count * dim * 4)
+                f.write(data.tobytes())
+                f.truncate()
+            
+            conn.executemany(
+                '''INSERT OR REPLACE INTO embedding_entries
+                   (session_id, row_index, kind, source_id, content_hash, chunk_index, text)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                [(session_id, count + offset, kind, source_id, content_hash, chunk_index, text)
+                 for offset, (kind, source_id, content_hash, chunk_index, text) in enumerate(items)]
+            )
+            conn.execute(
+                'INSERT OR REPLACE INTO embedding_stores (session_id, model, dim, count) VALUES (?, ?, ?, ?)',
+                (session_id, self.model, dim, count + len(items))
+            )
+            conn.commit()
+    
+    def _scores(self, path, count, dim, query_vector):
+        """Cosine similarity of every stored row with the query vector"""
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), count * dim * 4, access=mmap.ACCESS_READ) as mapped:
+            if NUMPY_AVAILABLE:
+                matrix = np.frombuffer(mapped, dtype=np.float32, count=count * dim).reshape(count, dim)
+                scores = (matrix @ np.asarray(query_vector, dtype=np.float32)).tolist()
+                del matrix
+                return scores
+            flat = memoryview(mapped).cast('f')
+            try:
+                return [sum(map(operator.mul, flat[row * dim:(row + 1) * dim], query_vector)) for row in range(count)]
+            finally:
+                flat.release()
+    
+    def search(self, session_id, query, top_k, kind=None, content_hash=None, exclude_sources=(), min_score=None):
+        """Best matching entries for query as dicts with a score, most similar first"""
+        if not self.enabled or not query.strip():
+            return []
+        with get_db() as conn:
+            store = conn.execute(
+                'SELECT model, dim, count FROM embedding_stores WHERE session_id = ?', (session_id,)
+            ).fetchone()
+        if not store or not store['count'] or store['model'] != self.model:
+            return []
+        
+        query_vector = self.embed_query(query)
+        if len(query_vector) != store['dim']:
+            return []
+        scores = self._scores(self.store_path(session_id), store['count'], store['dim'], query_vector)
+        
+        with get_db() as conn:
+            conditions, params = ['session_id = ?'], [session_id]
+            if kind:
+                conditions.append('kind = ?')
+                params.append(kind)
+            if content_hash:
+                conditions.append('content_hash = ?')
+                params.append(content_hash)
+            entries = {row['row_index']: row for row in conn.execute(
+                f'''SELECT row_index, kind, source_id, content_hash, chunk_index, text
+                    FROM embedding_entries WHERE {' AND '.join(conditions)}''',
+                params
+            )}
+        
+        excluded = set(exclude_sources)
+        candidates = (
+            (score, row_index) for row_index, score in enumerate(scores)
+            if row_index in entries and (min_score is None or score >= min_score)
+            and not (entries[row_index]['kind'] == 'message' and entries[row_index]['source_id'] in excluded)
+        )
+        results = []
+        for score, row_index in heapq.nlargest(top_k, candidates):
+            result = dict(entries[row_index])
+            result['score'] = round(score, 4)
+            results.append(result)
+        return results
+    
+    def _reset(self, conn, session_id):
+        conn.execute('DELETE FROM embedding_entries WHERE session_id = ?', (session_id,))
+        conn.execute('DELETE FROM embedding_stores WHERE session_id = ?', (session_id,))
+        conn.commit()
+        path = self.store_path(session_id)
+        if os.path.exists(path):
+            os.remove(path)
+    
+    def delete(self, session_id):
+        """Drop a session's vectors and their metadata"""
+        with self._write_lock, get_db() as conn:
+            self._reset(conn, session_id)
+
+
+class ConversationSummarizer:
+    """Background worker that keeps sessions.summary up to date for long chats"""
+    def __init__(self, client, model=SUMMARY_MODEL, keep_recent=SUMMARY_KEEP_RECENT, trigger=SUMMARY_TRIGGER):
+        self.client = client
+        self.model = model
+        self.keep_recent = keep_recent
+        self.trigger = trigger
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    @property
+    def enabled(self):
+        return bool(self.model)
+    
+    def schedule(self, session_id):
+        """Queue a session for summarization; duplicate requests are merged"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if session_id in self._pending:
+                return
+            self._pending.add(session_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='conversation-summarizer', daemon=True)
+                self._thread.start()
+        self._queue.put(session_id)
+    
+    def _run(self):
+        while True:
+            session_id = self._queue.get()
+            with self._lock:
+                self._pending.discard(session_id)
+            try:
+                self.summarize(session_id)
+            except Exception as e:
+                print(f"Error summarizing session {session_id}: {e}")
+    
+    def summarize(self, session_id, force=False):
+        """Fold older unsummarized messages into the session summary"""
+        summary, summary_message_id = get_session_summary(session_id)
+        
+        with get_db() as conn:
+            rows = conn.execute(
+                '''SELECT m.id, m.role, m.content, fa.original_filename
+                   FROM messages m
+                   LEFT JOIN file_attachments fa ON m.id = fa.message_id
+                   WHERE m.session_id = ? AND m.id > ?
+                   ORDER BY m.id''',
+                (session_id, summary_message_id or 0)
+            ).fetchall()
+        
+        # The latest turns stay verbatim in the prompt
+        older = rows[:-self.keep_recent] if self.keep_recent else rows
+        if not older or (len(older) < self.trigger and not force):
+            return False
+        
+        transcript = []
+        for row in older:
+            line = f"{row['role'].title()}: {truncate_to_tokens(row['content'], 300)}"
+            if row['original_filename']:
+                line += f" [attached file: {row['original_filename']}]"
+            transcript.append(line)
+        
+        prompt = (
+            "Update the running summary of a conversation. Keep facts, decisions, open questions, "
+            "names of files discussed and user preferences. Be concise (under 200 words).\n\n"
+            f"Current summary:\n{summary or '(none)'}\n\n"
+            "New messages:\n" + "\n".join(transcript)
+        )
+        with generation_scheduler.acquire(self.model, '__summarizer__'):
+            response = self.client.chat(self.model, [{'role': 'user', 'content': prompt}])
+        new_summary = response.get('message', {}).get('content', '').strip()
+        if not new_summary:
+            return False
+        
+        with get_db() as conn:
+            conn.execute(
+                'UPDATE sessions SET summary = ?, summary_message_id = ? WHERE id = ?',
+                (new_summary, older[-1]['id'], session_id)
+            )
+            conn.commit()
+        print(f"Summarized {len(older)} messages for session {session_id[:8]}")
+        return True
 
-Please analyze this file and respond to my question. Format your response professionally using:
-- **Bold text** for emphasis and important findings
-- *Italic text* for explanations or definitions
-- `code snippets` for technical terms and functions
-- ```language blocks``` for code examples
-- ## Headings to organize your analysis
-- Tables with | pipes | for | data summary | or | comparisons |
-- Bullet points and numbered lists for clarity
-- Links [like this](url) when referencing external resources
-- When analyzing spreadsheet data, present key findings in table format"""
+conversation_summarizer = ConversationSummarizer(ollama_client)
+embedding_index = EmbeddingIndex(ollama_client)
 
 # Database functions (same as before)
 def get_db():
@@ -805,6 +3926,7 @@ def init_db():
                 file_name TEXT,
                 file_type TEXT,
                 formatted_content TEXT,
+                prompt_content TEXT,
                 FOREIGN KEY (session_id) REFERENCES sessions (id)
             );
             
@@ -821,6 +3943,93 @@ def init_db():
                 FOREIGN KEY (message_id) REFERENCES messages (id)
             );
         ''')
+        
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS extraction_cache (
+                content_hash TEXT NOT NULL,
+                extractor_version INTEGER NOT NULL,
+                file_ext TEXT NOT NULL DEFAULT '',
+                processed_content TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (content_hash, extractor_version, file_ext)
+            );
+            
+            CREATE TABLE IF NOT EXISTS embedding_stores (
+                session_id TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                dim INTEGER NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0
+            );
+            
+            CREATE TABLE IF NOT EXISTS embedding_entries (
+                session_id TEXT NOT NULL,
+                row_index INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                source_id INTEGER,
+                content_hash TEXT,
+                chunk_index INTEGER,
+                text TEXT,
+                PRIMARY KEY (session_id, row_index)
+            );
+            
+            CREATE INDEX IF NOT EXISTS idx_embedding_entries_source
+                ON embedding_entries (session_id, kind, source_id);
+            
+            CREATE TABLE IF NOT EXISTS image_encodings (
+                content_hash TEXT NOT NULL,
+                max_edge INTEGER NOT NULL,
+                quality INTEGER NOT NULL,
+                width INTEGER,
+                height INTEGER,
+                data TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (content_hash, max_edge, quality)
+            );
+            
+            CREATE TABLE IF NOT EXISTS pdf_page_cache (
+                content_hash TEXT NOT NULL,
+                extractor_version INTEGER NOT NULL,
+                page_number INTEGER NOT NULL,
+                text TEXT,
+                PRIMARY KEY (content_hash, extractor_version, page_number)
+            );
+        ''')
+        
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS document_index (
+                content_hash TEXT PRIMARY KEY,
+                extractor_version INTEGER NOT NULL,
+                chunk_count INTEGER NOT NULL,
+                indexed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        try:
+            conn.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS document_chunks USING fts5(
+                    content, content_hash UNINDEXED, chunk_index UNINDEXED, start_offset UNINDEXED,
+                    tokenize = 'porter unicode61'
+                )
+            ''')
+        except sqlite3.OperationalError as e:
+            # SQLite built without FTS5: attachments are truncated instead
+            print(f"WARNING: Document retrieval disabled ({e})")
+            document_index.available = False
+        
+        # Migrate databases created before rolling summaries were added
+        session_columns = [row['name'] for row in conn.execute('PRAGMA table_info(sessions)')]
+        if 'summary_message_id' not in session_columns:
+            conn.execute('ALTER TABLE sessions ADD COLUMN summary_message_id INTEGER DEFAULT 0')
+        
+        # Migrate databases created before user turns were replayed verbatim
+        message_columns = [row['name'] for row in conn.execute('PRAGMA table_info(messages)')]
+        if 'prompt_content' not in message_columns:
+            conn.execute('ALTER TABLE messages ADD COLUMN prompt_content TEXT')
+        
+        # Migrate databases created before content-addressed uploads
+        attachment_columns = [row['name'] for row in conn.execute('PRAGMA table_info(file_attachments)')]
+        if 'content_hash' not in attachment_columns:
+            conn.execute('ALTER TABLE file_attachments ADD COLUMN content_hash TEXT')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_file_attachments_hash ON file_attachments (content_hash)')
         conn.commit()
 
 # Routes
@@ -830,95 +4039,299 @@ def index():
     file_accept = ','.join(f'.{ext}' for ext in sorted(ALLOWED_EXTENSIONS))
     return render_template('index.html', file_accept=file_accept)
 
+def store_uploaded_file(uploaded_file):
+    """Save an uploaded file without extracting it; returns a file_info dict"""
+    filename = secure_filename(uploaded_file.filename)
+    
+    # Stored by content hash: repeat uploads reuse the blob and the cached extraction
+    content_hash, file_path, file_size, existed = upload_store.save(uploaded_file, filename)
+    if existed:
+        print(f"Upload {filename} already stored as {os.path.basename(file_path)}")
+    
+    mime_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    
+    return {
+        'filename': os.path.basename(file_path),
+        'original_filename': filename,
+        'file_path': file_path,
+        'file_size': file_size,
+        'mime_type': mime_type,
+        'processed_content': None,
+        'content_hash': content_hash
+    }
+
+def save_uploaded_file(uploaded_file):
+    """Save an uploaded file and extract its content"""
+    file_info = store_uploaded_file(uploaded_file)
+    file_info['processed_content'] = extract_file_content(
+        file_info['file_path'], file_info['original_filename'], file_info['mime_type'], file_info['content_hash']
+    )
+    return file_info
+
+def get_chat_file_info(uploaded_file):
+    """Resolve the chat attachment from an inline file or an upload_id
+    
+    Returns (file_info, error_response); an upload_id waits for its
+    background extraction to finish.
+    """
+    if uploaded_file and uploaded_file.filename != '':
+        if not allowed_file(uploaded_file.filename):
+            return None, (jsonify({'success': False, 'error': 'File type not allowed'}), 400)
+        return save_uploaded_file(uploaded_file), None
+    
+    upload_id = get_request_field('upload_id')
+    if not upload_id:
+        return None, None
+    
+    try:
+        job = extraction_jobs.wait(upload_id)
+    except TimeoutError as e:
+        return None, (jsonify({'success': False, 'error': str(e)}), 504)
+    if job is None:
+        return None, (jsonify({'success': False, 'error': 'Upload not found'}), 404)
+    if job.status == 'failed':
+        return None, (jsonify({'success': False, 'error': f"Extraction failed: {job.error}"}), 422)
+    return dict(job.file_info), None
+
+def parse_chat_request():
+    """Read message, model and optional file from a JSON or form chat request"""
+    if request.is_json:
+        data = request.get_json()
+        user_message = data.get('message', '').strip()
+        model = data.get('model', 'llama2')
+        uploaded_file = None
+    else:
+        user_message = request.form.get('message', '').strip()
+        model = request.form.get('model', 'llama2')
+        uploaded_file = request.files.get('file')
+    return user_message, model, uploaded_file
+
+def get_request_field(name, default=None):
+    """Read an optional field from a JSON or form chat request"""
+    if request.is_json:
+        return (request.get_json(silent=True) or {}).get(name, default)
+    return request.form.get(name, default)
+
+def get_request_flag(name):
+    """Read a boolean flag from a JSON or form chat request"""
+    value = get_request_field(name, False)
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+def get_generation_options():
+    """Read Ollama generation options (temperature, seed, num_ctx...) from the request"""
+    options = get_request_field('options')
+    if isinstance(options, str):
+        options = json.loads(options) if options.strip() else None
+    return options or None
+
+def scheduled_ollama_chat(model, messages, options=None, keep_alive=None, session_id=None, cancel_event=None):
+    """Send a chat to Ollama once a generation slot for the model is free"""
+    with generation_scheduler.acquire(model, session_id, cancel_event=cancel_event):
+        return ollama_client.chat(model, messages, options, keep_alive, cancel_event)
+
+def cached_ollama_chat(model, messages, options=None, use_cache=True, keep_alive=None, session_id=None,
+                       cancel_event=None):
+    """Send a chat to Ollama through the response cache; returns (response, cache_hit)"""
+    use_cache = use_cache and response_cache.enabled
+    cache_key = response_cache.make_key(model, messages, options)
+    if use_cache:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return cached, True
+    
+    # Identical requests already in flight share a single generation
+    response = chat_single_flight.do(
+        cache_key, lambda: scheduled_ollama_chat(model, messages, options, keep_alive, session_id, cancel_event),
+        cancel_event
+    )
+    
+    if use_cache:
+        response_cache.set(cache_key, model, response)
+    return response, False
+
+def generate_chat_response(model, messages, session_id=None, options=None, use_cache=True,
+                           keep_alive=None, cancel_event=None):
+    """Generate a reply with Claude Code or Ollama; returns (response, cache_hit)"""
+    if model == CLAUDE_CODE_MODEL and claude_code_client.available:
+        # Claude Code runs on the shared event loop; tool use makes it uncacheable
+        with generation_scheduler.acquire(model, session_id, cancel_event=cancel_event):
+            response = claude_code_client.chat_sync(
+                messages, ["Read", "Write", "Bash", "Grep"], cancel_event=cancel_event
+            )
+        return response, False
+    
+    # Ollama, answered from the response cache when enabled
+    return cached_ollama_chat(model, messages, options, use_cache, keep_alive, session_id, cancel_event)
+
+def describe_generation(response, started):
+    """Latency and token statistics for a finished generation"""
+    eval_count = response.get('eval_count')
+    eval_duration = response.get('eval_duration')  # Nanoseconds
+    return {
+        'timing': {
+            'total_time': round(time.time() - started, 3),
+            'load_time': round(response['load_duration'] / 1e9, 3) if response.get('load_duration') else None,
+            'prompt_time': round(response['prompt_eval_duration'] / 1e9, 3) if response.get('prompt_eval_duration') else None
+        },
+        'tokens': {
+            'prompt_tokens': response.get('prompt_eval_count'),
+            'completion_tokens': eval_count,
+            'tokens_per_second': round(eval_count / (eval_duration / 1e9), 2) if eval_count and eval_duration else None
+        }
+    }
+
+def get_requested_models():
+    """Models listed in the 'models' field (list or comma separated) for fan-out"""
+    models = get_request_field('models') or []
+    if isinstance(models, str):
+        models = models.split(',')
+    # Keep order, drop blanks and duplicates
+    return list(dict.fromkeys(m.strip() for m in models if m and m.strip()))
+
+def get_chat_session_id():
+    """Return the current chat session id, creating the session if needed"""
+    if 'session_id' not in session:
+        session['session_id'] = create_session()
+    
+    session_id = session['session_id']
+    create_session(session_id)
+    return session_id
+
+def build_chat_messages(session_id, model, user_message, file_info, user_message_id=None):
+    """Build the message list sent to the model for the latest user turn"""
+    messages, context_info = context_builder.build(
+        session_id, model, user_message, file_info, exclude_message_id=user_message_id
+    )
+    if user_message_id and messages[-1]['content'] != user_message:
+        save_prompt_content(user_message_id, messages[-1]['content'])
+    print(f"Context for {model}: ~{context_info['prompt_tokens']}/{context_info['budget']} tokens, "
+          f"{context_info['history_messages']} history messages, "
+          f"{context_info['prefix_messages']} leading messages reused")
+    return messages, context_info
+
+def queue_full_response(error):
+    """429 response telling the client when to retry"""
+    response = jsonify({'success': False, 'error': str(error), 'retry_after': error.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def sse_event(data):
+    """Encode a dict as a Server-Sent Events data frame"""
+    return f"data: {json.dumps(data)}\n\n"
+
+def fanout_chat(session_id, models, user_message, file_info):
+    """Ask several models the same question at once, streaming NDJSON results as each finishes"""
+    if len(models) > FANOUT_MAX_MODELS:
+        return jsonify({'success': False, 'error': f'At most {FANOUT_MAX_MODELS} models per comparison'}), 400
+    
+    user_message_id = add_message(session_id, 'user', user_message, ', '.join(models), file_info)
+    options = get_generation_options()
+    keep_alive = get_request_field('keep_alive')
+    use_cache = not get_request_flag('no_cache')
+    # Build every prompt before any answer is saved, so no model sees another's reply;
+    # each model gets history fitted to its own context budget
+    prompts = {}
+    for model in models:
+        try:
+            prompts[model] = build_chat_messages(session_id, model, user_message, file_info, user_message_id)
+        except Exception as e:
+            prompts[model] = e
+    watcher = DisconnectWatcher(request.environ).start()
+    
+    def run_model(model):
+        started = time.time()
+        result = {'model': model}
+        try:
+            if isinstance(prompts[model], Exception):
+                raise prompts[model]
+            messages, context_info = prompts[model]
+            response, cache_hit = generate_chat_response(
+                model, messages, session_id, options, use_cache, keep_alive, cancel_event=watcher.cancelled
+            )
+            assistant_message = response.get('message', {}).get('content', 'No response received')
+            add_message(session_id, 'assistant', assistant_message, model)
+            result.update({
+                'success': True,
+                'message': {
+                    'content': assistant_message,
+                    'formatted_content': formatter.format_response(assistant_message)
+                },
+                'cached': cache_hit,
+                'context': context_info
+            })
+            result.update(describe_generation(response, started))
+        except GenerationCancelled:
+            result.update({'success': False, 'error': 'Request cancelled'})
+        except Exception as e:
+            print(f"ERROR: Fan-out to {model} failed: {e}")
+            add_message(session_id, 'assistant', f"Error: {e}", model)
+            result.update({'success': False, 'error': str(e), 'timing': {'total_time': round(time.time() - started, 3)}})
+        return result
+    
+    def generate():
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(models), thread_name_prefix='fanout')
+        try:
+            futures = [executor.submit(run_model, model) for model in models]
+            for future in concurrent.futures.as_completed(futures):
+                yield json.dumps(future.result()) + "\n"
+            conversation_summarizer.schedule(session_id)
+        except GeneratorExit:
+            print(f"Fan-out cancelled for session {session_id}: client disconnected")
+        finally:
+            watcher.cancelled.set()
+            watcher.stop()
+            executor.shutdown(wait=False)
+    
+    response = Response(generate(), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+    response.call_on_close(watcher.stop)
+    return response
+
 @app.route('/api/chat', methods=['POST'])
 def chat():
     try:
         # Handle both JSON and form data
-        if request.is_json:
-            data = request.get_json()
-            user_message = data.get('message', '').strip()
-            model = data.get('model', 'llama2')
-            uploaded_file = None
-        else:
-            user_message = request.form.get('message', '').strip()
-            model = request.form.get('model', 'llama2')
-            uploaded_file = request.files.get('file')
+        user_message, model, uploaded_file = parse_chat_request()
         
-        if not user_message.strip() and not uploaded_file:
+        if not user_message.strip() and not uploaded_file and not get_request_field('upload_id'):
             return jsonify({'success': False, 'error': 'Empty message and no file'}), 400
         
         # Session management
-        if 'session_id' not in session:
-            session['session_id'] = create_session()
-        
-        session_id = session['session_id']
-        create_session(session_id)
-        
-        file_info = None
-        file_content = ""
-        
-        # Process uploaded file if present
-        if uploaded_file and uploaded_file.filename != '':
-            if allowed_file(uploaded_file.filename):
-                filename = secure_filename(uploaded_file.filename)
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                unique_filename = f"{timestamp}_{filename}"
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                
-                uploaded_file.save(file_path)
-                
-                # Get file info
-                file_size = os.path.getsize(file_path)
-                mime_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
-                
-                # Process file content
-                processed_content = file_processor.process_file(file_path, filename, mime_type)
-                
-                file_info = {
-                    'filename': unique_filename,
-                    'original_filename': filename,
-                    'file_path': file_path,
-                    'file_size': file_size,
-                    'mime_type': mime_type,
-                    'processed_content': processed_content
-                }
-                
-                file_content = processed_content
-            else:
-                return jsonify({'success': False, 'error': 'File type not allowed'}), 400
+        session_id = get_chat_session_id()
         
-        # Save user message to database
-        add_message(session_id, 'user', user_message, model, file_info)
+        # Process uploaded file (or wait for a background upload) if present
+        file_info, error_response = get_chat_file_info(uploaded_file)
+        if error_response:
+            return error_response
         
-        # Get recent messages for context
-        recent_messages = get_recent_messages(session_id, limit=10)
+        # Several models requested: ask them all at once
+        models = get_requested_models()
+        if len(models) > 1:
+            return fanout_chat(session_id, models, user_message, file_info)
         
-        # Prepare the prompt
-        if file_content:
-            enhanced_message = enhance_prompt_with_file(user_message, file_content, file_info['original_filename'])
-        else:
-            enhanced_message = enhance_prompt(user_message)
+        # Save user message to database
+        user_message_id = add_message(session_id, 'user', user_message, model, file_info)
         
-        # Prepare messages for AI model
-        messages = recent_messages[:-1]  # Exclude the current message
-        messages.append({'role': 'user', 'content': enhanced_message})
+        # Fit recent history into the model's context budget
+        messages, context_info = build_chat_messages(session_id, model, user_message, file_info, user_message_id)
+        options = get_generation_options()
+        keep_alive = get_request_field('keep_alive')
+        use_cache = not get_request_flag('no_cache')
+        cache_hit = False
         
         # Determine which AI service to use
+        watcher = DisconnectWatcher(request.environ).start()
         try:
-            if model == CLAUDE_CODE_MODEL and claude_code_client.available:
-                # Send to Claude Code (async)
-                async def claude_chat():
-                    return await claude_code_client.chat(messages, ["Read", "Write", "Bash", "Grep"])
-                
-                response = anyio.run(claude_chat)
-                assistant_message = response.get('message', {}).get('content', 'No response received')
-            else:
-                # Send to Ollama
-                response = ollama_client.chat(model, messages)
-                assistant_message = response.get('message', {}).get('content', 'No response received')
+            response, cache_hit = generate_chat_response(
+                model, messages, session_id, options, use_cache, keep_alive, cancel_event=watcher.cancelled
+            )
+            assistant_message = response.get('message', {}).get('content', 'No response received')
             
             # Save assistant response to database
             add_message(session_id, 'assistant', assistant_message, model)
+            conversation_summarizer.schedule(session_id)
             
             # Format the response
             formatted_content = formatter.format_response(assistant_message)
@@ -928,9 +4341,19 @@ def chat():
                 'message': {
                     'content': assistant_message,
                     'formatted_content': formatted_content
-                }
+                },
+                'cached': cache_hit,
+                'context': context_info
             })
             
+        except QueueFullError as e:
+            # The client retries after Retry-After, which saves the question again
+            delete_message(user_message_id)
+            return queue_full_response(e)
+        except GenerationCancelled:
+            # Nobody is waiting for this answer, so nothing is saved
+            print(f"Chat cancelled for session {session_id}: client disconnected")
+            return jsonify({'success': False, 'error': 'Request cancelled'}), 499
         except Exception as e:
             error_message = str(e)
             print(f"ERROR: Chat endpoint exception: {error_message}")
@@ -941,18 +4364,386 @@ def chat():
             
             add_message(session_id, 'assistant', f"Error: {error_message}", model)
             return jsonify({'success': False, 'error': error_message}), 500
+        finally:
+            watcher.stop()
+            
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """Stream the assistant response token by token as Server-Sent Events"""
+    user_message_id = None
+    watcher = None
+    slot = None
+    subscription = None
+    try:
+        user_message, model, uploaded_file = parse_chat_request()
+        
+        if not user_message.strip() and not uploaded_file and not get_request_field('upload_id'):
+            return jsonify({'success': False, 'error': 'Empty message and no file'}), 400
+        
+        session_id = get_chat_session_id()
+        
+        file_info, error_response = get_chat_file_info(uploaded_file)
+        if error_response:
+            return error_response
+        
+        user_message_id = add_message(session_id, 'user', user_message, model, file_info)
+        messages, context_info = build_chat_messages(session_id, model, user_message, file_info, user_message_id)
+        options = get_generation_options()
+        keep_alive = get_request_field('keep_alive')
+        use_cache = not get_request_flag('no_cache') and response_cache.enabled
+        
+        cache_key = response_cache.make_key(model, messages, options) if use_cache else None
+        cached = None
+        if cache_key and model != CLAUDE_CODE_MODEL:
+            cached = response_cache.get(cache_key)
+        
+        # Wait for a generation slot before the stream starts, so overload is a plain 429
+        watcher = DisconnectWatcher(request.environ).start()
+        if cached is None and model == CLAUDE_CODE_MODEL and claude_code_client.available:
+            slot = generation_scheduler.acquire(model, session_id, cancel_event=watcher.cancelled)
+        elif cached is None:
+            # An identical stream already generating is shared instead of sent again
+            flight_key = cache_key or response_cache.make_key(model, messages, options)
+            shared, subscription, leader = chat_stream_flight.join(flight_key)
+            if leader:
+                try:
+                    stream_slot = generation_scheduler.acquire(model, session_id, cancel_event=watcher.cancelled)
+                except Exception as e:
+                    subscription.close()
+                    chat_stream_flight.abandon(flight_key, shared, e)
+                    raise
+                
+                def save_to_cache(chunks):
+                    if cache_key:
+                        response = dict(next((chunk for chunk in reversed(chunks) if chunk.get('done')), {}))
+                        content = "".join(chunk.get('message', {}).get('content', '') for chunk in chunks)
+                        response['message'] = {'role': 'assistant', 'content': content}
+                        response_cache.set(cache_key, model, response)
+                
+                # The stream's reader thread releases the slot when generation ends
+                chat_stream_flight.start(
+                    flight_key, shared, lambda: ollama_client.chat_stream(model, messages, options, keep_alive),
+                    stream_slot, save_to_cache
+                )
+    except QueueFullError as e:
+        watcher.stop()
+        # The client retries after Retry-After, which saves the question again
+        delete_message(user_message_id)
+        return queue_full_response(e)
+    except GenerationCancelled:
+        watcher.stop()
+        print(f"Chat stream cancelled for session {session_id}: client disconnected while queued")
+        return jsonify({'success': False, 'error': 'Request cancelled'}), 499
+    except Exception as e:
+        # No stream will start: release what this turn holds and drop its unanswered question
+        print(f"ERROR: Chat stream failed to start: {e}")
+        if watcher:
+            watcher.stop()
+        if subscription:
+            subscription.close()
+        if slot:
+            slot.release()
+        delete_message(user_message_id)
+        return jsonify({'success': False, 'error': str(e)}), 500
+    
+    def generate():
+        started = time.time()
+        first_token_at = None
+        parts = []
+        cache_hit = False
+        try:
+            if cached is not None:
+                # Cache hit: replay the stored answer as a single chunk
+                content = cached.get('message', {}).get('content', '')
+                cache_hit = True
+                first_token_at = time.time()
+                parts.append(content)
+                yield sse_event({'type': 'token', 'content': content})
+            elif model == CLAUDE_CODE_MODEL and claude_code_client.available:
+                # Claude Code has no token stream; send the whole answer as one chunk
+                response = claude_code_client.chat_sync(
+                    messages, ["Read", "Write", "Bash", "Grep"], cancel_event=watcher.cancelled
+                )
+                content = response.get('message', {}).get('content', 'No response received')
+                first_token_at = time.time()
+                parts.append(content)
+                yield sse_event({'type': 'token', 'content': content})
+            else:
+                # Upstream stops generating once every subscriber has left
+                for chunk in subscription.chunks(watcher.cancelled):
+                    token = chunk.get('message', {}).get('content', '')
+                    if token:
+                        if first_token_at is None:
+                            first_token_at = time.time()
+                        parts.append(token)
+                        yield sse_event({'type': 'token', 'content': token})
+            
+            # Generation is over; let the next queued request in
+            if slot:
+                slot.release()
+            
+            assistant_message = "".join(parts) or 'No response received'
+            
+            # Persist the final message once the stream is complete
+            add_message(session_id, 'assistant', assistant_message, model)
+            conversation_summarizer.schedule(session_id)
+            
+            yield sse_event({
+                'type': 'done',
+                'content': assistant_message,
+                'formatted_content': formatter.format_response(assistant_message),
+                'time_to_first_token': round(first_token_at - started, 3) if first_token_at else None,
+                'total_time': round(time.time() - started, 3),
+                'cached': cache_hit,
+                'context': context_info
+            })
+        except (GenerationCancelled, GeneratorExit):
+            # Client went away mid-answer: stop upstream work and don't save the orphaned answer
+            print(f"Chat stream cancelled for session {session_id}: client disconnected")
+        except Exception as e:
+            error_message = str(e)
+            print(f"ERROR: Chat stream exception: {error_message}")
+            add_message(session_id, 'assistant', f"Error: {error_message}", model)
+            yield sse_event({'type': 'error', 'error': error_message})
+        finally:
+            watcher.stop()
+            if subscription:
+                subscription.close()
+            if slot:
+                slot.release()
+    
+    response = Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # Also covers a client that disconnects before the stream starts
+    response.call_on_close(watcher.stop)
+    if slot:
+        response.call_on_close(slot.release)
+    if subscription:
+        response.call_on_close(subscription.close)
+    return response
+
+def load_batch_file(job):
+    """Return (filename, processed content) for a batch job's file reference, if any"""
+    if job.get('file_id') is not None:
+        with get_db() as conn:
+            row = conn.execute(
+                'SELECT original_filename, processed_content FROM file_attachments WHERE id = ?',
+                (job['file_id'],)
+            ).fetchone()
+        if not row:
+            raise ValueError(f"File attachment {job['file_id']} not found")
+        return row['original_filename'], row['processed_content'] or ''
+    
+    if job.get('file'):
+        stored = upload_store.find(job['file'])
+        if not stored:
+            raise ValueError(f"File {job['file']} not found among stored uploads")
+        file_path, filename, mime_type, digest = stored
+        return filename, extract_file_content(file_path, filename, mime_type, digest)
+    
+    if job.get('file_hash'):
+        # A previously uploaded blob, referenced by its SHA-256 digest
+        digest = job['file_hash'].lower()
+        if not re.fullmatch(r'[0-9a-f]{64}', digest):
+            raise ValueError("file_hash must be a SHA-256 hex digest")
+        with get_db() as conn:
+            row = conn.execute(
+                'SELECT original_filename, file_path, mime_type FROM file_attachments WHERE content_hash = ? LIMIT 1',
+                (digest,)
+            ).fetchone()
+        if not row or not os.path.isfile(row['file_path']):
+            raise ValueError(f"No stored upload with hash {digest}")
+        return row['original_filename'], extract_file_content(
+            row['file_path'], row['original_filename'], row['mime_type'], digest
+        )
+    
+    return None, None
+
+def build_batch_messages(job, model):
+    """Build the message list for a batch job from messages or message + file"""
+    if job.get('messages'):
+        return [{'role': m['role'], 'content': m['content']} for m in job['messages']]
+    
+    user_message = job.get('message', '')
+    filename, file_content = load_batch_file(job)
+    if filename:
+        budget = context_builder.get_budget(model)
+        question_tokens = estimate_tokens(FORMATTING_SYSTEM_PROMPT) + \
+            estimate_tokens(enhance_prompt_with_file(user_message, '', filename))
+        user_message = enhance_prompt_with_file(
+            user_message, truncate_to_tokens(file_content, budget - question_tokens, TEXT_EXCERPT_MODE), filename
+        )
+    if not user_message:
+        raise ValueError("Job needs 'messages', 'message' or a file reference")
+    return [
+        {'role': 'system', 'content': FORMATTING_SYSTEM_PROMPT},
+        {'role': 'user', 'content': user_message}
+    ]
+
+def validate_batch_job(job):
+    """Reason a batch job is malformed, or None if it can be run"""
+    if not isinstance(job, dict):
+        return "must be an object"
+    messages = job.get('messages')
+    if messages is not None:
+        if not isinstance(messages, list) or not all(
+            isinstance(m, dict) and isinstance(m.get('role'), str) and isinstance(m.get('content'), str)
+            for m in messages
+        ):
+            return "'messages' must be a list of {role, content} objects"
+    for field in ('message', 'model', 'file', 'file_hash'):
+        if job.get(field) is not None and not isinstance(job[field], str):
+            return f"'{field}' must be a string"
+    if job.get('file_id') is not None and (isinstance(job['file_id'], bool) or not isinstance(job['file_id'], int)):
+        return "'file_id' must be an integer"
+    if job.get('options') is not None and not isinstance(job['options'], dict):
+        return "'options' must be an object"
+    return None
+
+def run_batch_job(batch_id, index, job, defaults, cancel_event):
+    """Run one batch job and return its result record"""
+    model = job.get('model') or defaults.get('model') or 'llama2'
+    result = {'index': index, 'id': job.get('id', index), 'model': model}
+    started = time.time()
+    try:
+        messages = build_batch_messages(job, model)
+        options = job.get('options') or defaults.get('options')
+        
+        for attempt in range(3):
+            try:
+                response, cache_hit = generate_chat_response(
+                    model, messages, batch_id, options, not job.get('no_cache'), cancel_event=cancel_event
+                )
+                break
+            except QueueFullError as e:
+                # Batch work can wait; back off and retry rather than failing the item
+                if attempt == 2:
+                    raise
+                time.sleep(min(e.retry_after, 30))
+        
+        result.update({
+            'success': True,
+            'content': response.get('message', {}).get('content', ''),
+            'cached': cache_hit
+        })
+        result.update(describe_generation(response, started))
+    except Exception as e:
+        result.update({
+            'success': False,
+            'error': str(e),
+            'timing': {'total_time': round(time.time() - started, 3)}
+        })
+    return result
+
+@app.route('/api/batch', methods=['POST'])
+def batch_chat():
+    """Run many chat jobs with bounded parallelism, streaming results as NDJSON"""
+    try:
+        data = request.get_json(silent=True) or {}
+        jobs = data.get('jobs') if isinstance(data, dict) else None
+        if not isinstance(jobs, list) or not jobs:
+            return jsonify({'success': False, 'error': 'jobs must be a non-empty list'}), 400
+        if len(jobs) > BATCH_MAX_JOBS:
+            return jsonify({'success': False, 'error': f'At most {BATCH_MAX_JOBS} jobs per batch'}), 400
+        # Reject malformed jobs before any run, so one bad entry cannot end the stream
+        for index, job in enumerate(jobs):
+            problem = validate_batch_job(job)
+            if problem:
+                return jsonify({'success': False, 'error': f'Job {index}: {problem}'}), 400
+        
+        try:
+            concurrency = max(1, min(int(data.get('concurrency', 4)), BATCH_MAX_CONCURRENCY))
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'concurrency must be an integer'}), 400
+        defaults = {'model': data.get('model'), 'options': data.get('options')}
+        # All jobs of a batch share one scheduler queue, so interactive users still get turns
+        batch_id = f"batch-{uuid.uuid4()}"
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    
+    watcher = DisconnectWatcher(request.environ).start()
+    
+    def generate():
+        started = time.time()
+        succeeded = 0
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch')
+        futures = []
+        try:
+            futures = [
+                executor.submit(run_batch_job, batch_id, index, job, defaults, watcher.cancelled)
+                for index, job in enumerate(jobs)
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                result = future.result()
+                succeeded += 1 if result['success'] else 0
+                yield json.dumps(result) + "\n"
             
+            yield json.dumps({
+                'summary': True,
+                'batch_id': batch_id,
+                'jobs': len(jobs),
+                'succeeded': succeeded,
+                'failed': len(jobs) - succeeded,
+                'total_time': round(time.time() - started, 3)
+            }) + "\n"
+        except GeneratorExit:
+            print(f"Batch {batch_id} cancelled: client disconnected")
+        finally:
+            # Stop running jobs and drop the ones not started yet
+            watcher.cancelled.set()
+            watcher.stop()
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+    
+    response = Response(generate(), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+    response.call_on_close(watcher.stop)
+    return response
+
+@app.route('/api/uploads', methods=['POST'])
+def create_upload():
+    """Store a file and extract its content in the background"""
+    try:
+        uploaded_file = request.files.get('file')
+        if not uploaded_file or uploaded_file.filename == '':
+            return jsonify({'success': False, 'error': 'No file provided'}), 400
+        if not allowed_file(uploaded_file.filename):
+            return jsonify({'success': False, 'error': 'File type not allowed'}), 400
+        
+        job = extraction_jobs.submit(store_uploaded_file(uploaded_file))
+        return jsonify({'success': True, 'upload': job.to_dict()}), 202
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    """Poll the status and progress of a background extraction"""
+    job = extraction_jobs.get(upload_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Upload not found'}), 404
+    return jsonify({'success': True, 'upload': job.to_dict()})
+
+@app.route('/api/extraction', methods=['GET'])
+def extraction_status():
+    """Extraction worker pool and background job counters"""
+    return jsonify({
+        'success': True,
+        'pool': extraction_pool.stats(),
+        'jobs': extraction_jobs.stats()
+    })
+
 @app.route('/api/models', methods=['GET'])
 def get_models():
     try:
-        models_data = ollama_client.list_models()
-        models = []
-        
-        if models_data.get('models'):
-            models = [model['name'] for model in models_data['models']]
+        # Served from the in-memory catalog; refreshed in the background
+        catalog_models, age = model_catalog.snapshot()
+        models = [model['name'] for model in catalog_models]
         
         # If no models found, return default models
         if not models:
@@ -965,13 +4756,40 @@ def get_models():
             # Show Claude Code as disabled if SDK is available but no API key
             models.append(f"{CLAUDE_CODE_MODEL} (API key required)")
             
-        return jsonify({'success': True, 'models': models})
+        return jsonify({
+            'success': True,
+            'models': models,
+            'age': round(age, 1) if age is not None else None,
+            'error': model_catalog.last_error
+        })
     except Exception as e:
         models = DEFAULT_MODELS.copy()
         if claude_code_client.available:
             models.append(CLAUDE_CODE_MODEL)
         return jsonify({'success': True, 'models': models})
 
+@app.route('/api/models/refresh', methods=['POST'])
+def refresh_models():
+    try:
+        model_catalog.invalidate()
+        return jsonify({'success': True})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/backends', methods=['GET'])
+def get_backends():
+    try:
+        return jsonify({'success': True, 'backends': ollama_client.status()})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/scheduler', methods=['GET'])
+def get_scheduler_stats():
+    try:
+        return jsonify({'success': True, 'models': generation_scheduler.stats()})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/sessions', methods=['GET'])
 def get_sessions():
     try:
@@ -986,7 +4804,8 @@ def get_sessions():
                 'created_at': session_data['created_at'],
                 'last_active': session_data['last_active'],
                 'message_count': session_data['message_count'] or 0,
-                'last_message': session_data['last_message'] or 'No messages'
+                'last_message': session_data['last_message'] or 'No messages',
+                'summary': session_data.get('summary')
             })
         
         return jsonify({'success': True, 'sessions': formatted_sessions})
@@ -1016,16 +4835,47 @@ def load_session(session_id):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/session/<session_id>/search', methods=['POST'])
+def search_session(session_id):
+    """Semantic search over a session's messages and attachments"""
+    if not embedding_index.enabled:
+        return jsonify({'success': False, 'error': 'Semantic search is disabled. Set EMBEDDING_MODEL to enable it.'}), 400
+    
+    data = request.get_json(silent=True) or {}
+    query = (data.get('query') or '').strip()
+    if not query:
+        return jsonify({'success': False, 'error': 'No query provided'}), 400
+    kind = data.get('kind')
+    if kind not in (None, 'message', 'chunk'):
+        return jsonify({'success': False, 'error': "kind must be 'message' or 'chunk'"}), 400
+    
+    try:
+        top_k = min(max(int(data.get('top_k', 5)), 1), 50)
+        # Pick up anything added since the background indexer last ran
+        embedding_index.update(session_id)
+        results = embedding_index.search(session_id, query, top_k, kind=kind)
+        return jsonify({'success': True, 'results': results})
+    except OllamaConnectionError as e:
+        return jsonify({'success': False, 'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/session/<session_id>/delete', methods=['DELETE'])
 def delete_session(session_id):
     try:
         with get_db() as conn:
             # Delete file attachments first
+            # Blobs are shared by content hash; only delete those no other session uses
             cursor = conn.execute('''
-                SELECT fa.file_path FROM file_attachments fa
+                SELECT DISTINCT fa.file_path FROM file_attachments fa
                 JOIN messages m ON fa.message_id = m.id
                 WHERE m.session_id = ?
-            ''', (session_id,))
+                AND NOT EXISTS (
+                    SELECT 1 FROM file_attachments other
+                    JOIN messages om ON other.message_id = om.id
+                    WHERE other.file_path = fa.file_path AND om.session_id != ?
+                )
+            ''', (session_id, session_id))
             
             file_paths = cursor.fetchall()
             
@@ -1048,6 +4898,11 @@ def delete_session(session_id):
             conn.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
             conn.commit()
         
+        # Search chunks of documents no other session uses
+        document_index.prune()
+        embedding_index.delete(session_id)
+        vision_images.prune()
+        
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -1096,6 +4951,30 @@ def get_claude_status():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    try:
+        return jsonify({
+            'success': True,
+            'cache': response_cache.stats(),
+            'coalescing': {
+                'in_flight': chat_single_flight.in_flight(),
+                'coalesced': chat_single_flight.coalesced,
+                'streams_in_flight': chat_stream_flight.in_flight(),
+                'streams_coalesced': chat_stream_flight.coalesced
+            }
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/cache/clear', methods=['POST'])
+def clear_cache():
+    try:
+        response_cache.clear()
+        return jsonify({'success': True})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 # Database helper functions
 def create_session(session_id=None):
     """Create a new chat session"""
@@ -1140,11 +5019,11 @@ def add_message(session_id, role, content, model=None, file_info=None):
             # Add file attachment if present
             if file_info:
                 conn.execute(
-                    '''INSERT INTO file_attachments (message_id, filename, original_filename, file_path, file_size, mime_type, processed_content)
-                       VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                    '''INSERT INTO file_attachments (message_id, filename, original_filename, file_path, file_size, mime_type, processed_content, content_hash)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
                     (message_id, file_info['filename'], file_info['original_filename'], 
                      file_info['file_path'], file_info['file_size'], file_info['mime_type'], 
-                     file_info.get('processed_content', ''))
+                     file_info.get('processed_content', ''), file_info.get('content_hash'))
                 )
             
             # Update session last active time
@@ -1153,51 +5032,123 @@ def add_message(session_id, role, content, model=None, file_info=None):
                 (session_id,)
             )
             conn.commit()
-            return message_id
+        embedding_index.schedule(session_id)
+        return message_id
     except Exception as e:
         print(f"Error adding message to database: {e}")
         return None
 
-def get_session_messages(session_id, limit=50):
-    """Get messages for a session"""
+def delete_message(message_id):
+    """Remove a message that never got an answer, e.g. one rejected with 429"""
+    if not message_id:
+        return
     try:
         with get_db() as conn:
-            cursor = conn.execute(
-                '''SELECT m.*, fa.original_filename, fa.mime_type as attachment_mime_type, fa.processed_content
-                   FROM messages m
-                   LEFT JOIN file_attachments fa ON m.id = fa.message_id
-                   WHERE m.session_id = ? 
-                   ORDER BY m.timestamp DESC LIMIT ?''',
-                (session_id, limit)
+            # Attachment blobs are shared by content hash and stay on disk
+            conn.execute('DELETE FROM file_attachments WHERE message_id = ?', (message_id,))
+            conn.execute("DELETE FROM embedding_entries WHERE kind = 'message' AND source_id = ?", (message_id,))
+            conn.execute('DELETE FROM messages WHERE id = ?', (message_id,))
+            conn.commit()
+    except Exception as e:
+        print(f"Error deleting message {message_id}: {e}")
+
+def save_prompt_content(message_id, prompt_content):
+    """Record a user turn as first sent, so later prompts replay it unchanged"""
+    try:
+        with get_db() as conn:
+            # With several models the first prompt built wins
+            conn.execute(
+                'UPDATE messages SET prompt_content = ? WHERE id = ? AND prompt_content IS NULL',
+                (prompt_content, message_id)
             )
-            messages = cursor.fetchall()
-            return [dict(msg) for msg in reversed(messages)]
+            conn.commit()
     except Exception as e:
-        print(f"Error getting session messages: {e}")
-        return []
+        print(f"Error saving prompt content: {e}")
 
-def get_recent_messages(session_id, limit=10):
-    """Get recent messages for context"""
+def get_cached_extraction(content_hash, file_ext):
+    """Get cached extraction output for a blob from the current extractor version"""
+    try:
+        with get_db() as conn:
+            row = conn.execute(
+                '''SELECT processed_content FROM extraction_cache
+                   WHERE content_hash = ? AND extractor_version = ? AND file_ext = ?''',
+                (content_hash, FileProcessor.VERSION, file_ext)
+            ).fetchone()
+            return row['processed_content'] if row else None
+    except Exception as e:
+        print(f"Error reading extraction cache: {e}")
+        return None
+
+def save_cached_extraction(content_hash, file_ext, processed_content):
+    """Store extraction output for a blob"""
+    try:
+        with get_db() as conn:
+            conn.execute(
+                '''INSERT OR REPLACE INTO extraction_cache (content_hash, extractor_version, file_ext, processed_content)
+                   VALUES (?, ?, ?, ?)''',
+                (content_hash, FileProcessor.VERSION, file_ext, processed_content)
+            )
+            conn.commit()
+    except Exception as e:
+        print(f"Error writing extraction cache: {e}")
+
+def get_cached_pdf_pages(content_hash, page_limit):
+    """Get cached page texts of a PDF as {page index: text}"""
+    try:
+        with get_db() as conn:
+            rows = conn.execute(
+                '''SELECT page_number, text FROM pdf_page_cache
+                   WHERE content_hash = ? AND extractor_version = ? AND page_number < ?''',
+                (content_hash, FileProcessor.VERSION, page_limit)
+            ).fetchall()
+            return {row['page_number']: row['text'] for row in rows}
+    except Exception as e:
+        print(f"Error reading PDF page cache: {e}")
+        return {}
+
+def save_cached_pdf_pages(content_hash, start, texts):
+    """Store the text of consecutive PDF pages starting at index start"""
+    try:
+        with get_db() as conn:
+            conn.executemany(
+                '''INSERT OR REPLACE INTO pdf_page_cache (content_hash, extractor_version, page_number, text)
+                   VALUES (?, ?, ?, ?)''',
+                [(content_hash, FileProcessor.VERSION, start + offset, text) for offset, text in enumerate(texts)]
+            )
+            conn.commit()
+    except Exception as e:
+        print(f"Error writing PDF page cache: {e}")
+
+def get_session_summary(session_id):
+    """Get the rolling summary and the id of the last message it covers"""
+    try:
+        with get_db() as conn:
+            row = conn.execute(
+                'SELECT summary, summary_message_id FROM sessions WHERE id = ?',
+                (session_id,)
+            ).fetchone()
+            if row:
+                return row['summary'], row['summary_message_id'] or 0
+    except Exception as e:
+        print(f"Error getting session summary: {e}")
+    return None, 0
+
+def get_session_messages(session_id, limit=50):
+    """Get messages for a session"""
     try:
         with get_db() as conn:
             cursor = conn.execute(
-                '''SELECT m.role, m.content, fa.processed_content
+                '''SELECT m.*, fa.original_filename, fa.mime_type as attachment_mime_type, fa.processed_content
                    FROM messages m
                    LEFT JOIN file_attachments fa ON m.id = fa.message_id
                    WHERE m.session_id = ? 
-                   ORDER BY m.timestamp DESC LIMIT ?''',
+                   ORDER BY m.timestamp DESC, m.id DESC LIMIT ?''',
                 (session_id, limit)
             )
             messages = cursor.fetchall()
-            result = []
-            for msg in reversed(messages):
-                message_content = msg['content']
-                if msg['processed_content']:
-                    message_content += f"\n\nFile content:\n{msg['processed_content']}"
-                result.append({'role': msg['role'], 'content': message_content})
-            return result
+            return [dict(msg) for msg in reversed(messages)]
     except Exception as e:
-        print(f"Error getting recent messages: {e}")
+        print(f"Error getting session messages: {e}")
         return []
 
 def get_all_sessions():
@@ -1856,7 +5807,7 @@ def initialize_app():
     print("=" * 50)
     safe_print(f"📁 Upload folder: {UPLOAD_FOLDER}")
     safe_print(f"🗄️  Database: {DATABASE}")
-    safe_print(f"🌐 Ollama URL: {OLLAMA_BASE_URL}")
+    safe_print(f"🌐 Ollama URL: {', '.join(OLLAMA_BASE_URLS)}")
     print("")
     
     # Check AI capabilities
@@ -1864,11 +5815,11 @@ def initialize_app():
     
     ai_models = []
     
-    # Test Ollama connection
+    # Test Ollama connection and prime the model catalog
     try:
-        models = ollama_client.list_models()
-        if models.get('models'):
-            model_names = [model['name'] for model in models['models']]
+        catalog_models = model_catalog.refresh()
+        if catalog_models:
+            model_names = [model['name'] for model in catalog_models]
             ai_models.extend(model_names)
             safe_print(f"   ✅ Ollama: {len(model_names)} models ({', '.join(model_names[:3])}{'...' if len(model_names) > 3 else ''})")
         else:
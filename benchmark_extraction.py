@@ -0,0 +1,61 @@
+"""Compare the streaming .docx/.pptx extractors with the python-docx/python-pptx path
+
+Usage:
+    python benchmark_extraction.py FILE [FILE ...] [--repeat N]
+
+For each file this prints the time taken by both extractors, the speedup and
+whether their output is identical.
+"""
+import argparse
+import os
+import time
+
+from app import FileProcessor, office_xml_extractor, FastPathUnsupported
+
+
+def best_time(function, repeat):
+    """Best wall-clock time of repeat runs, and the last result"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark(file_path, repeat):
+    processor = FileProcessor()
+    filename = os.path.basename(file_path)
+    if filename.endswith('.docx'):
+        fast = lambda: office_xml_extractor.word_document(file_path, filename)
+        slow = lambda: processor._load_word_document(file_path, filename)
+    elif filename.endswith('.pptx'):
+        fast = lambda: office_xml_extractor.powerpoint(file_path, filename)
+        slow = lambda: processor._load_powerpoint(file_path, filename)
+    else:
+        print(f"{filename}: skipped (not .docx or .pptx)")
+        return
+
+    try:
+        fast_time, fast_output = best_time(fast, repeat)
+    except FastPathUnsupported as e:
+        print(f"{filename}: streaming extractor falls back ({e})")
+        return
+    slow_time, slow_output = best_time(slow, repeat)
+
+    size_kb = os.path.getsize(file_path) / 1024
+    print(f"{filename}: {size_kb:,.0f} KB | object model {slow_time * 1000:,.1f} ms | "
+          f"streaming {fast_time * 1000:,.1f} ms | {slow_time / fast_time:.1f}x | "
+          f"identical output: {fast_output == slow_output}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for file_path in args.files:
+        benchmark(file_path, args.repeat)
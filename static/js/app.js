@@ -6,6 +6,7 @@ let currentSessionId = null;
 let isLoading = false;
 let isSplitMode = false;
 let claudeCodeAvailable = false;
+let currentChatController = null; // Aborts the in-flight chat request
 
 // DOM Elements
 let chatContainer, promptInput, sendButton, modelSelect, fileInput, fileButton, fileInfo, filePreview;
@@ -327,42 +328,70 @@ async function sendMessage() {
         formData.append('model', selectedModel);
 
         if (selectedFile) {
-            formData.append('file', selectedFile);
+            // Extract in the background and show progress before the chat starts
+            const upload = await uploadFileForExtraction(selectedFile, (progress) => {
+                sendButton.textContent = `Extracting ${Math.round(progress * 100)}%`;
+            });
+            formData.append('upload_id', upload.id);
+            sendButton.textContent = 'Sending...';
         }
 
         console.log('Sending message with model:', selectedModel);
 
-        // Send to backend
-        const response = await fetch('/api/chat', {
+        // Send to backend and render tokens as they stream in
+        currentChatController = new AbortController();
+        const response = await fetch('/api/chat/stream', {
             method: 'POST',
-            body: formData
+            body: formData,
+            signal: currentChatController.signal
         });
 
         console.log('Chat API response status:', response.status);
 
         if (!response.ok) {
-            throw new Error(`HTTP error! status: ${response.status}`);
+            let errorMessage = `HTTP error! status: ${response.status}`;
+            try {
+                const data = await response.json();
+                errorMessage = data.error || errorMessage;
+            } catch (e) {
+                // Non-JSON error body
+            }
+            throw new Error(errorMessage);
         }
 
-        const data = await response.json();
-        console.log('Chat API response data:', data);
+        let streamedText = '';
+        let streamingDiv = null;
 
-        if (data.success) {
-            // Enter split mode when AI responds
-            enterSplitMode();
+        await readEventStream(response, (event) => {
+            if (event.type === 'token') {
+                if (!streamingDiv) {
+                    // Enter split mode on the first token
+                    enterSplitMode();
+                    streamingDiv = startStreamingResponse(selectedModel);
+                }
+                streamedText += event.content;
+                updateStreamingResponse(streamingDiv, streamedText);
+            } else if (event.type === 'done') {
+                console.log('Chat stream finished:', event);
+                enterSplitMode();
+                // Replace the raw text with the server-formatted version
+                const responseContent = event.formatted_content || event.content;
+                addResponseToSplitView(responseContent, selectedModel);
+            } else if (event.type === 'error') {
+                throw new Error(event.error || 'Unknown error occurred');
+            }
+        });
 
-            // Add assistant response ONLY to split view (not main chat)
-            // Use formatted_content if available, otherwise fall back to content
-            const responseContent = data.message.formatted_content || data.message.content;
-            addResponseToSplitView(responseContent, selectedModel);
+    } catch (error) {
+        if (error.name === 'AbortError') {
+            // Cancelled on purpose (e.g. new session); the server stops generating
+            console.log('Chat request cancelled');
         } else {
-            throw new Error(data.error || 'Unknown error occurred');
+            console.error('Error sending message:', error);
+            addMessage(`❌ Error: ${error.message}`, 'system');
         }
-
-    } catch (error) {
-        console.error('Error sending message:', error);
-        addMessage(`❌ Error: ${error.message}`, 'system');
     } finally {
+        currentChatController = null;
         // Reset form
         promptInput.value = '';
         clearFileSelection();
@@ -372,6 +401,75 @@ async function sendMessage() {
     }
 }
 
+// Upload a file as a background extraction job and poll until it finishes
+async function uploadFileForExtraction(file, onProgress) {
+    const uploadData = new FormData();
+    uploadData.append('file', file);
+
+    const response = await fetch('/api/uploads', { method: 'POST', body: uploadData });
+    let data = await response.json();
+    if (!data.success) {
+        throw new Error(data.error || 'Upload failed');
+    }
+
+    let upload = data.upload;
+    while (upload.status === 'queued' || upload.status === 'running') {
+        onProgress(upload.progress);
+        await new Promise(resolve => setTimeout(resolve, 500));
+        data = await (await fetch(`/api/uploads/${upload.id}`)).json();
+        if (!data.success) {
+            throw new Error(data.error || 'Upload status unavailable');
+        }
+        upload = data.upload;
+    }
+
+    if (upload.status === 'failed') {
+        throw new Error(upload.error || 'File extraction failed');
+    }
+    onProgress(1);
+    return upload;
+}
+
+// Read a Server-Sent Events response body and call onEvent for each data frame
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+
+        buffer += decoder.decode(value, { stream: true });
+        const frames = buffer.split('\n\n');
+        buffer = frames.pop();
+
+        for (const frame of frames) {
+            const dataLine = frame.split('\n').find(line => line.startsWith('data: '));
+            if (dataLine) {
+                onEvent(JSON.parse(dataLine.slice(6)));
+            }
+        }
+    }
+}
+
+// Create an empty response in the split view that is filled while streaming
+function startStreamingResponse(model) {
+    addResponseToSplitView('', model);
+    const responseDiv = responseContent.querySelector('.response-message.latest');
+    if (responseDiv) {
+        responseDiv.classList.add('streaming');
+    }
+    return responseDiv;
+}
+
+function updateStreamingResponse(responseDiv, text) {
+    if (!responseDiv) return;
+    const contentDiv = responseDiv.querySelector('.message-content');
+    // Raw tokens are shown as plain text until the formatted answer arrives
+    contentDiv.textContent = text;
+}
+
 // Add message to chat with enhanced formatting support
 function addMessage(content, role, model = null, hasFile = false, fileName = null) {
     const messageDiv = document.createElement('div');
@@ -816,7 +914,16 @@ function addResponseToSplitView(content, model = null, isLatest = true) {
 }
 
 // Session management - Updated to handle welcome message
+// Cancel the in-flight chat request, if any
+function cancelCurrentChat() {
+    if (currentChatController) {
+        currentChatController.abort();
+        currentChatController = null;
+    }
+}
+
 async function createNewSession() {
+    cancelCurrentChat();
     try {
         const response = await fetch('/api/session/new', {
             method: 'POST',
@@ -0,0 +1,199 @@
+"""Shared fixtures: a local fake Ollama server and an isolated copy of the app
+
+app.py keeps its database, uploads and vector files relative to the working
+directory and reads its configuration at import time, so both are set up
+here before the app is imported.
+"""
+import json
+import os
+import re
+import socket
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Words the fake embedding model knows; a text's vector counts each of them
+EMBEDDING_VOCABULARY = ['cat', 'dog', 'car', 'engine', 'rain', 'sun']
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        fake = self.server.fake
+        fake.record(self.path, None)
+        if not fake.healthy:
+            self._send_json({'error': 'unavailable'}, 500)
+        elif self.path == '/api/tags':
+            self._send_json({'models': [{'name': name} for name in fake.models]})
+        elif self.path == '/api/ps':
+            self._send_json({'models': [{'name': name} for name in fake.loaded]})
+        else:
+            self._send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        fake = self.server.fake
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        fake.record(self.path, body)
+
+        if self.path == '/api/chat':
+            answer = fake.answer(body)
+            if body.get('stream'):
+                self._stream_chat(answer)
+            else:
+                time.sleep(fake.delay)
+                self._send_json({
+                    'model': body.get('model'),
+                    'message': {'role': 'assistant', 'content': answer},
+                    'done': True,
+                    'prompt_eval_count': 10,
+                    'eval_count': 3,
+                    'eval_duration': 1000000
+                })
+        elif self.path == '/api/embed':
+            inputs = body.get('input')
+            inputs = inputs if isinstance(inputs, list) else [inputs]
+            self._send_json({'embeddings': [fake_embedding(text) for text in inputs]})
+        elif self.path == '/api/show':
+            self._send_json({'capabilities': ['completion']})
+        else:
+            self._send_json({'error': 'not found'}, 404)
+
+    def _stream_chat(self, answer):
+        fake = self.server.fake
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        tokens = re.findall(r'\S+\s*', answer)
+        chunks = [{'message': {'role': 'assistant', 'content': token}, 'done': False} for token in tokens]
+        chunks.append({'message': {'role': 'assistant', 'content': ''}, 'done': True,
+                       'prompt_eval_count': 10, 'eval_count': len(tokens), 'eval_duration': 1000000})
+        for chunk in chunks:
+            time.sleep(fake.delay / len(chunks))
+            data = (json.dumps(chunk) + '\n').encode()
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+
+def fake_embedding(text):
+    """Bag-of-words vector over EMBEDDING_VOCABULARY, plus a constant so it is never zero"""
+    words = re.findall(r'[a-z]+', text.lower())
+    return [0.1] + [float(words.count(word)) for word in EMBEDDING_VOCABULARY]
+
+
+class FakeOllama:
+    """A local stand-in for the Ollama HTTP API that records every request"""
+    def __init__(self, delay=0.0, models=('llama2', 'mistral'), loaded=()):
+        self.delay = delay
+        self.models = list(models)
+        self.loaded = list(loaded)
+        self.healthy = True
+        self.requests = []
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeOllamaHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def record(self, path, body):
+        with self._lock:
+            self.requests.append((path, body))
+
+    def calls(self, path):
+        with self._lock:
+            return [body for request_path, body in self.requests if request_path == path]
+
+    def answer(self, body):
+        return f"Echo: {body['messages'][-1]['content']}"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def unused_url():
+    """URL of a local port nothing listens on, so connections are refused"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}"
+
+
+# The module-level clients in app.py talk to this server, never to a real Ollama
+_default_ollama = FakeOllama()
+os.environ['OLLAMA_BASE_URL'] = _default_ollama.url
+os.environ.pop('OLLAMA_BASE_URLS', None)
+os.environ['RESPONSE_CACHE_ENABLED'] = 'false'
+os.environ['EMBEDDING_MODEL'] = ''
+os.environ['SUMMARY_MODEL'] = ''
+os.chdir(tempfile.mkdtemp(prefix='ollama-chat-tests-'))
+
+import app as app_module  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """The app module with a fresh database, scheduler and coalescing state"""
+    monkeypatch.setattr(app_module, 'DATABASE', str(tmp_path / 'chat_app.db'))
+    app_module.init_db()
+    monkeypatch.setattr(app_module, 'generation_scheduler', app_module.GenerationScheduler())
+    monkeypatch.setattr(app_module, 'chat_single_flight', app_module.SingleFlight())
+    monkeypatch.setattr(app_module, 'chat_stream_flight', app_module.StreamFlight())
+    monkeypatch.setattr(app_module, 'response_cache',
+                        app_module.ResponseCache(database=str(tmp_path / 'cache.db'), enabled=False))
+    return app_module
+
+
+@pytest.fixture
+def fake_ollama():
+    """A fresh fake Ollama server, stopped after the test"""
+    servers = []
+
+    def start(**kwargs):
+        server = FakeOllama(**kwargs)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def make_pool(app, urls, **kwargs):
+    """A backend pool whose health is only checked when a test asks for it"""
+    pool = app.OllamaBackendPool(urls, **kwargs)
+    pool.start_health_checks = lambda: None
+    for backend in pool.backends:
+        # Fail over immediately instead of retrying a refused connection
+        backend.client.max_retries = 0
+    return pool
+
+
+@pytest.fixture
+def ollama(app, fake_ollama, monkeypatch):
+    """Points the app's Ollama client at a fresh fake server and returns the server"""
+    server = fake_ollama(delay=0.3)
+    monkeypatch.setattr(app, 'ollama_client', make_pool(app, [server.url]))
+    return server
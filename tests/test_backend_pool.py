@@ -0,0 +1,108 @@
+"""OllamaBackendPool routing, failover and health checks against local fake servers"""
+import pytest
+
+from conftest import make_pool, unused_url
+
+MESSAGES = [{'role': 'user', 'content': 'hello'}]
+
+
+def test_chat_fails_over_to_a_reachable_host(app, fake_ollama):
+    live = fake_ollama()
+    pool = make_pool(app, [unused_url(), live.url])
+
+    response = pool.chat('llama2', MESSAGES)
+
+    assert response['message']['content'] == 'Echo: hello'
+    dead, alive = pool.backends
+    assert not dead.healthy
+    assert dead.failures == 1
+    assert dead.last_error
+    assert alive.healthy
+    assert [backend.outstanding for backend in pool.backends] == [0, 0]
+
+
+def test_ejected_host_gets_no_traffic_while_another_is_healthy(app, fake_ollama):
+    first, second = fake_ollama(), fake_ollama()
+    pool = make_pool(app, [first.url, second.url])
+    first.stop()
+
+    pool.chat('llama2', MESSAGES)
+    pool.chat('llama2', MESSAGES)
+    pool.chat('llama2', MESSAGES)
+
+    assert not pool.backends[0].healthy
+    assert len(second.calls('/api/chat')) == 3
+
+
+def test_chat_raises_when_no_host_is_reachable(app):
+    pool = make_pool(app, [unused_url(), unused_url()])
+
+    with pytest.raises(app.OllamaConnectionError):
+        pool.chat('llama2', MESSAGES)
+    assert [backend.outstanding for backend in pool.backends] == [0, 0]
+
+
+def test_stream_fails_over_before_the_first_chunk(app, fake_ollama):
+    live = fake_ollama()
+    pool = make_pool(app, [unused_url(), live.url])
+
+    content = "".join(chunk['message']['content'] for chunk in pool.chat_stream('llama2', MESSAGES))
+
+    assert content == 'Echo: hello'
+    assert not pool.backends[0].healthy
+
+
+def test_health_checks_eject_after_repeated_failures_and_readmit(app, fake_ollama):
+    flaky = fake_ollama()
+    pool = make_pool(app, [flaky.url], eject_after=2)
+    backend = pool.backends[0]
+
+    flaky.healthy = False
+    pool.check_health()
+    assert backend.healthy
+    assert backend.failures == 1
+    pool.check_health()
+    assert not backend.healthy
+    assert backend.last_checked is not None
+
+    flaky.healthy = True
+    pool.check_health()
+    assert backend.healthy
+    assert backend.failures == 0
+    assert backend.last_error is None
+
+
+def test_routing_prefers_the_host_with_the_model_loaded(app, fake_ollama):
+    cold = fake_ollama(loaded=[])
+    warm = fake_ollama(loaded=['llama2:latest'])
+    pool = make_pool(app, [cold.url, warm.url])
+    pool.check_health()
+
+    pool.chat('llama2', MESSAGES)
+    pool.chat('llama2:latest', MESSAGES)
+
+    assert len(warm.calls('/api/chat')) == 2
+    assert cold.calls('/api/chat') == []
+    assert pool.backends[1].loaded_models == {'llama2:latest'}
+
+
+def test_routing_spreads_load_by_outstanding_requests(app, fake_ollama):
+    first, second = fake_ollama(), fake_ollama()
+    pool = make_pool(app, [first.url, second.url])
+
+    busy = pool._select('mistral')
+    other = pool._select('mistral')
+
+    assert {busy.base_url, other.base_url} == {first.url, second.url}
+    pool._release(busy)
+    pool._release(other)
+
+
+def test_numeric_keep_alive_is_sent_as_a_number(app, fake_ollama):
+    server = fake_ollama()
+    pool = make_pool(app, [server.url])
+
+    pool.chat('llama2', MESSAGES, keep_alive='-1')
+    pool.chat('llama2', MESSAGES, keep_alive='30m')
+
+    assert [body['keep_alive'] for body in server.calls('/api/chat')] == [-1, '30m']
@@ -0,0 +1,111 @@
+"""Identical concurrent generations share one upstream call"""
+import json
+import threading
+import time
+
+import pytest
+
+N_REQUESTS = 4
+
+
+def run_concurrently(target, count=N_REQUESTS):
+    results = [None] * count
+
+    def run(index):
+        results[index] = target(index)
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+def test_single_flight_runs_identical_calls_once(app):
+    flight = app.SingleFlight()
+    calls = []
+
+    def generate():
+        calls.append(1)
+        time.sleep(0.3)
+        return {'answer': 42}
+
+    results = run_concurrently(lambda index: flight.do('key', generate))
+
+    assert calls == [1]
+    assert results == [{'answer': 42}] * N_REQUESTS
+    assert flight.coalesced == N_REQUESTS - 1
+    assert flight.in_flight() == 0
+
+
+def test_single_flight_shares_the_leaders_error(app):
+    flight = app.SingleFlight()
+
+    def fail():
+        time.sleep(0.3)
+        raise ValueError('model not found')
+
+    def call(index):
+        try:
+            flight.do('key', fail)
+        except ValueError as e:
+            return str(e)
+
+    assert run_concurrently(call) == ['model not found'] * N_REQUESTS
+
+
+def test_single_flight_follower_stops_waiting_when_cancelled(app):
+    flight = app.SingleFlight()
+    cancel = threading.Event()
+    leader = threading.Thread(target=flight.do, args=('key', lambda: time.sleep(2)))
+    leader.start()
+    time.sleep(0.1)
+
+    threading.Timer(0.2, cancel.set).start()
+    started = time.time()
+    with pytest.raises(app.GenerationCancelled):
+        flight.do('key', lambda: None, cancel)
+
+    assert time.time() - started < 1
+    leader.join()
+
+
+def test_identical_chat_requests_make_one_upstream_call(app, ollama):
+    def post(index):
+        # Separate clients are separate sessions, so every prompt is the same
+        response = app.app.test_client().post('/api/chat', json={'message': 'hello', 'model': 'llama2'})
+        return response.status_code, response.get_json()['message']['content']
+
+    results = run_concurrently(post)
+
+    assert results == [(200, 'Echo: hello')] * N_REQUESTS
+    assert len(ollama.calls('/api/chat')) == 1
+    assert app.chat_single_flight.coalesced == N_REQUESTS - 1
+
+
+def test_identical_chat_streams_make_one_upstream_call(app, ollama):
+    def stream(index):
+        response = app.app.test_client().post('/api/chat/stream', json={'message': 'hello there', 'model': 'llama2'})
+        events = [json.loads(line[len('data: '):]) for line in response.get_data(as_text=True).splitlines()
+                  if line.startswith('data: ')]
+        tokens = "".join(event['content'] for event in events if event['type'] == 'token')
+        return response.status_code, tokens, events[-1]['type']
+
+    results = run_concurrently(stream)
+
+    assert results == [(200, 'Echo: hello there', 'done')] * N_REQUESTS
+    assert len(ollama.calls('/api/chat')) == 1
+    assert app.chat_stream_flight.coalesced == N_REQUESTS - 1
+    assert app.chat_stream_flight.in_flight() == 0
+
+
+def test_different_prompts_are_not_coalesced(app, ollama):
+    def post(index):
+        response = app.app.test_client().post('/api/chat', json={'message': f'question {index}', 'model': 'llama2'})
+        return response.get_json()['message']['content']
+
+    results = run_concurrently(post)
+
+    assert sorted(results) == [f'Echo: question {index}' for index in range(N_REQUESTS)]
+    assert len(ollama.calls('/api/chat')) == N_REQUESTS
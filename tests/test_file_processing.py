@@ -0,0 +1,77 @@
+"""ExtractionProcessPool workers and the CSV/JSON data profiles"""
+import json
+
+import pytest
+
+
+@pytest.fixture
+def pool(app):
+    pool = app.ExtractionProcessPool(size=1, timeout=30)
+    yield pool
+    while not pool.idle.empty():
+        pool.idle.get_nowait().stop(force=True)
+
+
+def test_worker_extracts_a_file(pool, tmp_path):
+    path = tmp_path / 'notes.txt'
+    path.write_text('meeting notes\nship on friday\n')
+
+    content = pool.run(str(path), 'notes.txt', 'text/plain')
+
+    assert 'ship on friday' in content
+    assert pool.stats()['completed'] == 1
+
+
+def test_timed_out_worker_is_replaced(app, pool, tmp_path):
+    path = tmp_path / 'notes.txt'
+    path.write_text('meeting notes\n')
+
+    pool.timeout = 0
+    with pytest.raises(app.ExtractionTimeout):
+        pool.call('process_file', (str(path), 'notes.txt', 'text/plain'))
+    assert pool.stats()['timeouts'] == 1
+    assert pool.stats()['running'] == 0
+
+    pool.timeout = 30
+    assert 'meeting notes' in pool.run(str(path), 'notes.txt', 'text/plain')
+
+
+def test_json_keys_are_the_header_even_when_they_look_like_values(app, tmp_path):
+    path = tmp_path / 'data.json'
+    path.write_text(json.dumps([{'id': 1, '2024': 5, 'NA': 'x'}, {'id': 2, '2024': 7, 'NA': 'y'}]))
+
+    profile = app.file_processor._process_structured_data(str(path), 'data.json')
+
+    assert 'Rows: 2 | Columns: 3' in profile
+    assert '`2024` (integer)' in profile
+    assert '`NA` (text)' in profile
+
+
+def test_ndjson_falls_back_to_text(app, tmp_path):
+    path = tmp_path / 'events.json'
+    path.write_text('{"event": "login"}\n{"event": "logout"}\n')
+
+    content = app.file_processor._process_structured_data(str(path), 'events.json')
+
+    assert '"event": "logout"' in content
+    assert 'Data profile' not in content
+
+
+def test_csv_header_with_numeric_labels_is_kept(app, tmp_path):
+    path = tmp_path / 'sales.csv'
+    path.write_text('year,2020,2021\n2019,1.5,2.5\n2018,3,4\n')
+
+    profile = app.file_processor._process_structured_data(str(path), 'sales.csv')
+
+    assert 'Rows: 2 | Columns: 3' in profile
+    assert '`2020` (float)' in profile
+
+
+def test_csv_without_header_gets_numbered_columns(app, tmp_path):
+    path = tmp_path / 'grid.csv'
+    path.write_text('1,2,3\n4,5,6\n7,8,9\n')
+
+    profile = app.file_processor._process_structured_data(str(path), 'grid.csv')
+
+    assert 'Rows: 3 | Columns: 3' in profile
+    assert '`Column 1` (integer)' in profile
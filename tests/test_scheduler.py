@@ -0,0 +1,84 @@
+"""GenerationScheduler limits, fair queueing and the 429 Retry-After responses"""
+import threading
+import time
+
+import pytest
+
+
+def test_requests_past_the_limit_and_queue_are_rejected(app):
+    scheduler = app.GenerationScheduler(default_limit=1, max_queue=0)
+    slot = scheduler.acquire('llama2')
+
+    with pytest.raises(app.QueueFullError) as error:
+        scheduler.acquire('llama2')
+
+    # Nothing has finished yet, so there is no duration to estimate from
+    assert error.value.retry_after == 1
+    assert scheduler.stats()['llama2']['rejected'] == 1
+    slot.release()
+
+
+def test_retry_after_follows_observed_generation_times(app):
+    scheduler = app.GenerationScheduler(default_limit=1, max_queue=0)
+    slot = scheduler.acquire('llama2')
+    slot.acquired_at -= 6
+    slot.release()
+    assert scheduler.stats()['llama2']['avg_duration'] == pytest.approx(6, abs=0.1)
+
+    slot = scheduler.acquire('llama2')
+    with pytest.raises(app.QueueFullError) as error:
+        scheduler.acquire('llama2')
+    assert error.value.retry_after == 6
+    slot.release()
+
+
+def test_queued_sessions_are_served_round_robin(app):
+    scheduler = app.GenerationScheduler(default_limit=1, max_queue=10)
+    slot = scheduler.acquire('llama2', 'busy')
+    served = []
+
+    def wait(session_id, label):
+        with scheduler.acquire('llama2', session_id):
+            served.append(label)
+
+    threads = []
+    for session_id, label in [('busy', 'busy-2'), ('busy', 'busy-3'), ('quiet', 'quiet-1')]:
+        thread = threading.Thread(target=wait, args=(session_id, label))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.05)
+    slot.release()
+    for thread in threads:
+        thread.join(5)
+
+    assert served == ['busy-2', 'quiet-1', 'busy-3']
+
+
+def test_cancelled_waiter_leaves_the_queue(app):
+    scheduler = app.GenerationScheduler(default_limit=1, max_queue=10)
+    slot = scheduler.acquire('llama2')
+    cancel = threading.Event()
+    cancel.set()
+
+    with pytest.raises(app.GenerationCancelled):
+        scheduler.acquire('llama2', cancel_event=cancel)
+    assert scheduler.stats()['llama2']['queued'] == 0
+    slot.release()
+
+
+@pytest.mark.parametrize('path', ['/api/chat', '/api/chat/stream'])
+def test_full_queue_returns_429_with_retry_after(app, ollama, monkeypatch, path):
+    scheduler = app.GenerationScheduler(default_limit=1, max_queue=0)
+    monkeypatch.setattr(app, 'generation_scheduler', scheduler)
+    slot = scheduler.acquire('llama2')
+
+    response = app.app.test_client().post(path, json={'message': 'hello', 'model': 'llama2'})
+
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+    assert response.get_json()['retry_after'] == 1
+    assert ollama.calls('/api/chat') == []
+    # The rejected question is not left behind to be replayed into history
+    with app.get_db() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 0
+    slot.release()
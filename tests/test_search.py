@@ -0,0 +1,92 @@
+"""Keyword and semantic search ranking over session documents and messages"""
+import pytest
+
+from conftest import make_pool
+
+SECTIONS = [
+    "Cats sleep most of the day and purr when they are content.",
+    "A car engine turns fuel into motion; the engine needs regular oil changes.",
+    "Rain is forecast for the weekend, with sun returning on Monday.",
+]
+
+
+@pytest.fixture
+def document(app):
+    index = app.DocumentIndex(chunk_chars=200, overlap=0, top_k=3, enabled=True)
+    # Pad each section to its own chunk
+    text = "\n\n".join(section.ljust(190) for section in SECTIONS)
+    index.add('doc-hash', text)
+    return index
+
+
+def test_document_chunks_are_ranked_by_keyword_relevance(document):
+    rows = document.search('doc-hash', 'How often does the engine need oil?', 3)
+
+    assert rows[0]['content'].strip() == SECTIONS[1]
+
+
+def test_document_search_without_matches_returns_the_start(document):
+    rows = document.search('doc-hash', 'quantum chromodynamics', 2)
+
+    assert [row['chunk_index'] for row in rows] == [0, 1]
+
+
+def test_excerpts_keep_document_order_within_the_budget(app, document):
+    excerpt = document.excerpts('doc-hash', None, 'weekend rain and engine oil', max_tokens=200)
+
+    assert excerpt.index('Section 2') < excerpt.index('Section 3')
+    assert 'Cats sleep' not in excerpt
+
+
+@pytest.fixture
+def embeddings(app, fake_ollama, tmp_path):
+    server = fake_ollama()
+    index = app.EmbeddingIndex(make_pool(app, [server.url]), model='fake-embed',
+                               folder=str(tmp_path / 'embeddings'), batch_size=2)
+    index.server = server
+    return index
+
+
+@pytest.fixture
+def session_id(app):
+    session_id = app.create_session()
+    for role, content in [('user', 'My dog chases the cat'), ('assistant', 'Dogs often chase cats'),
+                          ('user', 'The car engine is making noise'), ('assistant', 'Check the engine belt')]:
+        app.add_message(session_id, role, content, 'llama2')
+    return session_id
+
+
+def test_semantic_search_ranks_the_most_similar_messages_first(embeddings, session_id):
+    assert embeddings.update(session_id) == 4
+
+    results = embeddings.search(session_id, 'engine trouble in my car', 2)
+
+    assert [result['text'] for result in results] == [
+        'User: The car engine is making noise',
+        'Assistant: Check the engine belt',
+    ]
+    assert results[0]['score'] >= results[1]['score']
+
+
+def test_embeddings_are_built_incrementally_in_batches(app, embeddings, session_id):
+    embeddings.update(session_id)
+    assert len(embeddings.server.calls('/api/embed')) == 2
+
+    assert embeddings.update(session_id) == 0
+    app.add_message(session_id, 'user', 'Sun and rain today', 'llama2')
+    assert embeddings.update(session_id) == 1
+
+    results = embeddings.search(session_id, 'rain', 1)
+    assert results[0]['text'] == 'User: Sun and rain today'
+
+
+def test_semantic_search_filters(app, embeddings, session_id):
+    embeddings.update(session_id)
+    with app.get_db() as conn:
+        car_question = conn.execute(
+            "SELECT id FROM messages WHERE content LIKE 'The car%'"
+        ).fetchone()['id']
+
+    results = embeddings.search(session_id, 'car engine', 4, exclude_sources=[car_question], min_score=0.5)
+
+    assert [result['text'] for result in results] == ['Assistant: Check the engine belt']